@@ -0,0 +1,206 @@
+# app/cache.py
+"""
+Read-through cache of the item hashes, kept in the memory of the worker.
+
+Items are kept in an LRU of FAKEAPI_CACHE_SIZE entries, each entry expires after FAKEAPI_CACHE_TTL seconds.
+Every write (POST/PUT/PATCH/DELETE) invalidates the item in this worker and publishes the item ID on the Redis
+channel 'invalidate:item', a batch publishes a comma separated list of IDs. Every replica subscribes to the channel
+and drops the items from its own cache. If the subscription is lost, the whole cache is flushed because invalidations could have been missed.
+
+Check the counters with curl:
+    curl -H "Accept: application/json" -i -L "http://localhost:8000/api/cache/stats"
+"""
+import asyncio
+import contextlib
+import time
+from collections import OrderedDict
+from fastapi import APIRouter
+from redis import exceptions
+from app.redis_db import redis, container_id
+from app.definitions import CACHE_SIZE, CACHE_TTL
+from app.singleflight import flights
+from app.logs import logger
+import app.metrics as metrics
+
+INVALIDATE_CHANNEL = 'invalidate:item'
+
+router = APIRouter()
+
+class ItemCache:
+    """
+    LRU cache of the items of a worker, with a TTL per entry. An entry is dropped by the writes of this worker and by
+    the invalidations of the other ones, received on INVALIDATE_CHANNEL.
+    """
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[float, dict]] = OrderedDict()
+        # incremented on every invalidation, see token() and put()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def get(self, item_id: int) -> dict | None:
+        entry = self._entries.get(item_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, value = entry
+        if expires < time.monotonic():
+            del self._entries[item_id]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(item_id)
+        self.hits += 1
+        return value
+
+    def token(self) -> int:
+        """
+        Take a token before reading Redis and give it back to put(). If an invalidation happened while the read
+        was in flight, the value read could be stale and it's not cached.
+        """
+        return self._generation
+
+    def put(self, item_id: int, value: dict, token: int) -> None:
+        if not self.enabled or token != self._generation:
+            return
+        self._entries[item_id] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(item_id)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def discard(self, item_id: int) -> None:
+        self._generation += 1
+        self.invalidations += 1
+        self._entries.pop(item_id, None)
+
+    def clear(self) -> None:
+        self._generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"enabled": self.enabled, "size": self.size, "ttl": self.ttl, "entries": len(self._entries),
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "expirations": self.expirations, "invalidations": self.invalidations,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0}
+
+
+cache = ItemCache(CACHE_SIZE, CACHE_TTL)
+
+def cache_metrics() -> list:
+    return [('fakeapi_cache_entries', 'gauge', 'Items in the cache', [('', len(cache._entries))]),
+            ('fakeapi_cache_events_total', 'counter', 'Events of the item cache',
+             [(f'event="{event}"', getattr(cache, event))
+              for event in ('hits', 'misses', 'evictions', 'expirations', 'invalidations')])]
+
+
+metrics.add_collector(cache_metrics)
+
+_listener: asyncio.Task | None = None
+_stopping: asyncio.Event | None = None
+# seconds a read of the channel waits for a message, and that stop() waits for the subscriber
+POLL_INTERVAL = 1.0
+STOP_TIMEOUT = 5.0
+
+async def invalidate(item_id: int) -> None:
+    """
+    Drops an item from the cache of this worker and tells the other replicas to do the same.
+    A failure to publish is logged, the TTL bounds how long the other replicas can serve the old item.
+    """
+    await invalidate_many([item_id])
+
+async def invalidate_many(item_ids: list[int]) -> None:
+    """
+    Same as invalidate() for a batch of items, with a single message published for the whole batch.
+    The reads of the items in flight aren't shared with the requests that arrive after the write.
+    """
+    for item_id in item_ids:
+        flights.forget((item_id, False))
+        flights.forget((item_id, True))
+    if not cache.enabled or not item_ids:
+        return
+    for item_id in item_ids:
+        cache.discard(item_id)
+    try:
+        await redis.publish(INVALIDATE_CHANNEL, f'{container_id} {",".join(map(str, item_ids))}')
+    except exceptions.RedisError as e:
+        logger.warning('Cache invalidation of %d item(s) not published: %s', len(item_ids), e)
+
+async def _listen(stopping: asyncio.Event) -> None:
+    while not stopping.is_set():
+        try:
+            async with redis.pubsub() as pubsub:
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+                logger.info('Subscribed to cache invalidation channel "%s"', INVALIDATE_CHANNEL)
+                try:
+                    # checked between the reads: a read in flight isn't cancelled by Task.cancel(), redis-py shields it
+                    while not stopping.is_set():
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=POLL_INTERVAL)
+                        if message is None:
+                            continue
+                        origin, _, item_ids = message['data'].partition(' ')
+                        # our own invalidations are done before they're published
+                        if origin != container_id:
+                            for item_id in item_ids.split(','):
+                                cache.discard(int(item_id))
+                finally:
+                    with contextlib.suppress(exceptions.RedisError):
+                        await pubsub.unsubscribe()
+        except asyncio.CancelledError:
+            raise
+        except (exceptions.RedisError, ValueError) as e:
+            logger.warning('Cache invalidation channel lost, flushing the cache: %s', e)
+            cache.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(stopping.wait(), 1)
+
+async def start() -> None:
+    """
+    Starts the subscriber of the invalidation channel, if the cache is enabled. The cache is flushed whenever the
+    subscription is lost, the invalidations sent meanwhile are missed.
+    """
+    global _listener, _stopping
+    if cache.enabled and _listener is None:
+        _stopping = asyncio.Event()
+        _listener = asyncio.create_task(_listen(_stopping))
+        logger.info('Item cache enabled: size=%s ttl=%ss', cache.size, cache.ttl)
+
+async def stop() -> None:
+    """
+    Stops the subscriber, it unsubscribes and closes its connection after its current read. It's cancelled if it
+    doesn't stop within STOP_TIMEOUT seconds.
+    """
+    global _listener, _stopping
+    if _listener is not None:
+        _stopping.set()
+        done, _ = await asyncio.wait({_listener}, timeout=STOP_TIMEOUT)
+        if not done:
+            logger.warning('Cache invalidation subscriber not stopped after %ss, cancelled', STOP_TIMEOUT)
+            _listener.cancel()
+        elif not _listener.cancelled() and _listener.exception() is not None:
+            logger.warning('Cache invalidation subscriber failed: %s', _listener.exception())
+        _listener = None
+        _stopping = None
+
+@router.get("/api/cache/stats", tags=["get"])
+async def cache_stats() -> dict:
+    """
+    Returns the counters of the item cache and of the coalesced reads of the worker that answers the request.
+    Use them to size FAKEAPI_CACHE_SIZE and FAKEAPI_CACHE_TTL.
+
+    Example with curl:
+        curl -H "Content-type: application/json" -H "Accept: application/json" -i -L \
+        "http://localhost:8000/api/cache/stats"
+    :return: The counters of the cache and of the coalesced reads
+    """
+    return {"hostname": container_id, "cache": cache.stats(), "singleflight": flights.stats()}
@@ -0,0 +1,210 @@
+# app/compression.py
+"""
+Compression of the responses with gzip, brotli or zstd, negotiated with the Accept-Encoding header of the request.
+
+    - The encoding is the first of FAKEAPI_COMPRESSION that the client accepts.
+    - Only the content types starting with one of FAKEAPI_COMPRESSION_TYPES are compressed, and only if the body has
+      at least FAKEAPI_COMPRESSION_MIN_SIZE bytes. A response that already has a Content-Encoding is sent as is.
+    - A streamed response (/api/redis/keys?stream=true, /api/items/export) is compressed chunk by chunk. Each chunk
+      is flushed, the client can decode the lines as they arrive.
+    - Every response of a content type that can be compressed has 'Vary: Accept-Encoding', compressed or not, so a
+      cache doesn't send a compressed response to a client that didn't ask for it.
+    - The ETag of a compressed response has the encoding as suffix, '"1697650000123456-gzip"', each encoding is a
+      different representation, see etags.encoded(). app/etags.py ignores the suffix, the ETag of any encoding can be
+      sent back in If-None-Match or If-Match.
+
+brotli and zstd are optional:
+    pip3 install brotli zstandard
+
+Check with curl:
+    curl -H "Accept-Encoding: gzip" -o /dev/null -D - "http://localhost:8000/api/users"
+"""
+import zlib
+from starlette.datastructures import MutableHeaders
+from app.definitions import COMPRESSION, COMPRESSION_MIN_SIZE, COMPRESSION_LEVEL, COMPRESSION_TYPES
+from app.etags import encoded
+from app.logs import logger
+import app.metrics as metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class GzipCompressor:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(min(level, 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes, flush: bool = True) -> bytes:
+        """
+        :param flush: flush the output, so the client can decode everything sent so far
+        """
+        if flush:
+            return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+class BrotliCompressor:
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data: bytes, flush: bool = True) -> bytes:
+        if flush:
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+class ZstdCompressor:
+    def __init__(self, level: int):
+        self._compressor = zstandard.ZstdCompressor(level=min(level, 22)).compressobj()
+
+    def compress(self, data: bytes, flush: bool = True) -> bytes:
+        if flush:
+            return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+COMPRESSORS = {'gzip': GzipCompressor}
+if brotli is not None:
+    COMPRESSORS['br'] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS['zstd'] = ZstdCompressor
+
+for _encoding in COMPRESSION:
+    if _encoding not in COMPRESSORS:
+        logger.warning('Compression %s is not available, install its package or remove it from FAKEAPI_COMPRESSION',
+                       _encoding)
+ENCODINGS = [encoding for encoding in COMPRESSION if encoding in COMPRESSORS]
+
+# encoding -> [bytes before compression, bytes after compression]
+_bytes = {encoding: [0, 0] for encoding in ENCODINGS}
+
+def compression_metrics() -> list:
+    return [('fakeapi_compression_bytes_total', 'counter', 'Bytes of the compressed responses',
+             [(f'encoding="{encoding}",stage="{stage}"', counts[i])
+              for encoding, counts in _bytes.items() for i, stage in enumerate(('in', 'out'))])]
+
+
+metrics.add_collector(compression_metrics)
+
+def negotiate(accept_encoding: str) -> str | None:
+    """
+    :param accept_encoding: Accept-Encoding header, like 'gzip, deflate, br;q=0.5'
+    :return: The first encoding of FAKEAPI_COMPRESSION accepted by the client, None to send the response as is
+    """
+    accepted = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODINGS:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+def _negotiable(headers: MutableHeaders) -> bool:
+    """
+    True if the response depends on the Accept-Encoding of the request, whatever its size.
+    """
+    return 'content-encoding' not in headers and headers.get('content-type', '').startswith(COMPRESSION_TYPES)
+
+def _compressible(headers: MutableHeaders, body: bytes, more_body: bool) -> bool:
+    if not _negotiable(headers):
+        return False
+    if more_body:
+        # the size of a streamed response is only known if it has a Content-Length
+        return int(headers.get('content-length', COMPRESSION_MIN_SIZE)) >= COMPRESSION_MIN_SIZE
+    return len(body) >= COMPRESSION_MIN_SIZE
+
+class CompressionMiddleware:
+    """
+    ASGI middleware that compresses the responses. The encoding is added to the ETag of a compressed response.
+        app.add_middleware(CompressionMiddleware)
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not ENCODINGS:
+            await self.app(scope, receive, send)
+            return
+        encoding = None
+        for name, value in scope['headers']:
+            if name == b'accept-encoding':
+                encoding = negotiate(value.decode('latin-1'))
+                break
+        if encoding is None:
+            async def send_vary(message):
+                if message['type'] == 'http.response.start':
+                    headers = MutableHeaders(scope=message)
+                    if _negotiable(headers):
+                        headers.add_vary_header('Accept-Encoding')
+                await send(message)
+
+            await self.app(scope, receive, send_vary)
+            return
+
+        start = None
+        # None until the first chunk of the body, False if the response is sent as is
+        compressor = None
+        counts = _bytes[encoding]
+
+        async def send_compressed(message):
+            nonlocal start, compressor
+            if message['type'] == 'http.response.start':
+                # held until the first chunk of the body tells if the response is compressed
+                start = message
+                return
+            if message['type'] != 'http.response.body' or compressor is False:
+                await send(message)
+                return
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if compressor is None:
+                headers = MutableHeaders(raw=start['headers'])
+                if not _compressible(headers, body, more_body):
+                    compressor = False
+                    if _negotiable(headers):
+                        headers.add_vary_header('Accept-Encoding')
+                    await send(start)
+                    await send(message)
+                    return
+                compressor = COMPRESSORS[encoding](COMPRESSION_LEVEL)
+                headers['Content-Encoding'] = encoding
+                headers.add_vary_header('Accept-Encoding')
+                del headers['Content-Length']
+                tag = headers.get('etag')
+                if tag is not None:
+                    headers['ETag'] = encoded(tag, encoding)
+            if more_body:
+                data = compressor.compress(body)
+            else:
+                data = compressor.compress(body, flush=False) + compressor.finish()
+            counts[0] += len(body)
+            counts[1] += len(data)
+            if start is not None:
+                if not more_body:
+                    MutableHeaders(raw=start['headers'])['Content-Length'] = str(len(data))
+                await send(start)
+                start = None
+            await send({'type': 'http.response.body', 'body': data, 'more_body': more_body})
+
+        await self.app(scope, receive, send_compressed)
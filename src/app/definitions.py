@@ -1,6 +1,6 @@
 # app/definitions.py
 from enum import Enum
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from os import getenv
 
 # *** Environment Variables
@@ -9,6 +9,33 @@ HOSTNAME = getenv('FAKEAPI_INTF', '0.0.0.0')
 # The TCP port for Uvicorn
 PORT = int(getenv('FAKEAPI_PORT', 8000))
 
+"""
+Uvicorn server
+    FAKEAPI_WORKERS: number of worker processes, each one has its own event loop and Redis pool
+    FAKEAPI_LOOP: event loop implementation: auto, asyncio or uvloop (auto uses uvloop if it's installed)
+    FAKEAPI_HTTP: HTTP parser implementation: auto, h11 or httptools (auto uses httptools if it's installed)
+    FAKEAPI_BACKLOG: maximum number of connections waiting to be accepted
+    FAKEAPI_KEEPALIVE: time, in seconds, an idle keep-alive connection is kept open
+    FAKEAPI_LIMIT_CONCURRENCY: maximum number of concurrent connections or tasks per worker before returning 503,
+                               0 for no limit
+"""
+WORKERS = int(getenv('FAKEAPI_WORKERS', 1))
+LOOP = getenv('FAKEAPI_LOOP', 'auto')
+HTTP = getenv('FAKEAPI_HTTP', 'auto')
+BACKLOG = int(getenv('FAKEAPI_BACKLOG', 2048))
+KEEPALIVE = int(getenv('FAKEAPI_KEEPALIVE', 5))
+LIMIT_CONCURRENCY = int(getenv('FAKEAPI_LIMIT_CONCURRENCY', 0)) or None
+
+"""
+Logging, see app/logs.py
+    FAKEAPI_LOG_LEVEL: DEBUG, INFO, WARNING, ERROR or CRITICAL
+    FAKEAPI_LOG_FORMAT: 'json' for one JSON object per line, 'text' for the plain messages
+    FAKEAPI_LOG_RATE: maximum number of records per second from the same line of code, 0 for no limit
+"""
+LOG_LEVEL = getenv('FAKEAPI_LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = getenv('FAKEAPI_LOG_FORMAT', 'json')
+LOG_RATE = float(getenv('FAKEAPI_LOG_RATE', 10))
+
 """
 Redis database
 If Redis is run as a container, the hostname should be the same as the '--name' parameter
@@ -16,6 +43,122 @@ If Redis is run as a container, the hostname should be the same as the '--name'
 REDIS_HOSTNAME = getenv('REDIS_HOSTNAME', 'localhost')
 REDIS_PORT = getenv('REDIS_PORT', 6379)
 
+"""
+Redis nodes the items are sharded on, see app/redis_db.py
+    REDIS_NODES: comma separated list of 'host:port', like 'redis1.lab:6379,redis2.lab:6379'. Defaults to the single
+                 node REDIS_HOSTNAME:REDIS_PORT. The first node also holds everything that isn't an item: the visit
+                 counters and the cache invalidation channel. Don't change the list once items are stored, there's
+                 no rebalancing of the items that would move to another node.
+"""
+REDIS_NODES = [node.strip() for node in getenv('REDIS_NODES', f'{REDIS_HOSTNAME}:{REDIS_PORT}').split(',')
+               if node.strip()]
+
+"""
+Redis connection pool. One pool per node is shared by all the routers of a worker, it's opened and closed in the app
+lifespan.
+    REDIS_MAX_CONNECTIONS: maximum number of connections in the pool of each node
+    REDIS_HEALTH_CHECK_INTERVAL: idle time, in seconds, after which a connection is checked with a PING before use
+    REDIS_SOCKET_TIMEOUT/REDIS_SOCKET_CONNECT_TIMEOUT: timeouts, in seconds, for a command and for a new connection
+"""
+REDIS_MAX_CONNECTIONS = int(getenv('REDIS_MAX_CONNECTIONS', 100))
+REDIS_HEALTH_CHECK_INTERVAL = int(getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+REDIS_SOCKET_TIMEOUT = float(getenv('REDIS_SOCKET_TIMEOUT', 5))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(getenv('REDIS_SOCKET_CONNECT_TIMEOUT', 5))
+
+"""
+Circuit breaker of Redis, see app/redis_db.py
+    REDIS_BREAKER_FAILURES: consecutive connection errors or timeouts that open the breaker, the requests then fail
+                            with a 503 without waiting for the timeouts
+    REDIS_BREAKER_PROBE_INTERVAL: time, in seconds, between two PING while the breaker is open
+"""
+REDIS_BREAKER_FAILURES = int(getenv('REDIS_BREAKER_FAILURES', 5))
+REDIS_BREAKER_PROBE_INTERVAL = float(getenv('REDIS_BREAKER_PROBE_INTERVAL', 1))
+
+"""
+Read replicas, see app/replicas.py. The writes always go to the primary, the reads of the GET routes go to a replica
+that is fresh enough.
+    REDIS_REPLICAS: static replicas, a comma separated list of 'host:port' per node of REDIS_NODES, the lists of the
+                    nodes separated by ';', like 'replica1a.lab:6379,replica1b.lab:6379;replica2a.lab:6379'
+    REDIS_SENTINELS: comma separated list of 'host:port' of Redis Sentinels. When set, the primary and the replicas
+                     of each node are discovered by the Sentinels, REDIS_NODES and REDIS_REPLICAS are ignored
+    REDIS_SENTINEL_SERVICES: comma separated names of the primaries monitored by the Sentinels, one per node
+    REDIS_READ_MAX_LAG: a replica is read only if it has all the writes the primary had this number of seconds
+                        ago. It includes REDIS_REPLICA_CHECK_INTERVAL, keep it larger.
+    REDIS_REPLICA_CHECK_INTERVAL: time, in seconds, between two measures of the lag of the replicas
+    REDIS_READ_YOUR_WRITES: time, in seconds, a client reads from the primaries after one of its writes, 0 to
+                            disable. The client is recognized by a cookie.
+"""
+REDIS_REPLICAS = [[replica.strip() for replica in group.split(',') if replica.strip()]
+                  for group in getenv('REDIS_REPLICAS', '').split(';')]
+REDIS_SENTINELS = [sentinel.strip() for sentinel in getenv('REDIS_SENTINELS', '').split(',') if sentinel.strip()]
+REDIS_SENTINEL_SERVICES = [service.strip() for service in getenv('REDIS_SENTINEL_SERVICES', 'mymaster').split(',')
+                           if service.strip()]
+REDIS_READ_MAX_LAG = float(getenv('REDIS_READ_MAX_LAG', 1))
+REDIS_REPLICA_CHECK_INTERVAL = float(getenv('REDIS_REPLICA_CHECK_INTERVAL', 0.25))
+REDIS_READ_YOUR_WRITES = float(getenv('REDIS_READ_YOUR_WRITES', 5))
+
+"""
+In-process item cache. It's disabled when the size is 0.
+    FAKEAPI_CACHE_SIZE: maximum number of items kept in the cache of a worker (least recently used are evicted)
+    FAKEAPI_CACHE_TTL: time, in seconds, an item is kept in the cache. It's the upper bound on how stale a read can
+                       be if an invalidation message from another replica is lost
+"""
+CACHE_SIZE = int(getenv('FAKEAPI_CACHE_SIZE', 0))
+CACHE_TTL = float(getenv('FAKEAPI_CACHE_TTL', 5))
+
+"""
+Compression of the responses, see app/compression.py
+    FAKEAPI_COMPRESSION: encodings the server can use, by order of preference. 'br' needs the package 'brotli' and
+                         'zstd' the package 'zstandard', they're skipped if it isn't installed. Empty to disable.
+    FAKEAPI_COMPRESSION_MIN_SIZE: responses smaller than this number of bytes are sent as is
+    FAKEAPI_COMPRESSION_LEVEL: compression level, capped to the maximum of each encoding (gzip 9, br 11, zstd 22)
+    FAKEAPI_COMPRESSION_TYPES: comma separated prefixes of the content types that are compressed
+"""
+COMPRESSION = [encoding.strip() for encoding in getenv('FAKEAPI_COMPRESSION', 'zstd,br,gzip').split(',')
+               if encoding.strip()]
+COMPRESSION_MIN_SIZE = int(getenv('FAKEAPI_COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(getenv('FAKEAPI_COMPRESSION_LEVEL', 5))
+COMPRESSION_TYPES = tuple(getenv('FAKEAPI_COMPRESSION_TYPES',
+                                 'application/json,application/x-ndjson,text/').split(','))
+
+"""
+Storage of the items in Redis
+    FAKEAPI_ITEM_ENCODING: 'hash' stores each item in its own hash 'item:<id>'. 'bucket' packs the items in hashes
+                           'items:<id // FAKEAPI_ITEM_BUCKET_SIZE>', one field per item whose value is
+                           'v<version>|price|quantity|category|description'. The buckets stay in the compact listpack encoding
+                           of Redis if they have at most 'hash-max-listpack-entries' (128) fields of at most
+                           'hash-max-listpack-value' (64) bytes, raise the latter for long descriptions.
+                           Use 'python3 -m app.migrate' to move the existing 'item:<id>' hashes to the buckets.
+    FAKEAPI_ITEM_BUCKET_SIZE: number of consecutive IDs per bucket, don't change it once items are stored
+"""
+ITEM_ENCODING = getenv('FAKEAPI_ITEM_ENCODING', 'hash')
+ITEM_BUCKET_SIZE = int(getenv('FAKEAPI_ITEM_BUCKET_SIZE', 100))
+
+# Interval, in seconds, between two flushes of the visit counter of a worker to its field in the hash 'visited'
+HITS_FLUSH_INTERVAL = float(getenv('FAKEAPI_HITS_FLUSH_INTERVAL', 1))
+
+# Maximum number of items in a request to a batch endpoint, each batch is sent to Redis in a single pipeline
+BATCH_MAX = int(getenv('FAKEAPI_BATCH_MAX', 10000))
+
+# Default and maximum number of keys examined by each SCAN of /api/redis/keys
+SCAN_COUNT = int(getenv('FAKEAPI_SCAN_COUNT', 100))
+SCAN_COUNT_MAX = int(getenv('FAKEAPI_SCAN_COUNT_MAX', 1000))
+
+# Default and maximum number of items in a page of /api/items
+PAGE_SIZE = int(getenv('FAKEAPI_PAGE_SIZE', 100))
+PAGE_SIZE_MAX = int(getenv('FAKEAPI_PAGE_SIZE_MAX', 1000))
+
+"""
+Idempotency keys of the write routes, see app/idempotency.py
+    FAKEAPI_IDEMPOTENCY_TTL: time, in seconds, the response of a request with an Idempotency-Key is kept for replay
+    FAKEAPI_IDEMPOTENCY_LOCK_TTL: time, in seconds, after which a key whose request never finished can be used again
+    FAKEAPI_IDEMPOTENCY_WAIT: time, in seconds, a duplicate waits for the response of the request in progress before
+                              it gets a 409 Conflict
+"""
+IDEMPOTENCY_TTL = int(getenv('FAKEAPI_IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_LOCK_TTL = int(getenv('FAKEAPI_IDEMPOTENCY_LOCK_TTL', 30))
+IDEMPOTENCY_WAIT = float(getenv('FAKEAPI_IDEMPOTENCY_WAIT', 10))
+
 # Returns empty string if the key doesn't exist, so HTTP instead of HTTPS
 SERVER_CRT = getenv("FAKEAPI_SERVER_CRT", "")
 # logging.info(f'Server Certificate={SERVER_CRT}')
@@ -84,6 +227,10 @@ class Item(BaseModel):
     quantity: int
     category: Category
 
+    class Config:
+        # .dict() returns the value of the category, ready to be stored in Redis or serialized
+        use_enum_values = True
+
 # The URLs for the 'patchItem' function
 class PatchURL(str, Enum):
     price = "price"
@@ -93,6 +240,10 @@ class PatchURL(str, Enum):
 class ItemID(BaseModel):
     item_id: int
 
+# The IDs for the batch GET and DELETE
+class ItemIDs(BaseModel):
+    item_ids: list[int] = Field(..., min_items=1, max_items=BATCH_MAX)
+
 class IDPrice(BaseModel):
     item_id: int
     price: float
@@ -1,50 +1,103 @@
 # app/delete.py
 # https://fastapi.tiangolo.com/it/tutorial/bigger-applications/
-from fastapi import status, HTTPException, APIRouter
-from app.redis_db import redis
-from app.definitions import ItemID, REDIS_HOSTNAME, REDIS_PORT
+from fastapi import status, Header, HTTPException, APIRouter, Depends
+import app.storage as storage
+import app.etags as etags
+from app.cache import invalidate, invalidate_many
+from app.definitions import ItemID, ItemIDs, REDIS_HOSTNAME, REDIS_PORT
 from redis import exceptions
 from app.logs import logger
+from jwtauth.auth import require_token
 
 router = APIRouter()
 
-@router.delete('/api/delete/id/', status_code=status.HTTP_200_OK, tags=["delete"])
-async def deleteItem(item_id: ItemID) -> dict:
+@router.delete('/api/delete/id/', status_code=status.HTTP_200_OK, tags=["delete"],
+               dependencies=[Depends(require_token)])
+async def deleteItem(item_id: ItemID, if_match: str | None = Header(default=None)) -> dict:
     """
     Use DELETE method to delete a specified resource by ID. If it doesn't exist, return 404.
     The parameter is of type "ItemID" because we need to pass it in the content of the request.
     It's not a path or query parameter.
+    With an If-Match header, the item is deleted only if its ETag is one of the ETags of the header, otherwise
+    this API returns a 412 Precondition Failed.
 
     Example with curl:
         curl -X DELETE -H "Content-type: application/json" -H "Accept: application/json" \
         -d '{"item_id": 123}' -i -L "http://localhost:8000/api/delete/id/"
     :param item_id: ID of item to delete
+    :param if_match: ETag(s) the item must have, from a previous GET
     :return: Deleted item or error 404 if not found
     """
-    key = 'item:' + str(item_id.item_id)
     try:
-        result = redis.delete(key)
+        deleted = await storage.delete_item(item_id.item_id, etags.condition(if_match))
     except exceptions.ConnectionError:
         strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
-    if result == 1:
-        logger.info(f'delete successful for item {item_id.item_id}')
+    if deleted == -2:
+        raise etags.precondition_failed(item_id.item_id)
+    if deleted:
+        await invalidate(item_id.item_id)
+        logger.info('delete successful for item %s', item_id.item_id)
         return {"detail": "delete successful", "Item": item_id.item_id}
 
     strError = f"Item with ID {item_id.item_id} doesn't exists, delete failed"
-    logger.info(f'{strError}')
+    logger.info(strError)
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
         detail=strError,
         headers={"X-Fake-REST-API": strError},
     )
 
+@router.delete('/api/items/batch', status_code=status.HTTP_200_OK, tags=["delete"],
+               dependencies=[Depends(require_token)])
+async def deleteItems(item_ids: ItemIDs) -> dict:
+    """
+    Use DELETE method to delete many resources by ID with a single request. The items are removed in one pipeline,
+    with UNLINK so Redis reclaims the memory in the background. The status of every item is returned:
+        200 if the item was deleted
+        404 if the ID doesn't exist
+        500 if Redis failed to delete it, with the error in 'detail'
+
+    Example with curl:
+        curl -X DELETE -H "Content-type: application/json" -H "Accept: application/json" \
+        -d '{"item_ids": [100, 101, 102]}' -i -L "http://localhost:8000/api/items/batch"
+    :param item_ids: IDs of the items to delete, at most FAKEAPI_BATCH_MAX
+    :return: The number of items deleted, missing or failed and the status of each item
+    """
+    try:
+        results = await storage.delete_items(item_ids.item_ids)
+    except exceptions.ConnectionError:
+        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
+        logger.info(strError)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError},
+        )
+
+    status_items = []
+    deleted = []
+    failed = 0
+    for item_id, result in zip(item_ids.item_ids, results):
+        if isinstance(result, Exception):
+            status_items.append({"id": item_id, "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "detail": str(result)})
+            failed += 1
+        elif result:
+            status_items.append({"id": item_id, "status": status.HTTP_200_OK})
+            deleted.append(item_id)
+        else:
+            status_items.append({"id": item_id, "status": status.HTTP_404_NOT_FOUND})
+    await invalidate_many(deleted)
+    logger.info('DELETE batch: %d/%d item(s) deleted', len(deleted), len(results))
+    return {"deleted": len(deleted), "missing": len(results) - len(deleted) - failed, "failed": failed,
+            "items": status_items}
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -0,0 +1,91 @@
+# app/etags.py
+"""
+Conditional requests on the items, based on the version written with every item by the Lua scripts of app/scripts.py.
+
+    GET/HEAD /api/item/{item_id}   return ETag and Last-Modified, 304 Not Modified to If-None-Match or If-Modified-Since
+    PUT/PATCH/DELETE               accept If-Match, 412 Precondition Failed if the item changed since the client read it
+
+The ETag is strong, it's the version between double quotes:
+    curl -i "http://localhost:8000/api/item/100"                                  ETag: "1697650000123456"
+    curl -i -H 'If-None-Match: "1697650000123456"' "http://localhost:8000/api/item/100"   HTTP/1.1 304 Not Modified
+A compressed response has the encoding as suffix, like "1697650000123456-gzip", added by app/compression.py with
+encoded(). The suffix is ignored when an ETag is sent back, the versions are compared, and a 304 has the ETag the
+client sent, the one of the representation it has.
+"""
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import HTTPException, status
+from app.logs import logger
+
+def etag(version: int) -> str:
+    return f'"{version}"'
+
+def headers(version: int) -> dict:
+    """
+    The validators of an item. The version is the time of the last write in microseconds, it's also the
+    Last-Modified date. An item written before the versions existed has no Last-Modified.
+    """
+    if not version:
+        return {"ETag": etag(version)}
+    return {"ETag": etag(version), "Last-Modified": formatdate(version // 1_000_000, usegmt=True)}
+
+def encoded(tag: str, encoding: str) -> str:
+    """
+    :param tag: ETag of the response
+    :param encoding: content-coding of the compressed response, like 'gzip'
+    :return: The ETag of the compressed response
+    """
+    return f'{tag[:-1]}-{encoding}"' if tag.endswith('"') else tag
+
+def _decoded(tag: str) -> str:
+    """
+    :return: The ETag without the suffix of the encoding
+    """
+    opaque, dash, _ = tag.rpartition('-')
+    return opaque + '"' if dash and tag.endswith('"') else tag
+
+def _tags(header: str) -> list[str]:
+    return [tag.strip() for tag in header.split(',')]
+
+def not_modified(version: int, if_none_match: str | None, if_modified_since: str | None) -> str | None:
+    """
+    Checks if the copy of the client is current and a 304 can be returned. If-None-Match uses the weak comparison,
+    like RFC 9110 asks, and If-Modified-Since is ignored when If-None-Match is present.
+    :return: The ETag of the 304, the matching ETag of If-None-Match with its encoding, or None to return the item
+    """
+    if if_none_match is not None:
+        for tag in _tags(if_none_match):
+            tag = tag.removeprefix('W/')
+            if tag == '*':
+                return etag(version)
+            if _decoded(tag) == etag(version):
+                return tag
+        return None
+    if if_modified_since is not None and version:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return None
+        return etag(version) if version // 1_000_000 <= since else None
+    return None
+
+def condition(if_match: str | None) -> str:
+    """
+    Converts an If-Match header to the condition checked by the Lua scripts: an empty string without header, '*',
+    or the versions of the strong ETags between spaces. A weak or malformed ETag matches no version.
+    """
+    if if_match is None:
+        return ''
+    if if_match.strip() == '*':
+        return '*'
+    tags = [_decoded(tag) for tag in _tags(if_match)]
+    versions = [tag[1:-1] for tag in tags if len(tag) > 2 and tag[0] == tag[-1] == '"' and tag[1:-1].isdigit()]
+    return f' {" ".join(versions)} '
+
+def precondition_failed(item_id: int) -> HTTPException:
+    strError = f"Item with ID {item_id} doesn't match If-Match, it was modified"
+    logger.info(strError)
+    return HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail=strError,
+        headers={"X-Fake-REST-API": strError},
+    )
@@ -14,23 +14,73 @@ Type of parameter(s) passed with the API:
     4. Content body parameter(s)
 """
 
-from fastapi import APIRouter, status, HTTPException
-from fastapi.responses import RedirectResponse
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from fastapi import APIRouter, Header, Query, Response, status, HTTPException
+from fastapi.responses import RedirectResponse, StreamingResponse
 from redis import exceptions
-from app.redis_db import redis
-from app.definitions import IDPrice, REDIS_HOSTNAME, REDIS_PORT
+from app.cache import cache
+from app.replicas import primary_reads, replicated
+from app.singleflight import flights
+import app.storage as storage
+import app.etags as etags
+from app.definitions import Category, IDPrice, ItemIDs, REDIS_HOSTNAME, REDIS_PORT, PAGE_SIZE, PAGE_SIZE_MAX, \
+    SCAN_COUNT, SCAN_COUNT_MAX
 from app.logs import logger
+from app.responses import FastJSONResponse, dumps
 
 router = APIRouter()
 
-def get_id_price(item_id, price) -> dict:
-    # Hash GETALL
-    key = 'item:' + str(item_id)
+def cacheable(item_id: int) -> bool:
+    """
+    An item read from a replica can be older than the last write, only the items read from a primary are cached.
+    """
+    return primary_reads() or not replicated(storage.shard_of(item_id))
+
+async def fetch_item(item_id: int) -> dict:
+    token = cache.token()
+    result = await storage.read_item(item_id)
+    if result and cacheable(item_id):
+        cache.put(item_id, result, token)
+    return result
+
+async def read_item(item_id: int) -> dict:
+    """
+    Reads an item from the cache, if enabled, or from Redis. The concurrent reads of the same item share a single
+    read from Redis, see app/singleflight.py. The reads of a client that wrote recently skip the cache, another
+    client may have cached the item before the write reached it.
+    :param item_id: ID of the item
+    :return: The item or an empty dict if it doesn't exist
+    """
+    result = cache.get(item_id) if cache.enabled and not primary_reads() else None
+    if result is None:
+        # a client that reads from the primaries doesn't wait for a read from a replica
+        result = await flights.do((item_id, primary_reads()), lambda: fetch_item(item_id))
+    return result
+
+async def read_items(item_ids: list[int]) -> list[dict]:
+    """
+    Reads many items, the ones not in the cache are read from Redis with a single pipeline.
+    :param item_ids: IDs of the items
+    :return: Each item, in order, an empty dict if it doesn't exist
+    """
+    use_cache = cache.enabled and not primary_reads()
+    results = [cache.get(item_id) if use_cache else None for item_id in item_ids]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        token = cache.token()
+        fetched = await storage.read_items([item_ids[i] for i in missing])
+        for i, result in zip(missing, fetched):
+            results[i] = result
+            if result and cacheable(item_ids[i]):
+                cache.put(item_ids[i], result, token)
+    return results
+
+async def get_id_price(item_id, price) -> FastJSONResponse:
     try:
-        result = redis.hgetall(key)
+        result = await read_item(item_id)
     except exceptions.ConnectionError:
         strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
@@ -39,32 +89,31 @@ def get_id_price(item_id, price) -> dict:
 
     if not result:
         strError = f"Item with ID {item_id} was not found"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
-    if int(result.get('id')) == item_id and float(result.get('price')) == price:
-        return {"Item": result}
+    if result['id'] == item_id and result['price'] == price:
+        return FastJSONResponse({"Item": result})
     else:
         strError = f"Item with ID {item_id} and price {price:.2f}$ was not found"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
-def get_id(item_id: int) -> dict:
-    # Hash GETALL
-    key = 'item:' + str(item_id)
+async def get_id(item_id: int, if_none_match: str | None = None,
+                 if_modified_since: str | None = None) -> FastJSONResponse | Response:
     try:
-        result = redis.hgetall(key)
+        result = await read_item(item_id)
     except exceptions.ConnectionError:
         strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
@@ -73,14 +122,18 @@ def get_id(item_id: int) -> dict:
 
     if not result:
         strError = f"Item with ID {item_id} was not found"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
-    return {"Item": result}
+    headers = etags.headers(result['version'])
+    tag = etags.not_modified(result['version'], if_none_match, if_modified_since)
+    if tag is not None:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={**headers, "ETag": tag})
+    return FastJSONResponse({"Item": result}, headers=headers)
 
 @router.get("/", response_class=RedirectResponse, include_in_schema=False)
 async def docs():
@@ -102,21 +155,27 @@ async def docs():
 #     return
 
 @router.get("/api/item/{item_id}", tags=["path_parameter"])
-def path_parameter_id(item_id: int):
+async def path_parameter_id(item_id: int, if_none_match: str | None = Header(default=None),
+                            if_modified_since: str | None = Header(default=None)):
     """
     The value of the path parameter 'item_id' will be passed to the function path_parameter()
     as the argument 'item_id'. The name of the path parameter MUST be identical to the function argument.
 
+    The response has the ETag and Last-Modified of the item. Send them back in If-None-Match or If-Modified-Since
+    and the response is a 304 Not Modified without body while the item doesn't change, see app/etags.py.
+
     Example with curl:
         curl -H "Content-type: application/json" \
         -H "Accept: application/json" -i -L "http://127.0.0.1:8000/api/item/{item_id}"
     :param item_id: The ID of the resource we want to retreive
+    :param if_none_match: ETag(s) of the copy of the client
+    :param if_modified_since: Last-Modified of the copy of the client
     :return:
     """
-    return get_id(item_id)
+    return await get_id(item_id, if_none_match, if_modified_since)
 
 @router.get("/api/item/price/{item_id}/{price}", tags=["path_parameter"])
-def path_parameter_id_price(item_id: int, price: float):
+async def path_parameter_id_price(item_id: int, price: float):
     """
     Path parameters help scope the API call down to a single resource, which means you don’t have to build a body for
     something as simple as a resource finder.
@@ -133,10 +192,10 @@ def path_parameter_id_price(item_id: int, price: float):
     :param price: The price of the resource we want to retreive
     :return:
     """
-    return get_id_price(item_id, price)
+    return await get_id_price(item_id, price)
 
 @router.get("/api/item/0/price", tags=["query_parameter"])
-def query_parameter(item_id: int, price: float):
+async def query_parameter(item_id: int, price: float):
     """
     Query parameters are optional. In FastAPI, function parameters that aren’t declared as part of the path parameters
     are automatically interpreted as query parameters.
@@ -165,7 +224,7 @@ def query_parameter(item_id: int, price: float):
     :param item_id:
     :return:
     """
-    return get_id_price(item_id, price)
+    return await get_id_price(item_id, price)
 
 @router.get("/api/item/1/price", status_code=status.HTTP_200_OK, tags=["content_parameter"])
 async def content_parameter(itemPrice: IDPrice):
@@ -179,7 +238,149 @@ async def content_parameter(itemPrice: IDPrice):
     :param itemPrice: Item ID and price of item we want to retreive
     :return: The item or error 404 if not found
     """
-    return get_id_price(itemPrice.item_id, itemPrice.price)
+    return await get_id_price(itemPrice.item_id, itemPrice.price)
+
+@router.get("/api/items/batch", status_code=status.HTTP_200_OK, tags=["content_parameter"])
+async def content_parameter_ids(itemIDs: ItemIDs) -> FastJSONResponse:
+    """
+    Retrieves many items with a single request. The items are read from Redis in one pipeline.
+    The status of every item is returned:
+        200 and the item if it exists
+        404 if the ID doesn't exist
+
+    Example with curl:
+        curl -X GET -H "Content-type: application/json" -H "Accept: application/json" \
+        -d '{"item_ids": [100, 101, 102]}' -i -L "http://localhost:8000/api/items/batch"
+    :param itemIDs: IDs of the items we want to retreive, at most FAKEAPI_BATCH_MAX
+    :return: The number of items found and the status of each item
+    """
+    try:
+        results = await read_items(itemIDs.item_ids)
+    except exceptions.ConnectionError:
+        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
+        logger.info(strError)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError},
+        )
+
+    status_items = []
+    found = 0
+    for item_id, result in zip(itemIDs.item_ids, results):
+        if result:
+            status_items.append({"id": item_id, "status": status.HTTP_200_OK, "Item": result})
+            found += 1
+        else:
+            status_items.append({"id": item_id, "status": status.HTTP_404_NOT_FOUND})
+    return FastJSONResponse({"found": found, "missing": len(results) - found, "items": status_items})
+
+def encode_page_cursor(price: str, item_id: int) -> str:
+    """
+    The cursor of /api/items is the price and the ID of the last item of the page, opaque to the client.
+    """
+    return urlsafe_b64encode(f'{price} {item_id}'.encode()).decode()
+
+def decode_page_cursor(cursor: str | None) -> tuple[str, str] | None:
+    if not cursor:
+        return None
+    try:
+        price, item_id = urlsafe_b64decode(cursor.encode()).decode().split(' ')
+        float(price)
+        int(item_id)
+    except ValueError:
+        strError = f"Invalid cursor: {cursor}"
+        logger.info(strError)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError},
+        )
+    return price, item_id
+
+@router.get("/api/items", status_code=status.HTTP_200_OK, tags=["query_parameter"])
+async def query_items(category: Category | None = None, min_price: float | None = None,
+                      max_price: float | None = None, cursor: str | None = None,
+                      count: int = Query(default=PAGE_SIZE, ge=1, le=PAGE_SIZE_MAX)) -> FastJSONResponse:
+    """
+    Returns the items of a category and/or a price range, ordered by price, one page at a time. The items are found
+    with the indexes of app/storage.py, a page costs O(log N + count) whatever the number of items and the page.
+    Start without a cursor and send back the 'cursor' of the response until it's null.
+
+    Example with curl:
+        curl -H "Content-type: application/json" -H "Accept: application/json" -i -L \
+        "http://localhost:8000/api/items?category=tools&min_price=5&max_price=20&count=50"
+    :param category: only the items of this category
+    :param min_price: lowest price, inclusive
+    :param max_price: highest price, inclusive
+    :param cursor: the cursor returned by the previous page, nothing for the first page
+    :param count: maximum number of items in the page
+    :return: A page of items and the cursor for the next page
+    """
+    try:
+        entries = await storage.query_index(category and category.value, min_price, max_price, count,
+                                            decode_page_cursor(cursor))
+        results = await read_items([item_id for item_id, _ in entries])
+    except exceptions.ConnectionError:
+        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
+        logger.info(strError)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError},
+        )
+
+    # an item deleted between the two reads is skipped
+    items = [result for result in results if result]
+    # a short page is the last one
+    next_cursor = None
+    if len(entries) == count:
+        last_id, last_price = entries[-1]
+        next_cursor = encode_page_cursor(last_price, last_id)
+    return FastJSONResponse({"items": items, "cursor": next_cursor})
+
+async def stream_items(first: list, pages):
+    """
+    Yields the items of the first page, then all the others, one JSON object per line. The next page is read from
+    Redis only when the previous one was sent, a slow client slows down the export instead of filling the memory.
+    """
+    items = first
+    while True:
+        if items:
+            yield b''.join(dumps(item) + b'\n' for item in items)
+        try:
+            items = await anext(pages)
+        except StopAsyncIteration:
+            return
+        except exceptions.RedisError as e:
+            # the status is already sent, the client sees a truncated body
+            logger.error('Export of the items aborted: %s', e)
+            return
+
+@router.get("/api/items/export", tags=["get"])
+async def export_items(count: int = Query(default=SCAN_COUNT, ge=1, le=SCAN_COUNT_MAX)) -> StreamingResponse:
+    """
+    Streams every item as newline-delimited JSON, one item per line, in no particular order. The keys are read with
+    SCAN and the items of each SCAN with a single pipeline, the memory used doesn't depend on the number of items.
+
+    Example with curl:
+        curl -H "Accept: application/x-ndjson" -N -L "http://localhost:8000/api/items/export?count=1000"
+    :param count: number of keys examined by each SCAN
+    :return: The items, one per line
+    """
+    pages = storage.scan_items(count)
+    try:
+        # the first SCAN is done before the response is started, so a connection error is still a 500
+        first = await anext(pages)
+    except exceptions.ConnectionError:
+        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
+        logger.info(strError)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError},
+        )
+    return StreamingResponse(stream_items(first, pages), media_type='application/x-ndjson')
 
 if __name__ == "__main__":
     import uvicorn
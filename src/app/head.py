@@ -1,5 +1,6 @@
 # app/head.py
-from fastapi import APIRouter, Request
+from fastapi import APIRouter, Header, Request
+from app.get import get_id
 
 router = APIRouter()
 
@@ -16,6 +17,21 @@ async def head(request: Request) -> dict:
     """
     return {"message": "Root of Fake REST API", "method": request.method}
 
+@router.head("/api/item/{item_id}", tags=["head"])
+async def head_item(item_id: int, if_none_match: str | None = Header(default=None),
+                    if_modified_since: str | None = Header(default=None)):
+    """
+    Same response as GET /api/item/{item_id} without the body. Use it to check if an item exists or if it changed,
+    with its ETag and Last-Modified, without downloading it.
+
+    curl -I -H 'If-None-Match: "1697650000123456"' -L "http://localhost:8000/api/item/100"
+    :param item_id: The ID of the resource
+    :param if_none_match: ETag(s) of the copy of the client
+    :param if_modified_since: Last-Modified of the copy of the client
+    :return: The headers of the item, 404 if it doesn't exist or 304 if it didn't change
+    """
+    return await get_id(item_id, if_none_match, if_modified_since)
+
 if __name__ == "__main__":
     import uvicorn
     import logging
@@ -0,0 +1,192 @@
+# app/idempotency.py
+"""
+Idempotency keys for the write routes. A client that retries a POST, PUT or PATCH with the same 'Idempotency-Key'
+header gets the response of the first attempt, the route isn't run twice:
+
+    curl -X POST -H "Content-type: application/json" -H "Idempotency-Key: 8e03978e-40d5-43e8-bc93-6894a57f9324" \
+    -d '{"id":100,"description":"Hammer","price": 9.99,"quantity": 20,"category": "tools"}' \
+    -i -L "http://localhost:8000/api/item"
+
+    - The first request with a key runs the route. Its response is kept in Redis, under 'idempotency:<hash>', for
+      FAKEAPI_IDEMPOTENCY_TTL seconds. The hash covers the key and the Authorization header, so two clients can't
+      read each other's responses.
+    - A request with the same key, method, path and body gets the response back with 'Idempotent-Replayed: true'.
+    - A request with the same key that arrives while the first one is running waits for its response, up to
+      FAKEAPI_IDEMPOTENCY_WAIT seconds, then gets a 409 Conflict.
+    - A request with the same key and another method, path or body gets a 422 Unprocessable Entity.
+    - A 5xx response isn't kept, the request can be retried with the same key. If the worker dies while the route
+      runs, the key can be used again after FAKEAPI_IDEMPOTENCY_LOCK_TTL seconds.
+"""
+import asyncio
+import json
+import time
+from base64 import b64encode, b64decode
+from hashlib import sha256
+from uuid import uuid4
+from fastapi import Response, status
+from redis import exceptions
+from app.redis_db import redis, CircuitOpenError
+from app.scripts import SAVE_RESPONSE, RELEASE_KEY, run
+from app.definitions import IDEMPOTENCY_TTL, IDEMPOTENCY_LOCK_TTL, IDEMPOTENCY_WAIT
+from app.logs import logger
+from app.responses import FastJSONResponse
+import app.metrics as metrics
+
+IDEMPOTENT_METHODS = ('POST', 'PUT', 'PATCH')
+KEY_PREFIX = 'idempotency:'
+KEY_MAX_LENGTH = 255
+
+# outcome -> number of requests with an Idempotency-Key
+_requests = {'executed': 0, 'replayed': 0, 'conflict': 0, 'mismatch': 0}
+
+def idempotency_metrics() -> list:
+    return [('fakeapi_idempotency_requests_total', 'counter', 'Requests with an Idempotency-Key by outcome',
+             [(f'outcome="{outcome}"', count) for outcome, count in _requests.items()])]
+
+
+metrics.add_collector(idempotency_metrics)
+
+def _error(status_code: int, strError: str) -> FastJSONResponse:
+    logger.info(strError)
+    return FastJSONResponse({"detail": strError}, status_code=status_code, headers={"X-Fake-REST-API": strError})
+
+def _replay(record: dict) -> Response:
+    response = Response(content=b64decode(record['body']), status_code=record['status'])
+    # the headers of the first response, with its Content-Length
+    response.raw_headers = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in record['headers']]
+    response.raw_headers.append((b'idempotent-replayed', b'true'))
+    return response
+
+async def _read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+async def _claim(key: str, pending: str, fingerprint: str) -> dict | None:
+    """
+    Takes the key, or waits for the response of the request that holds it.
+    :return: None if this request holds the key and runs the route, otherwise the record of the key: the response,
+             a pending record if the wait timed out, or the record of another request
+    """
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    delay = 0.01
+    while True:
+        if await redis.set(key, pending, nx=True, ex=IDEMPOTENCY_LOCK_TTL):
+            return None
+        value = await redis.get(key)
+        if value is None:
+            # released since the SET, by a request that failed
+            continue
+        record = json.loads(value)
+        if record['fingerprint'] != fingerprint or 'status' in record or time.monotonic() >= deadline:
+            return record
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 0.2)
+
+class IdempotencyMiddleware:
+    """
+    ASGI middleware that runs the POST, PUT and PATCH with an Idempotency-Key header at most once per key.
+        app.add_middleware(IdempotencyMiddleware)
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['method'] not in IDEMPOTENT_METHODS:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope['headers'])
+        idempotency_key = headers.get(b'idempotency-key')
+        if idempotency_key is None:
+            await self.app(scope, receive, send)
+            return
+        if not 0 < len(idempotency_key.strip()) <= KEY_MAX_LENGTH:
+            response = _error(status.HTTP_400_BAD_REQUEST,
+                              f"Idempotency-Key must have between 1 and {KEY_MAX_LENGTH} characters")
+            await response(scope, receive, send)
+            return
+
+        body = await _read_body(receive)
+        fingerprint = sha256(b'\n'.join([scope['method'].encode(), scope['path'].encode(), scope['query_string'],
+                                         body])).hexdigest()
+        key = KEY_PREFIX + sha256(headers.get(b'authorization', b'') + b'\n' + idempotency_key.strip()).hexdigest()
+        pending = json.dumps({"fingerprint": fingerprint, "token": uuid4().hex})
+        try:
+            record = await _claim(key, pending, fingerprint)
+        except exceptions.RedisError as e:
+            strError = f"Idempotency-Key not checked, Redis database {redis.node}: {e}"
+            response = _error(status.HTTP_503_SERVICE_UNAVAILABLE if isinstance(e, CircuitOpenError)
+                              else status.HTTP_500_INTERNAL_SERVER_ERROR, strError)
+            await response(scope, receive, send)
+            return
+
+        if record is not None:
+            if record['fingerprint'] != fingerprint:
+                _requests['mismatch'] += 1
+                response = _error(status.HTTP_422_UNPROCESSABLE_ENTITY, "Idempotency-Key was already used for "
+                                  "another request, with a different method, path or body")
+            elif 'status' not in record:
+                _requests['conflict'] += 1
+                response = _error(status.HTTP_409_CONFLICT, "A request with the same Idempotency-Key is in progress, "
+                                  "retry later")
+            else:
+                _requests['replayed'] += 1
+                logger.info('Idempotency-Key replayed: %s %s', scope['method'], scope['path'])
+                response = _replay(record)
+            await response(scope, receive, send)
+            return
+
+        _requests['executed'] += 1
+        await self._execute(scope, receive, send, body, key, pending, fingerprint)
+
+    async def _execute(self, scope, receive, send, body: bytes, key: str, pending: str, fingerprint: str) -> None:
+        sent = False
+        started = {}
+        chunks = []
+
+        async def receive_body():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+            return await receive()
+
+        async def keep_response(message):
+            if message['type'] == 'http.response.start':
+                started.update(message)
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, keep_response)
+        except BaseException:
+            await self._release(key, pending)
+            raise
+        if started.get('status', 500) >= 500:
+            await self._release(key, pending)
+            return
+        record = json.dumps({"fingerprint": fingerprint, "status": started['status'],
+                             "headers": [(name.decode('latin-1'), value.decode('latin-1'))
+                                         for name, value in started.get('headers', [])],
+                             "body": b64encode(b''.join(chunks)).decode()})
+        try:
+            if not await run(SAVE_RESPONSE, [key], [pending, record, IDEMPOTENCY_TTL]):
+                logger.warning('Idempotency-Key expired while %s %s was running, response not kept', scope['method'],
+                               scope['path'])
+        except exceptions.RedisError as e:
+            # the response is already sent, a retry runs the route again once the key expires
+            logger.warning('Response of the Idempotency-Key not kept: %s', e)
+
+    @staticmethod
+    async def _release(key: str, pending: str) -> None:
+        try:
+            await run(RELEASE_KEY, [key], [pending])
+        except exceptions.RedisError as e:
+            logger.warning('Idempotency-Key not released, it expires in %ss: %s', IDEMPOTENCY_LOCK_TTL, e)
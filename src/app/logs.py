@@ -1,23 +1,122 @@
+# app/logs.py
+"""
+Logging of the app. The handler of the root logger only puts the records in a queue, a thread formats and writes
+them, so a request never waits for stderr.
+
+    - The message is formatted by the thread: use logger.info('Item %s not found', item_id), not an f-string.
+    - Each call site (file and line) is limited to FAKEAPI_LOG_RATE records per second, the others are dropped
+      before they reach the queue. The next record of that call site tells how many were dropped. The access log
+      isn't limited, it has one record per request.
+    - The loggers of Uvicorn, its access log included, are configured with UVICORN_LOG_CONFIG: their records go
+      through the same queue.
+    - With FAKEAPI_LOG_FORMAT=json, each record is a JSON object on one line. The fields passed with
+      extra={...} are added to the object.
+"""
+import atexit
+import json
 import logging
 import platform
+import queue
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from app.definitions import LOG_LEVEL, LOG_FORMAT, LOG_RATE
+
+# The attributes of every LogRecord, the others come from extra={...}. Uvicorn adds a copy of some messages with
+# terminal colors, 'color_message'.
+_RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'suppressed', 'color_message'}
+
+class RateLimitFilter(logging.Filter):
+    """
+    Token bucket per call site. It runs in the thread that logs, it must stay cheap. There's no lock, a race between
+    two threads only makes the counts approximate.
+    """
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+        # (pathname, lineno) -> [tokens, last refill, suppressed]
+        self._sites = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0 or record.name == 'uvicorn.access':
+            return True
+        now = time.monotonic()
+        site = self._sites.get((record.pathname, record.lineno))
+        if site is None:
+            site = self._sites[(record.pathname, record.lineno)] = [self.rate, now, 0]
+        site[0] = min(self.rate, site[0] + (now - site[1]) * self.rate)
+        site[1] = now
+        if site[0] < 1:
+            site[2] += 1
+            return False
+        site[0] -= 1
+        if site[2]:
+            record.suppressed = site[2]
+            site[2] = 0
+        return True
+
+class LazyQueueHandler(QueueHandler):
+    """
+    Queues the record as is. QueueHandler.prepare() formats the message in the calling thread, it's left to the
+    listener.
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage(),
+                 "location": f'{record.module}:{record.lineno}'}
+        if getattr(record, 'suppressed', 0):
+            entry["suppressed"] = record.suppressed
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        message = super().format(record)
+        if getattr(record, 'suppressed', 0):
+            message += f' ({record.suppressed} similar message(s) suppressed)'
+        return message
+
+
+# log_config of uvicorn.run(): the loggers of Uvicorn have no handler of their own and propagate to the root logger
+UVICORN_LOG_CONFIG = {"version": 1, "disable_existing_loggers": False,
+                      "loggers": {name: {"handlers": [], "propagate": True}
+                                  for name in ('uvicorn', 'uvicorn.error', 'uvicorn.access')}}
+
+_handler = logging.StreamHandler()
+_handler.setFormatter(JSONFormatter() if LOG_FORMAT == 'json' else TextFormatter('%(levelname)s:     %(message)s'))
+_queue = queue.SimpleQueue()
+_queue_handler = LazyQueueHandler(_queue)
+_queue_handler.addFilter(RateLimitFilter(LOG_RATE))
+_listener = QueueListener(_queue, _handler, respect_handler_level=True)
 
 # logger config
 logger = logging.getLogger()
-logging.basicConfig(level=logging.INFO,
-                    format='%(levelname)s:     %(message)s',
-                    datefmt='%Y-%m-%d %H:%M:%S')
-logger.info(f'Python version: {platform.python_version()}')
-logger.info(f'Python implementation: {platform.python_implementation()}')
-logger.info(f'Platform: {platform.platform()}')
-logger.info(f'Hostname: {platform.node()}')
-logger.info(f'System/OS name,: {platform.system()}')
-logger.info(f'Release: {platform.release()}')
-logger.info(f'Release Version: {platform.version()}')
-logger.info(f'Uname: {platform.uname()}')
-logger.info(f'Processor: {platform.machine()}')
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(_queue_handler)
+_listener.start()
+# the records still in the queue are written when the process exits
+atexit.register(_listener.stop)
+
+logger.info('Python version: %s', platform.python_version())
+logger.info('Python implementation: %s', platform.python_implementation())
+logger.info('Platform: %s', platform.platform())
+logger.info('Hostname: %s', platform.node())
+logger.info('System/OS name,: %s', platform.system())
+logger.info('Release: %s', platform.release())
+logger.info('Release Version: %s', platform.version())
+logger.info('Uname: %s', platform.uname())
+logger.info('Processor: %s', platform.machine())
 try:
     OS_RELEASE = platform.freedesktop_os_release()
 except OSError:
     pass
 else:
-    logger.info(f'OS Release: {OS_RELEASE}')
+    logger.info('OS Release: %s', OS_RELEASE)
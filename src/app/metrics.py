@@ -0,0 +1,174 @@
+# app/metrics.py
+"""
+Metrics of the worker in the Prometheus text format, at /metrics.
+
+The request path only increments counters of plain Python objects, from the event loop. There's no lock because
+there's no other thread updating them. The counters are formatted when /metrics is scraped. Gauges that live in
+other modules (Redis pool, threadpool, ...) are read at scrape time by the collectors registered with
+add_collector().
+
+Each Uvicorn worker has its own metrics. The label 'pid' of 'fakeapi_worker_info' tells which worker answered.
+
+Example with curl:
+    curl -i -L "http://localhost:8000/metrics"
+"""
+import os
+import platform
+import time
+from bisect import bisect_left
+from anyio import to_thread
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+# Upper bounds, in seconds, of the latency histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+router = APIRouter()
+
+class Histogram:
+    """
+    Histogram of a set of labels. Only the bucket of an observation is incremented, the cumulative counts are
+    computed when it's formatted.
+    """
+    __slots__ = ('buckets', 'sum')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def lines(self, name: str, labels: str) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += self.buckets[-1]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {cumulative}')
+        return lines
+
+
+# (method, route, status) -> Histogram
+http_requests: dict[tuple[str, str, int], Histogram] = {}
+# Redis command -> Histogram
+redis_commands: dict[str, Histogram] = {}
+in_flight = 0
+_collectors = []
+# endpoint function -> route template
+_routes = {}
+
+def observe_request(method: str, route: str, status: int, seconds: float) -> None:
+    key = (method, route, status)
+    histogram = http_requests.get(key)
+    if histogram is None:
+        histogram = http_requests[key] = Histogram()
+    histogram.observe(seconds)
+
+def observe_redis(command: str, seconds: float) -> None:
+    histogram = redis_commands.get(command)
+    if histogram is None:
+        histogram = redis_commands[command] = Histogram()
+    histogram.observe(seconds)
+
+def add_collector(collector) -> None:
+    """
+    Registers a function called at scrape time. It returns a list of (name, type, help, [(labels, value), ...]).
+    """
+    _collectors.append(collector)
+
+def _route_of(scope) -> str:
+    """
+    The route template, like '/api/item/{item_id}', not the path, so the number of label values stays bounded.
+    """
+    endpoint = scope.get('endpoint')
+    if endpoint is None:
+        return 'unmatched'
+    route = _routes.get(endpoint)
+    if route is None:
+        route = next((r.path for r in scope['app'].routes if getattr(r, 'endpoint', None) is endpoint), 'unmatched')
+        _routes[endpoint] = route
+    return route
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that times every HTTP request, until the last byte of the response is sent.
+        app.add_middleware(MetricsMiddleware)
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        global in_flight
+        status = 500
+        start = time.perf_counter()
+
+        async def send_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        in_flight += 1
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            in_flight -= 1
+            observe_request(scope['method'], _route_of(scope), status, time.perf_counter() - start)
+
+def _format() -> str:
+    lines = [
+        '# HELP fakeapi_worker_info Worker that answered the scrape',
+        '# TYPE fakeapi_worker_info gauge',
+        f'fakeapi_worker_info{{hostname="{platform.node()}",pid="{os.getpid()}"}} 1',
+        '# HELP fakeapi_http_requests_in_flight HTTP requests being processed',
+        '# TYPE fakeapi_http_requests_in_flight gauge',
+        f'fakeapi_http_requests_in_flight {in_flight}',
+        '# HELP fakeapi_http_requests_total HTTP requests by method, route and status',
+        '# TYPE fakeapi_http_requests_total counter',
+    ]
+    # the dicts can't change while we iterate, we don't await
+    for (method, route, status), histogram in http_requests.items():
+        lines.append(f'fakeapi_http_requests_total{{method="{method}",route="{route}",status="{status}"}} '
+                     f'{sum(histogram.buckets)}')
+    lines += ['# HELP fakeapi_http_request_duration_seconds Latency of the HTTP requests',
+              '# TYPE fakeapi_http_request_duration_seconds histogram']
+    for (method, route, status), histogram in http_requests.items():
+        lines += histogram.lines('fakeapi_http_request_duration_seconds',
+                                 f'method="{method}",route="{route}",status="{status}"')
+    lines += ['# HELP fakeapi_redis_command_duration_seconds Latency of the Redis commands, a pipeline is PIPELINE',
+              '# TYPE fakeapi_redis_command_duration_seconds histogram']
+    for command, histogram in redis_commands.items():
+        lines += histogram.lines('fakeapi_redis_command_duration_seconds', f'command="{command}"')
+    for collector in _collectors:
+        for name, kind, description, samples in collector():
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            for labels, value in samples:
+                lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+def threadpool_metrics() -> list:
+    # the limiter of the threadpool used by the 'def' routes, it's per event loop
+    limiter = to_thread.current_default_thread_limiter()
+    statistics = limiter.statistics()
+    return [('fakeapi_threadpool_tokens', 'gauge', 'Tokens of the threadpool by state',
+             [('state="borrowed"', statistics.borrowed_tokens), ('state="total"', statistics.total_tokens)]),
+            ('fakeapi_threadpool_waiting', 'gauge', 'Tasks waiting for a token of the threadpool',
+             [('', statistics.tasks_waiting)])]
+
+
+add_collector(threadpool_metrics)
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    """
+    Metrics of the worker that answers the request, in the Prometheus text format.
+    """
+    return PlainTextResponse(_format(), media_type='text/plain; version=0.0.4')
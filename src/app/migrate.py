@@ -0,0 +1,101 @@
+# app/migrate.py
+"""
+Moves the items stored in their own hash 'item:<id>' to the hashes 'items:<bucket>' of the 'bucket' encoding.
+
+The migration is online: start the app with FAKEAPI_ITEM_ENCODING=bucket first, it finds the items in both layouts,
+then run the migration. Each item is moved atomically by a Lua script, it can't race with a write of the app.
+The command can be stopped and started again, it only moves the hashes that are still there.
+
+Run it from the 'src' directory, with the same environment variables as the app:
+    FAKEAPI_ITEM_ENCODING=bucket python3 -m app.migrate --count 1000
+
+With many nodes (REDIS_NODES), each node is migrated in turn. 'item:<id>' and 'items:<bucket>' are always
+on the same node, the items are sharded by bucket in both encodings.
+
+With --reindex, the command adds the items of both layouts to the indexes 'index:price' and 'index:category:<name>'
+instead, for the items written before the indexes existed. Adding an item that is already indexed changes nothing.
+    python3 -m app.migrate --reindex
+"""
+import argparse
+import asyncio
+import time
+from app.redis_db import Redis, shards, close_redis
+from app.scripts import MIGRATE_ITEM, run_pipeline
+from app.storage import BUCKETS, PRICE_INDEX, legacy_key, bucket_key, category_index, scan_shard
+from app.logs import logger
+
+async def migrate(count: int, dry_run: bool) -> int:
+    """
+    :param count: number of keys examined by each SCAN, the items found are migrated in one pipeline
+    :param dry_run: only count the items to migrate
+    :return: The number of items migrated
+    """
+    scanned = migrated = scans = 0
+    start = time.perf_counter()
+    for client in shards:
+        cursor = None
+        while cursor != 0:
+            cursor, keys = await client.scan(cursor or 0, match='item:*', count=count, _type='hash')
+            scans += 1
+            item_ids = [int(key[5:]) for key in keys if key[5:].isdigit()]
+            scanned += len(item_ids)
+            if item_ids and not dry_run:
+                calls = [([legacy_key(item_id), bucket_key(item_id)], [item_id]) for item_id in item_ids]
+                results = await run_pipeline(MIGRATE_ITEM, calls, client)
+                for item_id, result in zip(item_ids, results):
+                    if isinstance(result, Exception):
+                        logger.error('Item %s not migrated: %s', item_id, result)
+                    else:
+                        migrated += result
+            if scans % 100 == 0:
+                logger.info('%d item(s) found, %d migrated in %.1fs', scanned, migrated, time.perf_counter() - start)
+    logger.info('Migration done: %d item(s) found, %d migrated in %.1fs', scanned, migrated,
+                time.perf_counter() - start)
+    return migrated
+
+async def index_items(client: Redis, items: list[dict]) -> None:
+    # an item deleted since it was read is indexed again, a query skips it
+    async with client.pipeline(transaction=False) as pipe:
+        for item in items:
+            pipe.zadd(PRICE_INDEX, {item['id']: item['price']})
+            pipe.zadd(category_index(item['category']), {item['id']: item['price']})
+        await pipe.execute()
+
+async def reindex(count: int) -> int:
+    """
+    :param count: number of keys examined by each SCAN, the items found are indexed in one pipeline
+    :return: The number of items indexed
+    """
+    indexed = scans = 0
+    start = time.perf_counter()
+    for client in shards:
+        # each node indexes its own items
+        async for items in scan_shard(client, count):
+            scans += 1
+            if items:
+                await index_items(client, items)
+                indexed += len(items)
+            if scans % 100 == 0:
+                logger.info('%d item(s) indexed in %.1fs', indexed, time.perf_counter() - start)
+    logger.info('Indexing done: %d item(s) indexed in %.1fs', indexed, time.perf_counter() - start)
+    return indexed
+
+async def main(count: int, dry_run: bool, index: bool) -> None:
+    try:
+        if index:
+            await reindex(count)
+        else:
+            await migrate(count, dry_run)
+    finally:
+        await close_redis()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moves the 'item:<id>' hashes to the 'bucket' encoding")
+    parser.add_argument('--count', type=int, default=1000, help='number of keys examined by each SCAN')
+    parser.add_argument('--dry-run', action='store_true', help='only count the items to migrate')
+    parser.add_argument('--reindex', action='store_true', help='add all the items to the indexes, nothing is moved')
+    args = parser.parse_args()
+    if not BUCKETS and not args.dry_run and not args.reindex:
+        parser.error("set FAKEAPI_ITEM_ENCODING=bucket, the app must read the buckets before the items are moved")
+    asyncio.run(main(args.count, args.dry_run, args.reindex))
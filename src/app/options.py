@@ -13,7 +13,7 @@ async def options(response: Response, full_path: str):
         -i -L "http://localhost:8000/"
     :return: The header with the method(s) supported by the server
     """
-    headers = {"Allow": "OPTIONS, GET, POST, PUT, DELETE, TRACE, PATCH",
+    headers = {"Allow": "OPTIONS, GET, HEAD, POST, PUT, DELETE, TRACE, PATCH",
                "Cache-Control": "max-age=604800"}
     if full_path:
         headers.update({"X-Fake-API-path-error": full_path})
@@ -15,17 +15,22 @@ The difference between the PUT and PATCH APIs are that PUT is a full update as P
 If an existing resource is modified, either the 200 (OK) or 204 (No Content) response codes SHOULD be sent to indicate
 successful completion of the request.
 """
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Header, HTTPException, Response, status, Depends
 from app.definitions import IDPrice, IDQuantity
-from app.redis_db import redis
+import app.storage as storage
+import app.etags as etags
+from app.cache import invalidate
 from app.definitions import REDIS_HOSTNAME, REDIS_PORT
 from redis import exceptions
 from app.logs import logger
+from jwtauth.auth import require_token
 
 router = APIRouter()
 
-@router.patch("/api/item/id/price", status_code=status.HTTP_200_OK, tags=["patch"])
-def updatePrice(update_price: IDPrice) -> dict:
+@router.patch("/api/item/id/price", status_code=status.HTTP_200_OK, tags=["patch"],
+              dependencies=[Depends(require_token)])
+async def updatePrice(update_price: IDPrice, response: Response,
+                      if_match: str | None = Header(default=None)) -> dict:
     """
     This API updated the price of an item given its ID.
 
@@ -34,6 +39,8 @@ def updatePrice(update_price: IDPrice) -> dict:
     JSON format identical to Python dictionary. The 'keys' need to be identical to the Pydantic models.
 
     if the resource does not exist, this API returns a 404 not found.
+    With an If-Match header, the item is updated only if its ETag is one of the ETags of the header, otherwise
+    this API returns a 412 Precondition Failed.
 
     If the client makes a typo or sends a wrong key/value pair, the server will send a:
         HTTP/1.1 422 Unprocessable Entity
@@ -41,55 +48,40 @@ def updatePrice(update_price: IDPrice) -> dict:
     curl -X PATCH -H "Content-type: application/json" -H "Accept: application/json" \
     -d '{"item_id":100, "price": 99.99}' -i -L "http://localhost:8000/api/item/id/price"
     :param update_price: class IDPrice(BaseModel)
+    :param if_match: ETag(s) the item must have, from a previous GET
     :return: The updated item
     """
-    # Hash HEXISTS
-    key = 'item:' + str(update_price.item_id)
+    # The existence check and the update are done atomically by a Lua script
     try:
-        result = redis.hexists(key, 'id')
+        result = await storage.update_item(update_price.item_id, {'price': update_price.price},
+                                           etags.condition(if_match))
     except exceptions.ConnectionError:
         strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
-    if not result:
+    if result == -2:
+        raise etags.precondition_failed(update_price.item_id)
+    if result < 0:
         strError = f"Item with ID {update_price.item_id} doesn't exists, price update failed"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
-
-    try:
-        result = redis.hset(key, 'price', update_price.price)
-    except exceptions.ConnectionError:
-        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=strError,
-            headers={"X-Fake-REST-API": strError},
-        )
-
-    if result == 0:
-        return {"detail": "update successful", "Item": update_price.item_id, "New Price": update_price.price}
-
-    # This should never happen
-    strError = f"ERROR: Field price was added for ID {update_price.item_id}"
-    logger.info(f'{strError}')
-    raise HTTPException(
-        status_code=status.HTTP_201_CREATED,
-        detail=strError,
-        headers={"X-Fake-REST-API": strError},
-    )
-
-@router.patch("/api/item/id/quantity", status_code=status.HTTP_200_OK, tags=["patch"])
-def updateQuantity(update_quantity: IDQuantity) -> dict:
+    await invalidate(update_price.item_id)
+    response.headers.update(etags.headers(result))
+    return {"detail": "update successful", "Item": update_price.item_id, "New Price": update_price.price}
+
+@router.patch("/api/item/id/quantity", status_code=status.HTTP_200_OK, tags=["patch"],
+              dependencies=[Depends(require_token)])
+async def updateQuantity(update_quantity: IDQuantity, response: Response,
+                         if_match: str | None = Header(default=None)) -> dict:
     """
     This API updated the quantity of an item given its ID.
 
@@ -98,6 +90,8 @@ def updateQuantity(update_quantity: IDQuantity) -> dict:
     JSON format identical to Python dictionary. The 'keys' need to be identical to the Pydantic models.
 
     if the resource does not exist, this API returns a 404 not found.
+    With an If-Match header, the item is updated only if its ETag is one of the ETags of the header, otherwise
+    this API returns a 412 Precondition Failed.
 
     If the client makes a typo or sends a wrong key/value pair, the server will send a:
         HTTP/1.1 422 Unprocessable Entity
@@ -105,52 +99,36 @@ def updateQuantity(update_quantity: IDQuantity) -> dict:
     curl -X PATCH -H "Content-type: application/json" -H "Accept: application/json" \
     -d '{"item_id":100, "quantity": 0}' -i -L "http://localhost:8000/api/item/id/quantity"
     :param update_quantity: class IDPrice(BaseModel)
+    :param if_match: ETag(s) the item must have, from a previous GET
     :return: The updated item
     """
-    # Hash SET
-    key = 'item:' + str(update_quantity.item_id)
+    # The existence check and the update are done atomically by a Lua script
     try:
-        result = redis.hexists(key, 'id')
+        result = await storage.update_item(update_quantity.item_id, {'quantity': update_quantity.quantity},
+                                           etags.condition(if_match))
     except exceptions.ConnectionError:
         strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
-    if not result:
+    if result == -2:
+        raise etags.precondition_failed(update_quantity.item_id)
+    if result < 0:
         strError = f"Item with ID {update_quantity.item_id} doesn't exists, quantity update failed"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
+    await invalidate(update_quantity.item_id)
+    response.headers.update(etags.headers(result))
+    return {"detail": "update successful", "Item": update_quantity.item_id, "New Price": update_quantity.quantity}
 
-    try:
-        result = redis.hset(key, 'quantity', update_quantity.quantity)
-    except exceptions.ConnectionError:
-        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=strError,
-            headers={"X-Fake-REST-API": strError},
-        )
-
-    if result == 0:
-        return {"detail": "update successful", "Item": update_quantity.item_id, "New Price": update_quantity.quantity}
-
-    # This should never happen
-    strError = f"ERROR: Field price was added for ID {update_quantity.item_id}"
-    logger.info(f'{strError}')
-    raise HTTPException(
-        status_code=status.HTTP_201_CREATED,
-        detail=strError,
-        headers={"X-Fake-REST-API": strError},
-    )
 
 
 if __name__ == "__main__":
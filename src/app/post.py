@@ -9,18 +9,23 @@ Ideally, if a resource has been created on the origin server, the response SHOUL
 Many times, the action performed by the POST method might not result in a resource that can be identified by a URI.
 In this case, either HTTP response code 200 (OK) or 204 (No Content) is the appropriate response status.
 """
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, status, Depends
+from pydantic import conlist
 from app.definitions import Item
-from app.redis_db import redis
-from app.definitions import REDIS_HOSTNAME, REDIS_PORT
-from fastapi.encoders import jsonable_encoder
+from app.cache import invalidate, invalidate_many
+import app.storage as storage
+import app.etags as etags
+from app.definitions import REDIS_HOSTNAME, REDIS_PORT, BATCH_MAX
 from redis import exceptions
 from app.logs import logger
+from app.responses import FastJSONResponse
+from jwtauth.auth import require_token
 
 router = APIRouter()
 
-@router.post("/api/item", status_code=status.HTTP_201_CREATED, tags=["post"])
-def add_item(item: Item) -> dict:
+@router.post("/api/item", status_code=status.HTTP_201_CREATED, tags=["post"],
+             dependencies=[Depends(require_token)])
+async def add_item(item: Item) -> FastJSONResponse:
     """
     A request body is data sent by the client to your API in the message body. To declare one in FastAPI,
     we can use Pydantic models. POST requests pass their data in the message body. The data parameter takes
@@ -29,36 +34,81 @@ def add_item(item: Item) -> dict:
     If the client makes a typo or sends a wrong key/value pair, the server will send a:
         HTTP/1.1 422 Unprocessable Entity
 
+    To retry safely, send an Idempotency-Key header: a retry gets the response of the first attempt instead of a
+    400 because the item already exists, see app/idempotency.py.
+
     curl -X POST -H "Content-type: application/json" -H "Accept: application/json" \
     -d '{"id":100,"description":"This is a description","price": 99.99,"quantity": 100,"category": "clothes"}' \
     -i -L "http://localhost:8000/api/item"
     :param item:
-    :return: The data received in the body
+    :return: The item created, with its version, and its ETag
     """
-    # Hash GET
-    key = 'item:' + str(item.id)
+    # The existence check and the write are done atomically by a Lua script
+    mapping = item.dict()
     try:
-        result = redis.hget(key, 'id')
+        version = await storage.create_item(mapping)
     except exceptions.ConnectionError:
         strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
-    if result:
+    if not version:
         strError = f"ID {item.id} already exists, adding item failed"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
-    # Hash Multiple Set
-    redis.hset(key, mapping=jsonable_encoder(item))
-    logger.info(f'POST: {item}')
-    return dict(item)
+    await invalidate(item.id)
+    logger.info('POST: %s', item)
+    return FastJSONResponse({**mapping, "version": version}, status_code=status.HTTP_201_CREATED,
+                            headers=etags.headers(version))
+
+@router.post("/api/items/batch", status_code=status.HTTP_200_OK, tags=["post"],
+             dependencies=[Depends(require_token)])
+async def add_items(items: conlist(Item, min_items=1, max_items=BATCH_MAX)) -> dict:
+    """
+    Creates many items with a single request. All the items are sent to Redis in one pipeline, each item is
+    created by a Lua script only if its ID doesn't already exist. The status of every item is returned:
+        201 if the item was created
+        400 if the ID already exists
+
+    curl -X POST -H "Content-type: application/json" -H "Accept: application/json" \
+    -d '[{"id":100,"description":"Hammer","price": 9.99,"quantity": 20,"category": "tools"},
+         {"id":101,"description":"Jeans","price": 39.99,"quantity": 100,"category": "clothes"}]' \
+    -i -L "http://localhost:8000/api/items/batch"
+    :param items: list of items to create, at most FAKEAPI_BATCH_MAX
+    :return: The number of items created and the status of each item
+    """
+    try:
+        results = await storage.create_items([item.dict() for item in items])
+    except exceptions.ConnectionError:
+        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
+        logger.info(strError)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError},
+        )
+
+    status_items = []
+    created = []
+    for item, result in zip(items, results):
+        if isinstance(result, Exception):
+            status_items.append({"id": item.id, "status": status.HTTP_500_INTERNAL_SERVER_ERROR, "detail": str(result)})
+        elif result:
+            status_items.append({"id": item.id, "status": status.HTTP_201_CREATED})
+            created.append(item.id)
+        else:
+            status_items.append({"id": item.id, "status": status.HTTP_400_BAD_REQUEST,
+                                 "detail": f"ID {item.id} already exists, adding item failed"})
+    await invalidate_many(created)
+    logger.info('POST batch: %d/%d item(s) created', len(created), len(items))
+    return {"created": len(created), "failed": len(items) - len(created), "items": status_items}
 
 
 if __name__ == "__main__":
@@ -15,18 +15,22 @@ code 201 (Created) response.
 If an existing resource is modified, either the 200 (OK) or 204 (No Content) response codes SHOULD be sent to indicate
 successful completion of the request.
 """
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, Header, HTTPException, status, Depends
 from app.definitions import Item
-from app.redis_db import redis
+import app.storage as storage
+import app.etags as etags
+from app.cache import invalidate
 from app.definitions import REDIS_HOSTNAME, REDIS_PORT
-from fastapi.encoders import jsonable_encoder
 from redis import exceptions
 from app.logs import logger
+from app.responses import FastJSONResponse
+from jwtauth.auth import require_token
 
 router = APIRouter()
 
-@router.put("/api/item/id", status_code=status.HTTP_200_OK, tags=["put"])
-def update_item(updated_item: Item) -> dict:
+@router.put("/api/item/id", status_code=status.HTTP_200_OK, tags=["put"],
+            dependencies=[Depends(require_token)])
+async def update_item(updated_item: Item, if_match: str | None = Header(default=None)) -> FastJSONResponse:
     """
     A request body is data sent by the client to your API in the message body. To declare one in FastAPI,
     we can use Pydantic models. PUT requests pass their data in the message body. The data parameter takes
@@ -34,6 +38,12 @@ def update_item(updated_item: Item) -> dict:
 
     if the resource does not exist, this API decides NOT to create a new resource.
 
+    With an If-Match header, the item is updated only if its ETag is one of the ETags of the header, otherwise the
+    server sends a:
+        HTTP/1.1 412 Precondition Failed
+
+    With an Idempotency-Key header, a retry gets the response of the first attempt, see app/idempotency.py.
+
     If the client makes a typo or sends a wrong key/value pair, the server will send a:
         HTTP/1.1 422 Unprocessable Entity
 
@@ -41,29 +51,31 @@ def update_item(updated_item: Item) -> dict:
     -d '{"id":100,"description":"This is a description","price": 99.99,"quantity": 100,"category": "clothes"}' \
     -i -L "http://localhost:8000/api/item/id"
     :param updated_item: class Item(BaseModel):
-    :return: The updated item
+    :param if_match: ETag(s) the item must have, from a previous GET
+    :return: The updated item, with its new version, and its ETag
     """
-    # Hash HEXISTS
-    key = 'item:' + str(updated_item.id)
+    # The existence check and the update are done atomically by a Lua script
+    item = updated_item.dict()
     try:
-        result = redis.hexists(key, 'id')
+        result = await storage.update_item(updated_item.id, item, etags.condition(if_match))
     except exceptions.ConnectionError:
         strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
-    if result:
-        # Hash Multiple Set
-        redis.hset(key, mapping=jsonable_encoder(updated_item))
-        logger.info(f'Full update - {jsonable_encoder(updated_item)}')
-        return dict(updated_item)
+    if result > 0:
+        await invalidate(updated_item.id)
+        logger.info('Full update - %s', item)
+        return FastJSONResponse({**item, "version": result}, headers=etags.headers(result))
+    if result == -2:
+        raise etags.precondition_failed(updated_item.id)
 
     strError = f"Item with ID {updated_item.id} doesn't exists, full update failed"
-    logger.info(f'{strError}')
+    logger.info(strError)
     raise HTTPException(
         status_code=status.HTTP_400_BAD_REQUEST,
         detail=strError,
@@ -12,51 +12,404 @@ Example of queries with the Redis client:
 
 If this script is run on the host, the Redis server is at 'localhost'
 If this script is run in a container, the Redis server is at 'redis.lab'
+
+The items can be sharded on many Redis servers listed in REDIS_NODES. Each node has its own pool and its own circuit
+breaker, a bucket of items is placed on a node by consistent hashing (see HashRing and app/storage.py). To try it
+locally with three servers:
+    redis-server --port 6380 --save '' --daemonize yes
+    redis-server --port 6381 --save '' --daemonize yes
+    REDIS_NODES=localhost:6379,localhost:6380,localhost:6381 python3 main.py
+
+With REDIS_SENTINELS, the nodes are the primaries monitored by the Sentinels, REDIS_SENTINEL_SERVICES, and their
+address is asked to the Sentinels, so the app follows a failover. The reads of the GET routes can go to the replicas
+of the nodes, see app/replicas.py.
 """
 
-from fastapi import APIRouter, HTTPException, status
-from fastapi.responses import HTMLResponse
-from redis import Redis, exceptions
-import time
+from contextlib import asynccontextmanager
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, status
+from fastapi.responses import HTMLResponse, StreamingResponse
+from redis.asyncio import ConnectionPool
+from redis.asyncio.sentinel import Sentinel, SentinelConnectionPool
+from redis.asyncio.client import Redis as AsyncRedis, Pipeline as AsyncPipeline
+from redis import exceptions
+import asyncio
+import bisect
 import platform
-from app.definitions import REDIS_HOSTNAME, REDIS_PORT
+import time
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import md5
+from app.definitions import REDIS_HOSTNAME, REDIS_PORT, REDIS_NODES, REDIS_SENTINELS, REDIS_SENTINEL_SERVICES, \
+    REDIS_MAX_CONNECTIONS, REDIS_HEALTH_CHECK_INTERVAL, REDIS_SOCKET_TIMEOUT, REDIS_SOCKET_CONNECT_TIMEOUT, \
+    REDIS_BREAKER_FAILURES, REDIS_BREAKER_PROBE_INTERVAL, SCAN_COUNT, SCAN_COUNT_MAX, HITS_FLUSH_INTERVAL
 from app.logs import logger
+import app.metrics as metrics
+from app.responses import FastJSONResponse, dumps
+from jwtauth.auth import require_token
 
 # Get the id of the docker container we're running in (it's our hostname)
 container_id = platform.node()
+# visits of every container, one field per hostname
+visits_key = 'visited'
+# visits of this container before they were kept in 'visited', they're added to its field at startup
 visited_key = 'visited:' + container_id
+# keys of the app itself: the indexes of app/storage.py, the responses of app/idempotency.py and the visits
+INTERNAL_PREFIXES = ('index:', 'idempotency:', visits_key + ':')
+
+def is_internal(key: str) -> bool:
+    """
+    :return: True if the key is kept by the app, it's neither listed nor deleted by the /api/redis routes
+    """
+    return key == visits_key or key.startswith(INTERNAL_PREFIXES)
+
+class CircuitOpenError(exceptions.RedisError):
+    """
+    Raised without contacting Redis while the circuit breaker is open. It's not a ConnectionError, so the routers
+    don't turn it into a 500, the app returns a 503 with circuit_open_handler().
+    """
+
+
+class CircuitBreaker:
+    """
+    Fails the Redis commands fast while a Redis node is unavailable, instead of waiting for the socket timeouts.
+
+    closed: the commands are sent. After REDIS_BREAKER_FAILURES consecutive connection errors or timeouts, it opens.
+    open: the commands raise CircuitOpenError. A background task sends a PING every REDIS_BREAKER_PROBE_INTERVAL
+          seconds, the first that succeeds half-opens the breaker.
+    half_open: the commands are sent, the first success closes the breaker and the first failure opens it again.
+
+    A node has one breaker, shared by all the connections of its pool. The client calls check() before a command and
+    success() or failure() after it, at most one probe task runs while the breaker is open.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, node: str, threshold: int, probe_interval: float):
+        self.node = node
+        # the client of the node, for the probe
+        self.client: AsyncRedis | None = None
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = 0.0
+        self._probe: asyncio.Task | None = None
+
+    def check(self) -> None:
+        if self.state == self.OPEN:
+            raise CircuitOpenError(f'Circuit breaker open for Redis database {self.node}')
 
-# Connect to redis and create a key for number of time visited, if it didn't exist
-try:
-    redis = Redis(host=REDIS_HOSTNAME, port=REDIS_PORT, db=0, socket_connect_timeout=5,
-                  socket_timeout=5, decode_responses=True, charset='utf-8')
-    # redis.set(container_id, 0)
+    def success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info('Circuit breaker closed, Redis database %s is back', self.node)
+            self.state = self.CLOSED
+        self.failures = 0
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+            self.open()
+
+    def open(self) -> None:
+        self.state = self.OPEN
+        self.trips += 1
+        self.opened_at = time.monotonic()
+        logger.warning('Circuit breaker open after %d failure(s) of Redis database %s', self.failures, self.node)
+        if self._probe is None:
+            self._probe = asyncio.create_task(self._run_probe())
+
+    async def _run_probe(self) -> None:
+        try:
+            while self.state == self.OPEN:
+                await asyncio.sleep(self.probe_interval)
+                try:
+                    # sent around the breaker
+                    await AsyncRedis.execute_command(self.client, 'PING')
+                except (exceptions.ConnectionError, exceptions.TimeoutError):
+                    continue
+                logger.info('Circuit breaker half-open, Redis database %s answered', self.node)
+                self.state = self.HALF_OPEN
+        finally:
+            self._probe = None
+
+    async def stop(self) -> None:
+        if self._probe is not None:
+            self._probe.cancel()
+            try:
+                await self._probe
+            except asyncio.CancelledError:
+                pass
+
+    def as_dict(self) -> dict:
+        return {"node": self.node, "state": self.state, "consecutive_failures": self.failures, "trips": self.trips,
+                "open_for": round(time.monotonic() - self.opened_at, 3) if self.state == self.OPEN else 0.0}
+
+
+class Pipeline(AsyncPipeline):
+    """
+    Pipeline that goes through the circuit breaker of its node and reports the latency of each round trip to the
+    metrics, as the command PIPELINE.
+    """
+    breaker: CircuitBreaker
+
+    async def execute(self, raise_on_error: bool = True):
+        self.breaker.check()
+        start = time.perf_counter()
+        try:
+            result = await super().execute(raise_on_error)
+        except (exceptions.ConnectionError, exceptions.TimeoutError):
+            self.breaker.failure()
+            raise
+        finally:
+            metrics.observe_redis('PIPELINE', time.perf_counter() - start)
+        self.breaker.success()
+        return result
+
+class Redis(AsyncRedis):
+    """
+    Redis client of a node that goes through the circuit breaker of the node and reports the latency of each command
+    to the metrics.
+    """
+    def __init__(self, node: str, **kwargs):
+        super().__init__(**kwargs)
+        self.node = node
+        self.breaker = CircuitBreaker(node, REDIS_BREAKER_FAILURES, REDIS_BREAKER_PROBE_INTERVAL)
+        self.breaker.client = self
+
+    async def execute_command(self, *args, **options):
+        self.breaker.check()
+        start = time.perf_counter()
+        try:
+            result = await super().execute_command(*args, **options)
+        except (exceptions.ConnectionError, exceptions.TimeoutError):
+            self.breaker.failure()
+            raise
+        finally:
+            metrics.observe_redis(str(args[0]).upper(), time.perf_counter() - start)
+        self.breaker.success()
+        return result
+
+    def pipeline(self, transaction: bool = True, shard_hint=None) -> Pipeline:
+        pipe = Pipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+        pipe.breaker = self.breaker
+        return pipe
+
+def address(node: str) -> tuple[str, int]:
+    host, _, port = node.rpartition(':')
+    return host, int(port)
+
+POOL_OPTIONS = dict(db=0,
+                    max_connections=REDIS_MAX_CONNECTIONS,
+                    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                    socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT,
+                    socket_timeout=REDIS_SOCKET_TIMEOUT,
+                    decode_responses=True, encoding='utf-8')
+
+sentinel = Sentinel([address(node) for node in REDIS_SENTINELS], socket_timeout=REDIS_SOCKET_TIMEOUT,
+                    socket_connect_timeout=REDIS_SOCKET_CONNECT_TIMEOUT) if REDIS_SENTINELS else None
+
+def connect(node: str) -> Redis:
+    """
+    The pool and the client don't do any I/O until the first command. Connections are created on demand, up to
+    REDIS_MAX_CONNECTIONS, and are shared by all the routers.
+    :param node: 'host:port' of the Redis server, or the name of the primary monitored by the Sentinels
+    """
+    if sentinel is not None and node in REDIS_SENTINEL_SERVICES:
+        # every new connection asks the Sentinels for the address of the primary
+        pool = SentinelConnectionPool(node, sentinel, is_master=True, check_connection=False, **POOL_OPTIONS)
+    else:
+        host, port = address(node)
+        pool = ConnectionPool(host=host, port=port, **POOL_OPTIONS)
+    return Redis(node, connection_pool=pool)
+
+class HashRing:
+    """
+    Consistent hashing over the nodes. Each node has VNODES points on a ring of 2**32 positions, a key goes to the
+    node of the first point after the hash of the key. When a node is added, only about 1/N of the keys move.
+    """
+    VNODES = 160
+
+    def __init__(self, nodes: list[str]):
+        points = sorted((self._hash(f'{node}#{i}'), index) for index, node in enumerate(nodes)
+                        for i in range(self.VNODES))
+        self._positions = [position for position, _ in points]
+        self._shards = [index for _, index in points]
+        self._single = len(nodes) == 1
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(md5(key.encode()).digest()[:4], 'big')
+
+    def shard(self, key) -> int:
+        """
+        :return: The index of the node of the key in NODES
+        """
+        if self._single:
+            return 0
+        i = bisect.bisect(self._positions, self._hash(str(key)))
+        return self._shards[i % len(self._shards)]
+
+
+NODES = REDIS_SENTINEL_SERVICES if sentinel is not None else REDIS_NODES
+# One client per node, the first node also holds everything that isn't an item
+shards = [connect(node) for node in NODES]
+ring = HashRing(NODES)
+redis = shards[0]
+pool = redis.connection_pool
+breaker = redis.breaker
+
+def pool_metrics() -> list:
+    connections, maximum, is_open, trips = [], [], [], []
+    for client in shards:
+        # the pool has no public API for its usage
+        created = getattr(client.connection_pool, '_created_connections', 0)
+        available = len(getattr(client.connection_pool, '_available_connections', []))
+        label = f'node="{client.node}"'
+        connections += [(f'{label},state="in_use"', created - available), (f'{label},state="idle"', available)]
+        maximum.append((label, REDIS_MAX_CONNECTIONS))
+        is_open.append((label, int(client.breaker.state == CircuitBreaker.OPEN)))
+        trips.append((label, client.breaker.trips))
+    return [('fakeapi_redis_pool_connections', 'gauge', 'Connections of the Redis pools by state', connections),
+            ('fakeapi_redis_pool_max_connections', 'gauge', 'Maximum number of connections of a Redis pool',
+             maximum),
+            ('fakeapi_redis_breaker_open', 'gauge', 'Circuit breaker of a Redis node, 1 while open', is_open),
+            ('fakeapi_redis_breaker_trips_total', 'counter', 'Number of times the circuit breaker of a Redis node '
+             'opened', trips)]
+
+
+metrics.add_collector(pool_metrics)
+
+async def open_redis() -> None:
+    """
+    Checks the connection to Redis and creates a key for number of time visited, if it didn't exist.
+    A failure is logged but doesn't prevent the server from starting, the routers will return a 500 until
+    Redis is back.
+    """
+    for client in shards[1:]:
+        try:
+            await client.ping()
+            logger.info('Connected to Redis database %s', client.node)
+        except exceptions.RedisError as e:
+            logger.error('Redis connection failed: %s - %s', client.node, e)
     try:
-        setnx_result = redis.setnx(visited_key, 0)
-    except Exception as e:
-        logger.error(f'Error: {e}')
+        await redis.ping()
+        legacy = await redis.getdel(visited_key)
+        if legacy is not None and legacy.isdigit():
+            await redis.hincrby(visits_key, container_id, int(legacy))
+        setnx_result = await redis.hsetnx(visits_key, container_id, 0)
+        hits.flushed = int(await redis.hget(visits_key, container_id) or 0)
+    except exceptions.RedisError as e:
+        logger.error('Redis connection failed: %s - %s', redis.node, e)
+        return
+    logger.info('Connected to Redis database %s - pool of %d connections, %d node(s)', redis.node,
+                REDIS_MAX_CONNECTIONS, len(shards))
+    if setnx_result:
+        logger.info('Field "%s" of key "%s" created', container_id, visits_key)
     else:
-        if setnx_result:
-            logger.info(f'Key: "{visited_key}" created')
-        else:
-            logger.info(f'Key: "{visited_key}" already exist')
-except Exception as e:
-    logger.error(f'Redis connection failed: {REDIS_HOSTNAME}:{REDIS_PORT} - {e}')
-else:
-    logger.info(f'Connected to Redis database {REDIS_HOSTNAME}:{REDIS_PORT}')
+        logger.info('Field "%s" of key "%s" already exist', container_id, visits_key)
+
+async def close_redis() -> None:
+    """
+    Closes the clients and all the connections of their pools.
+    """
+    for client in shards:
+        await client.breaker.stop()
+        await client.close()
+        await client.connection_pool.disconnect()
+        logger.info('Disconnected from Redis database %s', client.node)
+    if sentinel is not None:
+        for client in sentinel.sentinels:
+            await client.close()
+            await client.connection_pool.disconnect()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Lifespan of the application: the Redis pool is opened before the first request and closed at shutdown.
+        app = FastAPI(lifespan=lifespan)
+    """
+    await open_redis()
+    await start_hits()
+    yield
+    await stop_hits()
+    await close_redis()
 
 router = APIRouter()
 
-def get_hit_count():
-    retries = 3
+class HitCounter:
+    """
+    Counts the visits of this worker in memory. A background task adds them to the field '<hostname>' of the hash
+    'visited' with a single HINCRBY every FAKEAPI_HITS_FLUSH_INTERVAL seconds. hit() doesn't await, so a visit
+    counted while a flush waits for Redis goes to 'pending' and is added by the next flush.
+    """
+    def __init__(self, key: str, field: str):
+        self.key = key
+        self.field = field
+        # visits not added to Redis yet
+        self.pending = 0
+        # value of the key after the last flush, it includes the visits of the other workers of this host
+        self.flushed = 0
+
+    def hit(self) -> int:
+        """
+        :return: The number of visits, including the ones not flushed yet
+        """
+        self.pending += 1
+        return self.flushed + self.pending
+
+    async def flush(self) -> None:
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, 0
+        try:
+            self.flushed = await redis.hincrby(self.key, self.field, pending)
+        except exceptions.RedisError:
+            # counted again at the next flush
+            self.pending += pending
+            raise
+
+
+hits = HitCounter(visits_key, container_id)
+_flusher: asyncio.Task | None = None
+
+async def _flush_hits() -> None:
+    failures = 0
     while True:
+        # backoff while Redis is unavailable, up to 30 seconds
+        await asyncio.sleep(min(HITS_FLUSH_INTERVAL * 2 ** failures, 30))
         try:
-            return redis.incr(visited_key)
-        except exceptions.ConnectionError:
-            if retries == 0:
-                return -1
-            retries -= 1
-            time.sleep(0.5)
+            await hits.flush()
+            failures = 0
+        except exceptions.RedisError as e:
+            failures = min(failures + 1, 10)
+            logger.warning('%d visit(s) not flushed to "%s": %s', hits.pending, visits_key, e)
+
+async def start_hits() -> None:
+    """
+    Starts the task that flushes the visits to Redis, with a backoff while Redis is unavailable. Does nothing if
+    it's already running.
+    """
+    global _flusher
+    if _flusher is None:
+        _flusher = asyncio.create_task(_flush_hits())
+
+async def stop_hits() -> None:
+    """
+    Stops the task and flushes the last visits, if Redis is available.
+    """
+    global _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        try:
+            await _flusher
+        except asyncio.CancelledError:
+            pass
+        _flusher = None
+    try:
+        await hits.flush()
+    except exceptions.RedisError as e:
+        logger.warning('%d visit(s) lost: %s', hits.pending, e)
 
 def generate_html_response(num_visited: int):
     html_content = f"""
@@ -66,29 +419,87 @@ def generate_html_response(num_visited: int):
         </head>
         <body>
             <h2>You visited me {num_visited}</h2>
-            <h2>Container ID is {visited_key}</h2>
+            <h2>Container ID is {container_id}</h2>
         </body>
     </html>
     """
     return HTMLResponse(content=html_content, status_code=200)
 
+async def circuit_open_handler(request: Request, exc: CircuitOpenError) -> FastJSONResponse:
+    """
+    Exception handler of the app for CircuitOpenError, the request fails fast with a 503.
+        app.add_exception_handler(CircuitOpenError, circuit_open_handler)
+    """
+    strError = str(exc)
+    return FastJSONResponse({"detail": strError}, status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            headers={"X-Fake-REST-API": strError,
+                                     "Retry-After": str(max(1, round(REDIS_BREAKER_PROBE_INTERVAL)))})
+
+@router.get("/api/health/live", tags=["get"])
+async def liveness() -> dict:
+    """
+    Liveness probe: the worker answers. It doesn't depend on Redis.
+
+    Example with curl:
+        curl -i -L "http://localhost:8000/api/health/live"
+    :return: Always 200
+    """
+    return {"status": "alive", "hostname": container_id}
+
+@router.get("/api/health/ready", tags=["get"])
+async def readiness() -> FastJSONResponse:
+    """
+    Readiness probe for the load balancers: 503 while the circuit breaker of a Redis node is open, so the replica
+    is drained until the node is back. It doesn't send any command to Redis, the breakers already track their state.
+
+    Example with curl:
+        curl -i -L "http://localhost:8000/api/health/ready"
+    :return: 200 if Redis is usable, 503 otherwise, with the state of the circuit breaker
+    """
+    ready = all(client.breaker.state != CircuitBreaker.OPEN for client in shards)
+    return FastJSONResponse({"status": "ready" if ready else "unavailable", "hostname": container_id,
+                             "redis": breaker.as_dict() if len(shards) == 1
+                             else [client.breaker.as_dict() for client in shards]},
+                            status_code=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
 @router.get("/redis", response_class=HTMLResponse)
 async def my_redis():
-    # Increment the number of requests
-    count = get_hit_count()
-    if count < 0:
-        strError = f'Problem with Redis database {REDIS_HOSTNAME} at port {REDIS_PORT}'
+    # Increment the number of requests, it's flushed to Redis in the background
+    return generate_html_response(hits.hit())
+
+@router.get("/api/redis/visits", tags=["get"])
+async def get_visits() -> FastJSONResponse:
+    """
+    Returns the number of visits of every container, from the hash 'visited', and their total. The visits of the
+    last FAKEAPI_HITS_FLUSH_INTERVAL seconds may not be counted yet.
+    The hash has a field per container, it's read with a single HGETALL.
+
+    Example with curl:
+        curl -H "Content-type: application/json" -H "Accept: application/json" -i -L \
+        "http://localhost:8000/api/redis/visits"
+    :return: The total and the number of visits per container
+    """
+    try:
+        containers = {hostname: int(value) for hostname, value in (await redis.hgetall(visits_key)).items()
+                      if value.isdigit()}
+    except exceptions.ConnectionError:
+        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
-    return generate_html_response(count)
+    return FastJSONResponse({"total": sum(containers.values()), "containers": containers})
 
-@router.delete('/api/redis/key/{key}', status_code=status.HTTP_200_OK, tags=["delete"])
+@router.delete('/api/redis/key/{key}', status_code=status.HTTP_200_OK, tags=["delete"],
+               dependencies=[Depends(require_token)])
 async def deleteKey(key: str) -> dict:
     """
     Use DELETE method to delete a specified key in the Redis database. If it doesn't exist, return 404.
+    The items of a key 'item:<id>' or 'items:<bucket>' are deleted by the Lua scripts of app/storage.py, with their
+    entries in the indexes. The keys of the app itself, like the indexes, and the keys that aren't hashes can't be
+    deleted, return 400.
 
     Example with curl:
         curl -X DELETE -H "Content-type: application/json" -H "Accept: application/json" \
@@ -96,70 +507,202 @@ async def deleteKey(key: str) -> dict:
     :param key: key to delete
     :return: Deleted item or error 404 if not found
     """
+    # imported here, the cache and storage modules depend on this one
+    from app.cache import invalidate_many
+    from app.storage import item_ids_of, shard_of_key, delete_items
+    if is_internal(key):
+        strError = f"Key: {key} is kept by the app, it can't be deleted"
+        logger.info(strError)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError},
+        )
+    client = shard_of_key(key)
     try:
-        result = redis.hgetall(key)
+        try:
+            result = await client.hgetall(key)
+        except exceptions.ResponseError:
+            strError = f"Key: {key} isn't a hash, it can't be deleted"
+            logger.info(strError)
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=strError,
+                headers={"X-Fake-REST-API": strError},
+            )
         if not result:
-            strError = f"Key: {key} was found not found in Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-            logger.info(f'{strError}')
+            strError = f"Key: {key} was found not found in Redis database {client.node}"
+            logger.info(strError)
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=strError,
                 headers={"X-Fake-REST-API": strError},
             )
+        item_ids = item_ids_of(key, list(result))
         try:
-            await redis.delete(key)
+            if item_ids:
+                errors = [error for error in await delete_items(item_ids) if isinstance(error, Exception)]
+                if errors:
+                    # some items of the key can be deleted
+                    await invalidate_many(item_ids)
+                    strError = f"Key: {key} was not deleted from Redis database {client.node}: {errors[0]}"
+                    logger.warning(strError)
+                    raise HTTPException(
+                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail=strError,
+                        headers={"X-Fake-REST-API": strError},
+                    )
+            # a bucket of the other encoding isn't removed by the scripts
+            await client.delete(key)
         except exceptions.ConnectionError:
-            strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-            logger.info(f'{strError}')
+            strError = f"Connection error: Redis database {client.node}"
+            logger.info(strError)
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=strError,
                 headers={"X-Fake-REST-API": strError},
             )
-        logger.info(f'Key: {key} was deleted from Redis database {REDIS_HOSTNAME}:{REDIS_PORT}')
+        await invalidate_many(item_ids)
+        logger.info('Key: %s was deleted from Redis database %s', key, client.node)
         return {"key": key, 'data': result}
     except exceptions.ConnectionError:
-        strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        strError = f"Connection error: Redis database {client.node}"
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
+def encode_cursor(node: int, cursor: int, replica: str | None = None) -> str | None:
+    """
+    The SCAN cursor is returned to the client as an opaque string, with the index of the node that is scanned and
+    the address of the replica that returned it, a SCAN cursor is only valid on the server that returned it.
+    The nodes are scanned one after the other. None means the iteration of the last node is complete.
+    """
+    if cursor == 0:
+        if node == len(shards) - 1:
+            return None
+        # the next node is started on any replica
+        node, replica = node + 1, None
+    # the cursors of the first node don't change, the ones returned before the sharding are still valid
+    text = str(cursor) if node == 0 else f'{node}:{cursor}'
+    if replica is not None:
+        text += '@' + replica
+    return urlsafe_b64encode(text.encode()).decode()
+
+def decode_cursor(cursor: str | None) -> tuple[int, int, str | None]:
+    """
+    :return: The index of the node, its SCAN cursor and the address of the replica, None for the primary
+    """
+    if not cursor:
+        return 0, 0, None
+    try:
+        text, _, replica = urlsafe_b64decode(cursor.encode()).decode().partition('@')
+        node, _, scan_cursor = text.rpartition(':')
+        node = int(node or 0)
+        if not 0 <= node < len(shards):
+            raise ValueError(node)
+        return node, int(scan_cursor), replica or None
+    except ValueError:
+        strError = f"Invalid cursor: {cursor}"
+        logger.info(strError)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError},
+        )
+
+def scanner(node: int, cursor: int, replica: str | None) -> Redis:
+    """
+    :return: The server that continues the SCAN: the replica that returned the cursor, the primary, or any fresh
+             replica at the start of a node
+    """
+    # imported here, the replicas module depends on this one
+    from app.replicas import reader, replica_of
+    if cursor == 0:
+        return reader(shards[node])
+    if replica is None:
+        return shards[node]
+    client = replica_of(shards[node], replica)
+    if client is None:
+        logger.warning('Replica %s is gone, SCAN continued on the primary %s, keys can be missed', replica,
+                       shards[node].node)
+        return shards[node]
+    return client
+
+async def stream_keys(node: int, client: Redis, cursor: int, keys: list, match: str, count: int,
+                      key_type: str | None):
+    """
+    Yields the keys of the first page, then all the others, one JSON string per line. SCAN is called as the
+    client reads the response, so at most one page of keys is kept in memory.
+    """
+    while True:
+        keys = [key for key in keys if not is_internal(key)]
+        if keys:
+            yield b''.join(dumps(key) + b'\n' for key in keys)
+        if cursor == 0:
+            if node == len(shards) - 1:
+                return
+            node += 1
+            client = scanner(node, 0, None)
+        cursor, keys = await client.scan(cursor, match=match, count=count, _type=key_type)
+
 @router.get("/api/redis/keys", tags=["get"])
-async def get_all_keys():
-    # async def get_all_keys(request: Request) -> dict:
+async def get_all_keys(cursor: str | None = None,
+                       count: int = Query(default=SCAN_COUNT, ge=1, le=SCAN_COUNT_MAX),
+                       match: str = '*',
+                       type: str | None = Query(default=None, regex='^(string|list|set|zset|hash|stream)$'),
+                       stream: bool = False):
     """
-    Returns all the resources. No parameter needed.
-    curl -H "Content-type: application/json" -H "Accept: application/json" -i -L  http://localhost:8000/api/redis/keys
-    :return: All the elements
+    Returns the keys of the database, one page at a time. Each request runs a single SCAN command, it never
+    blocks the Redis server like KEYS does. Start without a cursor and send back the 'cursor' of the response
+    until it's null. A page can be empty even if the iteration isn't complete, SCAN filters after reading.
+    With many Redis nodes, they're scanned one after the other and 'dbsize' is the total of all the nodes.
+    The keys of the app itself, like the indexes and the idempotency responses, aren't returned, 'dbsize' counts them.
+
+    With stream=true, all the keys are returned in a streamed response, one JSON string per line.
+
+    curl -H "Content-type: application/json" -H "Accept: application/json" -i -L \
+    "http://localhost:8000/api/redis/keys?count=100&match=item:*&type=hash"
+    :param cursor: the cursor returned by the previous page, nothing for the first page
+    :param count: number of keys examined by SCAN, the page has about this number of keys
+    :param match: glob-style pattern of the keys to return
+    :param type: return only the keys of this Redis type
+    :param stream: stream all the keys instead of returning one page
+    :return: The size of the database, a page of keys and the cursor for the next page
     """
     try:
-        all_the_keys = redis.keys('*')
-        dbsize = redis.dbsize()
-        logger.info(f'DB size: {dbsize} - Keys: {all_the_keys}')
-        return {"dbsize": dbsize, 'keys': all_the_keys}
+        node, scan_cursor, replica = decode_cursor(cursor)
+        client = scanner(node, scan_cursor, replica)
+        next_cursor, keys = await client.scan(scan_cursor, match=match, count=count, _type=type)
+        if stream:
+            # the first SCAN is done before the response is started, so a connection error is still a 500
+            return StreamingResponse(stream_keys(node, client, next_cursor, keys, match, count, type),
+                                     media_type='application/x-ndjson')
+        keys = [key for key in keys if not is_internal(key)]
+        dbsize = sum(await asyncio.gather(*[primary.dbsize() for primary in shards]))
+        logger.info('DB size: %d - SCAN returned %d key(s)', dbsize, len(keys))
+        replica = None if client is shards[node] else client.node
+        return FastJSONResponse({"dbsize": dbsize, 'keys': keys, 'cursor': encode_cursor(node, next_cursor, replica)})
     except exceptions.ConnectionError:
         strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-        logger.info(f'{strError}')
+        logger.info(strError)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=strError,
             headers={"X-Fake-REST-API": strError},
         )
 
-
 if __name__ == "__main__":
     import uvicorn
     import logging
     import platform
-    from fastapi import FastAPI
     from definitions import tags_metadata, HOSTNAME, PORT, Item
     from fastapi.encoders import jsonable_encoder
 
     @router.post("/api/item", status_code=status.HTTP_201_CREATED, tags=["post"])
-    def add_item(item: Item) -> dict:
+    async def add_item(item: Item) -> dict:
         """
         A request body is data sent by the client to your API in the message body. To declare one in FastAPI,
         we can use Pydantic models. POST requests pass their data in the message body. The data parameter takes
@@ -177,10 +720,10 @@ if __name__ == "__main__":
         # Hash GET
         key = 'item:' + str(item.id)
         try:
-            result = redis.hget(key, 'id')
+            result = await redis.hget(key, 'id')
         except exceptions.ConnectionError:
             strError = f"Connection error: Redis database {REDIS_HOSTNAME}:{REDIS_PORT}"
-            logger.info(f'{strError}')
+            logger.info(strError)
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=strError,
@@ -191,14 +734,14 @@ if __name__ == "__main__":
 
         if result:
             strError = f"ID {item.id} already exists, adding item failed"
-            logger.info(f'{strError}')
+            logger.info(strError)
             raise HTTPException(
                 status_code=status.HTTP_406_NOT_ACCEPTABLE,
                 detail=strError,
                 headers={"X-Fake-REST-API": strError},
             )
         # Hash Multiple Set
-        result = redis.hset(key, mapping=jsonable_encoder(item))
+        result = await redis.hset(key, mapping=jsonable_encoder(item))
         logging.info(f'HSET: {result} - {jsonable_encoder(item)}')
         return dict(item)
 
@@ -211,7 +754,7 @@ if __name__ == "__main__":
     logging.info(f'Hostname: {platform.node()}')
     logging.info(f'Redis database module')
 
-    app = FastAPI(openapi_tags=tags_metadata)
+    app = FastAPI(openapi_tags=tags_metadata, lifespan=lifespan)
     app.include_router(router)
 
     uvicorn.run(app, host=HOSTNAME, port=PORT, log_level="info")
@@ -0,0 +1,261 @@
+# app/replicas.py
+"""
+Routing of the reads to the replicas of the Redis nodes. The writes, the Lua scripts that write and everything that
+isn't an item stay on the primary of each node. The reads of the GET routes, the items, the pages of the indexes,
+the export and the listing of the keys, go to a replica of the node if one is fresh enough, to the primary otherwise.
+
+The replicas are listed in REDIS_REPLICAS or discovered by the Sentinels of REDIS_SENTINELS. Every
+REDIS_REPLICA_CHECK_INTERVAL seconds, a background task reads the replication offset of each primary and of its
+replicas with INFO replication. A replica is fresh as of the last sample of its primary that it has caught up with,
+it's read only if that sample is less than REDIS_READ_MAX_LAG seconds old and its link to the primary is up. If
+no replica is fresh, the reads go to the primary: the staleness is bounded, not the load.
+
+Read-your-writes: a successful POST, PUT, PATCH or DELETE sets the cookie 'fakeapi_last_write'. For
+REDIS_READ_YOUR_WRITES seconds after, the reads of the client that sends it back go to the primaries. The other
+clients can read the old item for up to REDIS_READ_MAX_LAG seconds. The in-process cache only keeps the items read
+from a primary, and the reads of the client that wrote don't look into it.
+
+Try it locally with a replica:
+    redis-server --port 6380 --replicaof localhost 6379 --save '' --daemonize yes
+    REDIS_REPLICAS=localhost:6380 python3 main.py
+    curl -c cookies -b cookies -X PUT ... ; curl -c cookies -b cookies "http://localhost:8000/api/item/100"
+"""
+import asyncio
+import itertools
+import math
+import time
+from collections import deque
+from contextvars import ContextVar
+from starlette.datastructures import MutableHeaders
+from starlette.requests import cookie_parser
+from redis import exceptions
+from app.redis_db import Redis, CircuitBreaker, shards, sentinel, connect
+from app.definitions import REDIS_REPLICAS, REDIS_READ_MAX_LAG, REDIS_REPLICA_CHECK_INTERVAL, REDIS_READ_YOUR_WRITES
+from app.logs import logger
+import app.metrics as metrics
+
+WRITE_COOKIE = 'fakeapi_last_write'
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# True while the request of a client that wrote recently is processed, see ReadYourWritesMiddleware
+_primary_reads: ContextVar[bool] = ContextVar('primary_reads', default=False)
+
+class Replicas:
+    """
+    The replicas of a node and how fresh they are. A replica is fresh as of the newest sample of the replication
+    offset of the primary it has reached, it's read while that sample is at most REDIS_READ_MAX_LAG old.
+    """
+    # samples of the replication offset of the primary, enough for HISTORY * REDIS_REPLICA_CHECK_INTERVAL seconds
+    HISTORY = 64
+
+    def __init__(self, primary: Redis, addresses: list[str]):
+        self.primary = primary
+        self.clients: dict[str, Redis] = {}
+        # monotonic time of the newest sample of the primary each replica has caught up with
+        self.fresh_as_of: dict[str, float] = {}
+        self.failing = False
+        self._offsets: deque[tuple[float, int]] = deque(maxlen=self.HISTORY)
+        self._next = itertools.count()
+        self.update(addresses)
+
+    def update(self, addresses: list[str]) -> list[Redis]:
+        """
+        Adds the new replicas of the node and removes the ones that are gone.
+        :return: The clients of the replicas removed, to close
+        """
+        removed = [self.clients.pop(address) for address in list(self.clients) if address not in addresses]
+        for client in removed:
+            del self.fresh_as_of[client.node]
+            logger.info('Replica %s of Redis database %s removed', client.node, self.primary.node)
+        for address in addresses:
+            if address not in self.clients:
+                self.clients[address] = connect(address)
+                # not read until the first measure
+                self.fresh_as_of[address] = -math.inf
+                logger.info('Replica %s of Redis database %s added', address, self.primary.node)
+        return removed
+
+    def staleness(self, address: str) -> float:
+        return time.monotonic() - self.fresh_as_of[address]
+
+    def pick(self) -> Redis | None:
+        """
+        :return: One of the fresh replicas, in turn, or None if there's none
+        """
+        fresh = [client for address, client in self.clients.items()
+                 if client.breaker.state != CircuitBreaker.OPEN and self.staleness(address) <= REDIS_READ_MAX_LAG]
+        if not fresh:
+            return None
+        return fresh[next(self._next) % len(fresh)]
+
+    async def measure(self) -> None:
+        if sentinel is not None:
+            found = await sentinel.discover_slaves(self.primary.node)
+            for client in self.update([f'{host}:{port}' for host, port in found]):
+                await close(client)
+        info = await self.primary.info('replication')
+        sampled = time.monotonic()
+        self._offsets.append((sampled, int(info['master_repl_offset'])))
+        results = await asyncio.gather(*[client.info('replication') for client in self.clients.values()],
+                                       return_exceptions=True)
+        for address, info in zip(list(self.clients), results):
+            if isinstance(info, Exception):
+                # not fresher than before, its staleness grows until it answers again
+                continue
+            if info.get('master_link_status') != 'up':
+                self.fresh_as_of[address] = -math.inf
+                continue
+            offset = int(info.get('slave_repl_offset', -1))
+            for when, primary_offset in reversed(self._offsets):
+                if primary_offset <= offset:
+                    self.fresh_as_of[address] = max(self.fresh_as_of[address], when)
+                    break
+
+
+replica_sets: dict[Redis, Replicas] = {
+    client: Replicas(client, [] if sentinel is not None else addresses)
+    for client, addresses in zip(shards, REDIS_REPLICAS + [[]] * len(shards))
+    if sentinel is not None or addresses}
+
+# reads by target, only counted when there are replicas
+_reads = {'primary': 0, 'replica': 0}
+
+def reader(client: Redis) -> Redis:
+    """
+    :param client: the primary of the node that holds the data
+    :return: The client to read the data from, a fresh replica of the node or its primary
+    """
+    replica_set = replica_sets.get(client)
+    if replica_set is None:
+        return client
+    replica = None if _primary_reads.get() else replica_set.pick()
+    if replica is None:
+        _reads['primary'] += 1
+        return client
+    _reads['replica'] += 1
+    return replica
+
+def primary_reads() -> bool:
+    """
+    :return: True if the reads of the request go to the primaries, because the client wrote recently
+    """
+    return _primary_reads.get()
+
+def replicated(client: Redis) -> bool:
+    """
+    :return: True if the reads of the node can go to a replica
+    """
+    return client in replica_sets
+
+def replica_of(client: Redis, address: str) -> Redis | None:
+    """
+    :return: The replica of the node with this address, None if it isn't a replica of the node anymore
+    """
+    replica_set = replica_sets.get(client)
+    return replica_set.clients.get(address) if replica_set is not None else None
+
+def _seconds(value: float) -> float | str:
+    return round(value, 3) if value < math.inf else '+Inf'
+
+def replica_metrics() -> list:
+    if not replica_sets:
+        return []
+    return [('fakeapi_redis_replica_staleness_seconds', 'gauge',
+             'Age of the newest write of the primary a replica is known to have, +Inf until measured',
+             [(f'node="{replica_set.primary.node}",replica="{address}"', _seconds(replica_set.staleness(address)))
+              for replica_set in replica_sets.values() for address in replica_set.clients]),
+            ('fakeapi_redis_reads_total', 'counter', 'Reads of the GET routes by target',
+             [(f'target="{target}"', count) for target, count in _reads.items()])]
+
+
+metrics.add_collector(replica_metrics)
+
+def _wrote_recently(scope) -> bool:
+    for name, value in scope['headers']:
+        if name == b'cookie':
+            try:
+                written = float(cookie_parser(value.decode('latin-1')).get(WRITE_COOKIE, '0'))
+            except ValueError:
+                return False
+            return time.time() - written < REDIS_READ_YOUR_WRITES
+    return False
+
+class ReadYourWritesMiddleware:
+    """
+    ASGI middleware that marks the clients that wrote with a cookie, and sends their reads to the primaries for
+    REDIS_READ_YOUR_WRITES seconds.
+        app.add_middleware(ReadYourWritesMiddleware)
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not replica_sets or REDIS_READ_YOUR_WRITES <= 0:
+            await self.app(scope, receive, send)
+            return
+        if scope['method'] in WRITE_METHODS:
+            async def send_cookie(message):
+                if message['type'] == 'http.response.start' and message['status'] < 400:
+                    MutableHeaders(scope=message).append(
+                        'Set-Cookie', f'{WRITE_COOKIE}={time.time():.3f}; Max-Age={math.ceil(REDIS_READ_YOUR_WRITES)}; '
+                                      'Path=/; HttpOnly; SameSite=Lax')
+                await send(message)
+
+            await self.app(scope, receive, send_cookie)
+            return
+        # the streamed responses are read by a task created in this context, they see the same value
+        token = _primary_reads.set(_wrote_recently(scope))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _primary_reads.reset(token)
+
+_watcher: asyncio.Task | None = None
+
+async def _watch() -> None:
+    while True:
+        for replica_set in replica_sets.values():
+            try:
+                await replica_set.measure()
+            except (exceptions.RedisError, KeyError, ValueError) as e:
+                if not replica_set.failing:
+                    logger.warning('Lag of the replicas of Redis database %s not measured: %s',
+                                   replica_set.primary.node, e)
+                replica_set.failing = True
+            else:
+                if replica_set.failing:
+                    logger.info('Lag of the replicas of Redis database %s measured again', replica_set.primary.node)
+                replica_set.failing = False
+        await asyncio.sleep(REDIS_REPLICA_CHECK_INTERVAL)
+
+async def close(client: Redis) -> None:
+    await client.breaker.stop()
+    await client.close()
+    await client.connection_pool.disconnect()
+
+async def start() -> None:
+    """
+    Starts the task that measures the lag of the replicas every REDIS_REPLICA_CHECK_INTERVAL seconds, if a
+    node has replicas. Until their first measure, the replicas aren't read.
+    """
+    global _watcher
+    if replica_sets and _watcher is None:
+        _watcher = asyncio.create_task(_watch())
+        logger.info('Reads routed to the replicas of %d Redis node(s), max lag %ss, read-your-writes %ss',
+                    len(replica_sets), REDIS_READ_MAX_LAG, REDIS_READ_YOUR_WRITES)
+
+async def stop() -> None:
+    """
+    Stops the task and closes the connections to the replicas.
+    """
+    global _watcher
+    if _watcher is not None:
+        _watcher.cancel()
+        try:
+            await _watcher
+        except asyncio.CancelledError:
+            pass
+        _watcher = None
+    for replica_set in replica_sets.values():
+        for client in replica_set.clients.values():
+            await close(client)
@@ -0,0 +1,48 @@
+# app/responses.py
+"""
+JSON responses serialized with orjson, the default response class of the app.
+
+orjson serializes dict, list, str, int, float, Enum, UUID and datetime natively. Pydantic models (Item, UserSchema,
+...) are converted with .dict() by default(). A route that returns a FastJSONResponse skips the jsonable_encoder()
+pass FastAPI does on every other return value, use it on the routes that return a lot of data.
+
+If orjson isn't installed, the standard library json module is used.
+    pip3 install orjson
+"""
+import json
+from enum import Enum
+from uuid import UUID
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from app.logs import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    logger.warning('orjson is not installed, responses are serialized with the json module')
+
+def default(obj):
+    """
+    Converts the objects orjson doesn't know about.
+    """
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    # only needed by the json module, orjson handles them natively
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, UUID):
+        return str(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+def dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content, default=default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, default=default, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
+class FastJSONResponse(JSONResponse):
+    """
+    app = FastAPI(default_response_class=FastJSONResponse)
+    """
+    def render(self, content) -> bytes:
+        return dumps(content)
@@ -0,0 +1,312 @@
+# app/scripts.py
+"""
+Lua scripts executed by Redis. A script runs atomically, so a check and a write done in the same script can't race
+with another client, and it costs a single round trip.
+
+The scripts are loaded with SCRIPT LOAD when the app starts and are called by their SHA1 with EVALSHA. If Redis
+was restarted or flushed its script cache, the script is loaded again and the call is retried.
+
+With many Redis nodes, the keys of a call must all be on the node the script runs on, see app/storage.py.
+"""
+from hashlib import sha1
+from redis import exceptions
+from app.redis_db import Redis, redis, shards
+from app.logs import logger
+
+class Script:
+    def __init__(self, name: str, lua: str):
+        self.name = name
+        self.lua = lua
+        self.sha = sha1(lua.encode('utf-8')).hexdigest()
+
+
+# Indexes of the items, kept in sorted sets where the score is the price and the member the ID:
+#   'index:price' holds every item, 'index:category:<category>' the items of a category.
+# The scripts that write an item update its indexes in the same call, an index is never out of sync with the items.
+# KEYS[n] is 'index:price', the key of a category is built from its name.
+INDEX = """
+local function index_item(key, id, price, category, old_category)
+    if old_category and old_category ~= category then
+        redis.call('ZREM', 'index:category:' .. old_category, id)
+    end
+    redis.call('ZADD', key, price, id)
+    redis.call('ZADD', 'index:category:' .. category, price, id)
+end
+local function unindex_item(key, id, category)
+    redis.call('ZREM', key, id)
+    if category then
+        redis.call('ZREM', 'index:category:' .. category, id)
+    end
+end
+"""
+
+# Version of the items, the time of the last write in microseconds. It grows with every write of an item and it's
+# never reused, even by an item deleted and created again, so it can be used as a strong ETag.
+# A condition is the list of versions of an If-Match header, like ' 123 456 ', '*' or '' when there's no header.
+# An item written before the versions existed has the version 0.
+VERSION = """
+local function next_version(version)
+    local now = redis.call('TIME')
+    return string.format('%.0f', math.max(now[1] * 1000000 + now[2], (tonumber(version) or 0) + 1))
+end
+local function matches(condition, version)
+    return condition == '' or condition == '*' or string.find(condition, ' ' .. (version or '0') .. ' ', 1, true)
+end
+"""
+
+# KEYS[1]: item key, KEYS[2]: price index - ARGV: field1, value1, field2, value2, ...
+# Returns the version of the item if it was created, 0 if it already exists
+CREATE_ITEM = Script('create_item', INDEX + VERSION + """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+for i = 1, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+local version = next_version(false)
+redis.call('HSET', KEYS[1], 'version', version)
+local item = redis.call('HMGET', KEYS[1], 'id', 'price', 'category')
+index_item(KEYS[2], item[1], item[2], item[3], false)
+return tonumber(version)
+""")
+
+# KEYS[1]: item key, KEYS[2]: price index - ARGV[1]: condition, ARGV[2...]: field1, value1, field2, value2, ...
+# Returns -1 if the item doesn't exist, -2 if the condition is false, otherwise the new version of the item
+UPDATE_ITEM = Script('update_item', INDEX + VERSION + """
+local old = redis.call('HMGET', KEYS[1], 'id', 'category', 'version')
+if not old[1] then
+    return -1
+end
+if not matches(ARGV[1], old[3]) then
+    return -2
+end
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+local version = next_version(old[3])
+redis.call('HSET', KEYS[1], 'version', version)
+local item = redis.call('HMGET', KEYS[1], 'id', 'price', 'category')
+index_item(KEYS[2], item[1], item[2], item[3], old[2])
+return tonumber(version)
+""")
+
+# KEYS[1]: item key, KEYS[2]: price index - ARGV[1]: id, ARGV[2]: condition
+# Returns 1 if the item was deleted, 0 if it doesn't exist, -2 if the condition is false
+DELETE_ITEM = Script('delete_item', INDEX + VERSION + """
+local item = redis.call('HMGET', KEYS[1], 'category', 'version')
+if item[1] and not matches(ARGV[2], item[2]) then
+    return -2
+end
+unindex_item(KEYS[2], ARGV[1], item[1])
+return redis.call('UNLINK', KEYS[1])
+""")
+
+# Scripts of the 'bucket' encoding, see app/storage.py. An item is the field '<id>' of the hash 'items:<bucket>' and
+# its value is 'v<version>|price|quantity|category|description'. The description is last, it's the only one that
+# can hold a '|'.
+# Until it's migrated, an item can still be in its legacy hash 'item:<id>'.
+PACKED = """
+local function unpack_item(value)
+    local item = {}
+    item.version, item.price, item.quantity, item.category, item.description =
+        string.match(value, '^v(%d+)|([^|]*)|([^|]*)|([^|]*)|(.*)$')
+    return item
+end
+local function pack_item(item)
+    return 'v' .. item.version .. '|' .. item.price .. '|' .. item.quantity .. '|' .. item.category .. '|' ..
+        item.description
+end
+local function read_legacy(key)
+    local legacy = redis.call('HMGET', key, 'price', 'quantity', 'category', 'description', 'version')
+    if not legacy[1] then
+        return nil
+    end
+    return {price = legacy[1], quantity = legacy[2], category = legacy[3], description = legacy[4],
+            version = legacy[5] or '0'}
+end
+"""
+
+# KEYS[1]: bucket, KEYS[2]: legacy key, KEYS[3]: price index - ARGV[1]: id, ARGV[2]: packed item, its version
+# is replaced by a new one
+# Returns the version of the item if it was created, 0 if it already exists
+CREATE_PACKED = Script('create_packed', INDEX + VERSION + PACKED + """
+if redis.call('EXISTS', KEYS[2]) == 1 or redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return 0
+end
+local item = unpack_item(ARGV[2])
+item.version = next_version(false)
+redis.call('HSET', KEYS[1], ARGV[1], pack_item(item))
+index_item(KEYS[3], ARGV[1], item.price, item.category, false)
+return tonumber(item.version)
+""")
+
+# KEYS[1]: bucket, KEYS[2]: legacy key, KEYS[3]: price index - ARGV[1]: id, ARGV[2]: condition,
+# ARGV[3...]: field1, value1, ...
+# Returns -1 if the item doesn't exist, -2 if the condition is false, otherwise the new version of the item.
+# An item still in its legacy hash is migrated first.
+UPDATE_PACKED = Script('update_packed', INDEX + VERSION + PACKED + """
+local item
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if value then
+    item = unpack_item(value)
+else
+    item = read_legacy(KEYS[2])
+    if not item then
+        return -1
+    end
+end
+if not matches(ARGV[2], item.version) then
+    return -2
+end
+local old_category = item.category
+for i = 3, #ARGV, 2 do
+    if item[ARGV[i]] and ARGV[i] ~= 'version' then
+        item[ARGV[i]] = ARGV[i + 1]
+    end
+end
+item.version = next_version(item.version)
+redis.call('HSET', KEYS[1], ARGV[1], pack_item(item))
+redis.call('DEL', KEYS[2])
+index_item(KEYS[3], ARGV[1], item.price, item.category, old_category)
+return tonumber(item.version)
+""")
+
+# KEYS[1]: bucket, KEYS[2]: legacy key, KEYS[3]: price index - ARGV[1]: id, ARGV[2]: condition
+# Returns 1 if the item was deleted, 0 if it doesn't exist, -2 if the condition is false
+DELETE_PACKED = Script('delete_packed', INDEX + VERSION + PACKED + """
+local item
+local value = redis.call('HGET', KEYS[1], ARGV[1])
+if value then
+    item = unpack_item(value)
+else
+    item = read_legacy(KEYS[2])
+end
+if item and not matches(ARGV[2], item.version) then
+    return -2
+end
+unindex_item(KEYS[3], ARGV[1], item and item.category)
+return redis.call('HDEL', KEYS[1], ARGV[1]) + redis.call('UNLINK', KEYS[2])
+""")
+
+# KEYS[1]: legacy key, KEYS[2]: bucket - ARGV[1]: id
+# Returns 1 if the item was moved to its bucket, 0 if the legacy hash doesn't exist
+MIGRATE_ITEM = Script('migrate_item', PACKED + """
+local item = read_legacy(KEYS[1])
+if not item then
+    return 0
+end
+redis.call('HSETNX', KEYS[2], ARGV[1], pack_item(item))
+redis.call('DEL', KEYS[1])
+return 1
+""")
+
+# KEYS[1]: index - ARGV[1]: min price, ARGV[2]: max price, ARGV[3]: count,
+# ARGV[4], ARGV[5]: price and ID of the last item of the previous page, empty strings for the first page
+# Returns id1, price1, id2, price2, ... in the order of the index: by price, then by ID as a string.
+# The position of the last item is found with ZRANK, so a page costs O(log N + count) however deep it is.
+QUERY_INDEX = Script('query_index', """
+local start = redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. ARGV[1])
+if ARGV[5] ~= '' then
+    local after
+    local score = redis.call('ZSCORE', KEYS[1], ARGV[5])
+    if score and tonumber(score) == tonumber(ARGV[4]) then
+        after = redis.call('ZRANK', KEYS[1], ARGV[5]) + 1
+    else
+        -- the last item was deleted or its price changed, it's placed where it was in the index
+        after = redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. ARGV[4])
+        for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[4], ARGV[4])) do
+            if id <= ARGV[5] then
+                after = after + 1
+            end
+        end
+    end
+    start = math.max(start, after)
+end
+local page = redis.call('ZRANGE', KEYS[1], start, start + tonumber(ARGV[3]) - 1, 'WITHSCORES')
+local max = tonumber(ARGV[2]) or math.huge
+local result = {}
+for i = 1, #page, 2 do
+    if tonumber(page[i + 1]) > max then
+        break
+    end
+    result[#result + 1] = page[i]
+    result[#result + 1] = page[i + 1]
+end
+return result
+""")
+
+# Record of an idempotency key, see app/idempotency.py. The request that runs the route holds the key with its pending
+# record, the response is saved, or the key released, only if the key still holds that record: if it expired while
+# the route was running, another request may have taken it.
+# KEYS[1]: idempotency key - ARGV[1]: pending record, ARGV[2]: response record, ARGV[3]: TTL in seconds
+# Returns 1 if the response was saved, 0 if the key was lost
+SAVE_RESPONSE = Script('save_response', """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+return 1
+""")
+
+# KEYS[1]: idempotency key - ARGV[1]: pending record
+# Returns 1 if the key was released, 0 if it was lost
+RELEASE_KEY = Script('release_key', """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+return redis.call('DEL', KEYS[1])
+""")
+
+SCRIPTS = [CREATE_ITEM, UPDATE_ITEM, DELETE_ITEM, CREATE_PACKED, UPDATE_PACKED, DELETE_PACKED, MIGRATE_ITEM,
+           QUERY_INDEX, SAVE_RESPONSE, RELEASE_KEY]
+
+def hash_args(mapping: dict) -> list:
+    """
+    Flattens a dict to the list field1, value1, field2, value2, ... passed as ARGV to the scripts.
+    """
+    args = []
+    for field, value in mapping.items():
+        args += [field, value]
+    return args
+
+async def load_scripts() -> None:
+    """
+    Loads all the scripts in the script cache of every Redis node, so the first writes don't pay a NOSCRIPT round
+    trip. A node that fails is only logged, run() loads the scripts again when Redis doesn't know them.
+    """
+    for client in shards:
+        try:
+            for script in SCRIPTS:
+                await client.script_load(script.lua)
+        except exceptions.RedisError as e:
+            logger.error('Lua scripts not loaded on %s: %s', client.node, e)
+        else:
+            logger.info('Lua scripts loaded on %s: %s', client.node, ", ".join(s.name for s in SCRIPTS))
+
+async def run(script: Script, keys: list, args: list, client: Redis = redis):
+    """
+    Runs a script with EVALSHA, loading it first if Redis doesn't know it.
+    :param client: the node that holds the keys
+    """
+    try:
+        return await client.evalsha(script.sha, len(keys), *keys, *args)
+    except exceptions.NoScriptError:
+        await client.script_load(script.lua)
+        return await client.evalsha(script.sha, len(keys), *keys, *args)
+
+async def run_pipeline(script: Script, calls: list[tuple[list, list]], client: Redis = redis) -> list:
+    """
+    Runs the same script many times in a single pipeline, one call per (keys, args).
+    If the scripts were flushed, none of the calls was executed and the whole pipeline is sent again.
+    :param client: the node that holds the keys of all the calls
+    :return: The result of each call, in order. An error is returned as an exception instance.
+    """
+    for attempt in (1, 2):
+        async with client.pipeline(transaction=False) as pipe:
+            for keys, args in calls:
+                pipe.evalsha(script.sha, len(keys), *keys, *args)
+            results = await pipe.execute(raise_on_error=False)
+        if attempt == 1 and any(isinstance(r, exceptions.NoScriptError) for r in results):
+            await client.script_load(script.lua)
+            continue
+        return results
@@ -0,0 +1,146 @@
+# app/seed.py
+"""
+Fills the database with synthetic items and users, to test at production scale.
+
+The data is generated from a seed, the same command always writes the same items and users:
+    - the items of app/definitions.py (IDs 100 to 103), then --items items with IDs from --start, in every Category
+    - --users users 'seed<n>@example.com' with the password 'Password<n>', added to FAKEAPI_USR_DATABASE
+
+The items are written with the Lua scripts of the app, so they have their version and they're indexed. They're sent
+in pipelines of --chunk items, --concurrency pipelines at a time. An item that already exists isn't changed, the
+command can be run again. The passwords are hashed by a pool of processes, one per CPU.
+
+Run it from the 'src' directory, with the same environment variables as the app:
+    python3 -m app.seed --items 1000000 --users 1000
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from passlib.hash import pbkdf2_sha256
+from app.definitions import Category, items as EXAMPLES
+from app.redis_db import close_redis
+from app.logs import logger
+import app.storage as storage
+from jwtauth.model import UserSchema, Role, USR_DATABASE
+from jwtauth.database import readJSON, writeJSON
+
+CATEGORIES = [category.value for category in Category]
+ADJECTIVES = ['Small', 'Large', 'Blue', 'Red', 'Green', 'Heavy', 'Light', 'Classic', 'Premium', 'Basic', 'Organic',
+              'Vintage', 'Compact', 'Deluxe', 'Portable', 'Spare']
+NOUNS = {'clothes': ['Jeans', 'Shirt', 'Jacket', 'Sweater', 'Scarf', 'Socks', 'Hat', 'Boots'],
+         'grocery': ['Apple', 'Bread', 'Coffee', 'Rice', 'Cheese', 'Olive Oil', 'Pasta', 'Tea'],
+         'tools': ['Hammer', 'Wrench', 'Screwdriver', 'Saw', 'Drill', 'Pliers', 'Tape Measure', 'Level'],
+         'consumables': ['Radio AM/FM', 'Battery', 'Light Bulb', 'Printer Ink', 'Filter', 'Candle', 'Glue', 'Fuse']}
+
+def make_item(rng: random.Random, item_id: int) -> dict:
+    category = rng.choice(CATEGORIES)
+    return {"id": item_id, "description": f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS[category])}',
+            "price": round(rng.uniform(0.5, 500), 2), "quantity": rng.randint(0, 1000), "category": category}
+
+async def seed_items(count: int, start: int, chunk: int, concurrency: int, seed: int) -> int:
+    """
+    :param count: number of items to generate
+    :param start: ID of the first item
+    :param chunk: number of items per pipeline
+    :param concurrency: number of pipelines sent at the same time
+    :param seed: seed of the generator
+    :return: The number of items created
+    """
+    rng = random.Random(seed)
+    created = existing = failed = written = 0
+    began = last_report = time.perf_counter()
+
+    def tally(results: list) -> None:
+        nonlocal created, existing, failed
+        for result in results:
+            if isinstance(result, Exception):
+                failed += 1
+                if failed == 1:
+                    logger.error('Item not created: %s', result)
+            elif result:
+                created += 1
+            else:
+                existing += 1
+
+    tally(await storage.create_items([item.dict() for item in EXAMPLES]))
+    pending = set()
+    for offset in range(0, count, chunk):
+        # generated in order, the same seed gives the same items whatever the concurrency
+        items = [make_item(rng, start + i) for i in range(offset, min(offset + chunk, count))]
+        if len(pending) >= concurrency:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                tally(task.result())
+        pending.add(asyncio.create_task(storage.create_items(items)))
+        written += len(items)
+        now = time.perf_counter()
+        if now - last_report >= 5:
+            last_report = now
+            logger.info('%d/%d item(s) sent, %.0f items/s', written, count, written / (now - began))
+    for task in asyncio.as_completed(pending):
+        tally(await task)
+    elapsed = time.perf_counter() - began
+    logger.info('Items done: %d created, %d already existed, %d failed in %.1fs (%.0f items/s)', created, existing,
+                failed, elapsed, (created + existing + failed) / elapsed)
+    return created
+
+def _hash_password(password: str) -> str:
+    return pbkdf2_sha256.hash(password)
+
+def seed_users(count: int, seed: int, processes: int) -> int:
+    """
+    :param count: number of users to generate
+    :param seed: seed of the generator
+    :param processes: number of processes that hash the passwords
+    :return: The number of users added to the file
+    """
+    rng = random.Random(seed)
+    users = readJSON(USR_DATABASE)
+    emails = {user.email for user in users}
+    roles = list(Role)
+    new = []
+    for n in range(1, count + 1):
+        # the generator is called for every user, the same seed gives the same users even if some already exist
+        user_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+        role = rng.choice(roles)
+        if f'seed{n}@example.com' not in emails:
+            new.append((user_id, n, role))
+    began = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        hashes = executor.map(_hash_password, [f'Password{n}' for _, n, _ in new],
+                              chunksize=max(1, len(new) // (processes * 4)))
+        users += [UserSchema(id=str(user_id), fullname=f'Seed User{n}', email=f'seed{n}@example.com',
+                             password=hashed, role=role)
+                  for (user_id, n, role), hashed in zip(new, hashes)]
+    elapsed = time.perf_counter() - began
+    if new:
+        writeJSON(USR_DATABASE, users)
+    logger.info('Users done: %d created, %d already existed in %.1fs (%.0f users/s) with %d process(es)', len(new),
+                count - len(new), elapsed, len(new) / elapsed if elapsed else 0, processes)
+    return len(new)
+
+async def main(args: argparse.Namespace) -> None:
+    try:
+        await seed_items(args.items, args.start, args.chunk, args.concurrency, args.seed)
+    finally:
+        await close_redis()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Fills the database with synthetic items and users')
+    parser.add_argument('--items', type=int, default=100_000, help='number of items to generate')
+    parser.add_argument('--start', type=int, default=1_000, help='ID of the first item generated')
+    parser.add_argument('--users', type=int, default=0, help='number of users to generate')
+    parser.add_argument('--seed', type=int, default=42, help='seed of the generator')
+    parser.add_argument('--chunk', type=int, default=5_000, help='number of items per pipeline')
+    parser.add_argument('--concurrency', type=int, default=4, help='number of pipelines sent at the same time')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1,
+                        help='number of processes that hash the passwords')
+    args = parser.parse_args()
+    if args.users:
+        seed_users(args.users, args.seed, args.processes)
+    asyncio.run(main(args))
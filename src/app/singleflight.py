@@ -0,0 +1,107 @@
+# app/singleflight.py
+"""
+Coalescing of the concurrent reads of the same item. The first request that misses the cache starts the read from
+Redis, the requests for the same item that arrive while it's in flight wait for it and get the same result. A hot
+item costs one read per round trip to Redis, whatever the number of concurrent requests.
+
+    - The read runs in its own task, a client that disconnects doesn't cancel it for the others.
+    - An error of the read, like a connection error, is raised in every request that waited for it.
+    - A write of the item forgets the read in flight: the requests that arrive after the write start a new read,
+      they can't get the item as it was before their own write.
+
+The requests that waited are counted per item for the TRACKED_KEYS most recent hot items, the TOP_KEYS that waited
+the most are in /api/cache/stats. The metrics only have the totals, a label per item ID would create a new series
+for every hot item.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+import app.metrics as metrics
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share a single call. The first caller of a key is its leader, it starts the
+    call, the callers that arrive before the end of the call are its followers.
+    """
+    TRACKED_KEYS = 1000
+    TOP_KEYS = 10
+
+    def __init__(self):
+        self._calls: dict = {}
+        self.leaders = 0
+        self.followers = 0
+        self.wait = 0.0
+        # key -> [followers, total wait, longest wait], least recently shared first
+        self._keys: OrderedDict = OrderedDict()
+
+    async def do(self, key, call):
+        """
+        :param key: the calls with the same key are coalesced
+        :param call: coroutine function, called without arguments if no call with this key is in flight
+        :return: The result of the call
+        """
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = self._calls[key] = asyncio.ensure_future(call())
+            task.add_done_callback(lambda done: self._done(key, done))
+            return await asyncio.shield(task)
+        start = time.perf_counter()
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._observe(key, time.perf_counter() - start)
+
+    def forget(self, key) -> None:
+        """
+        The call in flight for the key, if any, isn't shared with the next callers.
+        """
+        self._calls.pop(key, None)
+
+    def _done(self, key, task: asyncio.Future) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # retrieved here in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    def _observe(self, key, seconds: float) -> None:
+        self.followers += 1
+        self.wait += seconds
+        stats = self._keys.pop(key, None) or [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+        self._keys[key] = stats
+        if len(self._keys) > self.TRACKED_KEYS:
+            self._keys.popitem(last=False)
+
+    def top(self) -> list[tuple]:
+        """
+        :return: (key, followers, total wait, longest wait) of the keys that were shared the most
+        """
+        entries = sorted(((key, *stats) for key, stats in self._keys.items()), key=lambda entry: -entry[1])
+        return entries[:self.TOP_KEYS]
+
+    def stats(self) -> dict:
+        calls = self.leaders + self.followers
+        return {"in_flight": len(self._calls), "reads": self.leaders, "coalesced": self.followers,
+                "coalesced_ratio": round(self.followers / calls, 4) if calls else 0.0,
+                "wait_seconds": round(self.wait, 6),
+                "hot_items": [{"id": key[0], "primary": key[1], "coalesced": followers, "wait_seconds": round(wait, 6),
+                               "max_wait_seconds": round(longest, 6)}
+                              for key, followers, wait, longest in self.top()]}
+
+
+# key: (item ID, read from the primary), see app/replicas.py
+flights = SingleFlight()
+
+def singleflight_metrics() -> list:
+    return [('fakeapi_singleflight_reads_total', 'counter', 'Reads of an item by role, a follower waited for the '
+             'read of the leader', [('role="leader"', flights.leaders), ('role="follower"', flights.followers)]),
+            ('fakeapi_singleflight_in_flight', 'gauge', 'Reads of an item in flight', [('', len(flights._calls))]),
+            ('fakeapi_singleflight_wait_seconds_total', 'counter', 'Time the followers waited for the leaders',
+             [('', round(flights.wait, 6))])]
+
+
+metrics.add_collector(singleflight_metrics)
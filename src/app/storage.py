@@ -0,0 +1,283 @@
+# app/storage.py
+"""
+Layout of the items in Redis, selected with FAKEAPI_ITEM_ENCODING. The routers only use the functions of this module,
+they don't know which keys hold an item.
+
+'hash' (default): one hash per item
+    HGETALL item:100
+'bucket': the items are packed in hashes of FAKEAPI_ITEM_BUCKET_SIZE consecutive IDs, one field per item
+    HGET items:1 100  ->  "v1697650000123456|9.99|20|tools|Hammer"
+A small hash is stored by Redis as a listpack, a few bytes per field instead of a key, a hash table and one object
+per field for every item. At tens of millions of items, it's a fraction of the memory.
+
+With 'bucket', the items still in their legacy hash 'item:<id>' are found, updated and deleted, so the app can run
+while 'python3 -m app.migrate' moves them to their bucket.
+
+An item is returned as a dict with the types of the model Item and its 'version', whatever the encoding. The version
+is written by the Lua scripts, see app/scripts.py.
+
+Both encodings keep the same indexes, sorted sets where the score is the price and the member the ID:
+    ZRANGE index:price 0 -1 WITHSCORES                  every item
+    ZRANGE index:category:tools 0 -1 WITHSCORES         the items of a category
+They're updated by the Lua scripts that write the items. The items written before the indexes existed are
+indexed with 'python3 -m app.migrate --reindex'.
+
+With many Redis nodes (REDIS_NODES), the items are sharded by bucket: the bucket number of an item, its ID
+divided by FAKEAPI_ITEM_BUCKET_SIZE, is placed on a node by the consistent hashing of app/redis_db.py. It's the same
+with both encodings, so an item and its bucket are on the same node and can be migrated by a script. Every node has
+the indexes of its own items, a query reads a page on every node and merges them. The batches are split by node and
+sent to all the nodes at the same time.
+
+The reads go to a replica of the node when there's a fresh one, see app/replicas.py. The writes go to the primary.
+"""
+import asyncio
+from app.redis_db import Redis, redis, shards, ring
+from app.replicas import reader
+from app.scripts import CREATE_ITEM, UPDATE_ITEM, DELETE_ITEM, CREATE_PACKED, UPDATE_PACKED, DELETE_PACKED, \
+    QUERY_INDEX, run, run_pipeline, hash_args
+from app.definitions import ITEM_ENCODING, ITEM_BUCKET_SIZE
+
+BUCKETS = ITEM_ENCODING == 'bucket'
+PRICE_INDEX = 'index:price'
+
+def legacy_key(item_id: int) -> str:
+    return 'item:' + str(item_id)
+
+def bucket_key(item_id: int) -> str:
+    return 'items:' + str(item_id // ITEM_BUCKET_SIZE)
+
+def category_index(category: str) -> str:
+    return 'index:category:' + category
+
+def shard_of(item_id: int) -> Redis:
+    """
+    :return: The Redis node that holds the item, in both encodings
+    """
+    return shards[ring.shard(item_id // ITEM_BUCKET_SIZE)]
+
+def shard_of_key(key: str) -> Redis:
+    """
+    :return: The Redis node of a key, the first node for the keys that don't hold items
+    """
+    kind, _, suffix = key.partition(':')
+    if kind == 'item' and suffix.isdigit():
+        return shard_of(int(suffix))
+    if kind == 'items' and suffix.isdigit():
+        return shards[ring.shard(int(suffix))]
+    return redis
+
+async def _fan_out(values: list, item_id, call) -> list:
+    """
+    Splits a batch by node and runs call(client, values) on all the nodes at the same time.
+    :param values: the batch, items or IDs
+    :param item_id: returns the ID of a value
+    :param call: coroutine function that returns a result per value
+    :return: The results of the values, in order
+    """
+    if len(shards) == 1:
+        return await call(redis, values)
+    groups: dict[Redis, list[int]] = {}
+    for i, value in enumerate(values):
+        groups.setdefault(shard_of(item_id(value)), []).append(i)
+    results = [None] * len(values)
+    fetched = await asyncio.gather(*[call(client, [values[i] for i in indexes]) for client, indexes in groups.items()])
+    for indexes, group in zip(groups.values(), fetched):
+        for i, result in zip(indexes, group):
+            results[i] = result
+    return results
+
+def pack(item: dict) -> str:
+    return f"v{item.get('version', 0)}|{item['price']}|{item['quantity']}|{item['category']}|{item['description']}"
+
+def unpack(item_id: int, value: str) -> dict:
+    # 'v<version>|price|quantity|category|description'
+    version, price, quantity, category, description = value[1:].split('|', 4)
+    return {"id": item_id, "description": description, "price": float(price), "quantity": int(quantity),
+            "category": category, "version": int(version)}
+
+def from_hash(result: dict) -> dict:
+    """
+    Converts a hash 'item:<id>', where every value is a string, to an item. An empty hash is returned as is.
+    """
+    if not result:
+        return result
+    return {"id": int(result['id']), "description": result['description'], "price": float(result['price']),
+            "quantity": int(result['quantity']), "category": result['category'],
+            "version": int(result.get('version', 0))}
+
+async def read_item(item_id: int) -> dict:
+    """
+    :param item_id: ID of the item
+    :return: The item or an empty dict if it doesn't exist
+    """
+    client = reader(shard_of(item_id))
+    if BUCKETS:
+        value = await client.hget(bucket_key(item_id), str(item_id))
+        if value is not None:
+            return unpack(item_id, value)
+    # with 'bucket', a miss can be an item not migrated yet
+    return from_hash(await client.hgetall(legacy_key(item_id)))
+
+async def read_items(item_ids: list[int]) -> list[dict]:
+    """
+    Reads many items with a single pipeline per node, two if some items aren't in their bucket.
+    :param item_ids: IDs of the items
+    :return: Each item, in order, an empty dict if it doesn't exist
+    """
+    return await _fan_out(item_ids, int, lambda client, ids: _read_items(reader(client), ids))
+
+async def _read_items(client: Redis, item_ids: list[int]) -> list[dict]:
+    if BUCKETS:
+        async with client.pipeline(transaction=False) as pipe:
+            for item_id in item_ids:
+                pipe.hget(bucket_key(item_id), str(item_id))
+            values = await pipe.execute()
+        results = [{} if value is None else unpack(item_id, value) for item_id, value in zip(item_ids, values)]
+        missing = [i for i, value in enumerate(values) if value is None]
+    else:
+        results = [{}] * len(item_ids)
+        missing = range(len(item_ids))
+    if missing:
+        async with client.pipeline(transaction=False) as pipe:
+            for i in missing:
+                pipe.hgetall(legacy_key(item_ids[i]))
+            fetched = await pipe.execute()
+        for i, result in zip(missing, fetched):
+            results[i] = from_hash(result)
+    return results
+
+async def create_item(item: dict) -> int:
+    """
+    Creates an item if its ID doesn't already exist, atomically.
+    :param item: The item, like Item.dict()
+    :return: The version of the item if it was created, 0 if it already exists
+    """
+    client = shard_of(item['id'])
+    if BUCKETS:
+        result = await run(CREATE_PACKED, [bucket_key(item['id']), legacy_key(item['id']), PRICE_INDEX],
+                           [item['id'], pack(item)], client)
+    else:
+        result = await run(CREATE_ITEM, [legacy_key(item['id']), PRICE_INDEX], hash_args(item), client)
+    return result
+
+async def create_items(items: list[dict]) -> list:
+    """
+    Same as create_item() for many items, in a single pipeline per node.
+    :return: For each item, True if created, False if it already exists or the exception raised by Redis
+    """
+    results = await _fan_out(items, lambda item: item['id'], _create_items)
+    return [result if isinstance(result, Exception) else result > 0 for result in results]
+
+async def _create_items(client: Redis, items: list[dict]) -> list:
+    if BUCKETS:
+        calls = [([bucket_key(item['id']), legacy_key(item['id']), PRICE_INDEX], [item['id'], pack(item)])
+                 for item in items]
+        return await run_pipeline(CREATE_PACKED, calls, client)
+    calls = [([legacy_key(item['id']), PRICE_INDEX], hash_args(item)) for item in items]
+    return await run_pipeline(CREATE_ITEM, calls, client)
+
+async def update_item(item_id: int, fields: dict, condition: str = '') -> int:
+    """
+    Updates some fields of an existing item, atomically.
+    :param item_id: ID of the item
+    :param fields: the fields to update and their new value
+    :param condition: versions accepted by the update, see etags.condition(). Any version if empty.
+    :return: -1 if the item doesn't exist, -2 if its version doesn't match, otherwise the new version
+    """
+    if BUCKETS:
+        return await run(UPDATE_PACKED, [bucket_key(item_id), legacy_key(item_id), PRICE_INDEX],
+                         [item_id, condition, *hash_args(fields)], shard_of(item_id))
+    return await run(UPDATE_ITEM, [legacy_key(item_id), PRICE_INDEX], [condition, *hash_args(fields)],
+                     shard_of(item_id))
+
+def _delete_call(item_id: int, condition: str) -> tuple[list, list]:
+    if BUCKETS:
+        return [bucket_key(item_id), legacy_key(item_id), PRICE_INDEX], [item_id, condition]
+    return [legacy_key(item_id), PRICE_INDEX], [item_id, condition]
+
+async def delete_items(item_ids: list[int]) -> list:
+    """
+    Deletes many items and their index entries in a single pipeline per node. The hashes are removed with UNLINK, so
+    Redis reclaims the memory in the background.
+    :return: For each item, True if it was deleted, False if it doesn't exist or the exception raised by Redis
+    """
+    results = await _fan_out(item_ids, int, lambda client, ids: run_pipeline(
+        DELETE_PACKED if BUCKETS else DELETE_ITEM, [_delete_call(item_id, '') for item_id in ids], client))
+    return [result if isinstance(result, Exception) else result > 0 for result in results]
+
+async def delete_item(item_id: int, condition: str = '') -> int:
+    """
+    :param item_id: ID of the item
+    :param condition: versions accepted by the delete, see etags.condition(). Any version if empty.
+    :return: 1 if the item was deleted, 0 if it doesn't exist, -2 if its version doesn't match
+    """
+    return await run(DELETE_PACKED if BUCKETS else DELETE_ITEM, *_delete_call(item_id, condition), shard_of(item_id))
+
+async def query_index(category: str | None, min_price: float | None, max_price: float | None, count: int,
+                      after: tuple[str, str] | None = None) -> list[tuple[int, str]]:
+    """
+    Reads a page of an index, ordered by price then by ID. With many nodes, a page is read on every node and the
+    first count entries of the merge are returned.
+    :param category: only the items of this category, all the items if None
+    :param min_price: lowest price, inclusive
+    :param max_price: highest price, inclusive
+    :param count: maximum number of items returned
+    :param after: (price, ID) of the last item of the previous page, as returned by the previous call
+    :return: (ID, price) of each item, the price is the score as returned by Redis
+    """
+    key = PRICE_INDEX if category is None else category_index(category)
+    last_price, last_id = after or ('', '')
+    args = ['-inf' if min_price is None else min_price, '+inf' if max_price is None else max_price, count,
+            last_price, last_id]
+    pages = await asyncio.gather(*[run(QUERY_INDEX, [key], args, reader(client)) for client in shards])
+    entries = [(item_id, price) for result in pages for item_id, price in zip(result[::2], result[1::2])]
+    if len(pages) > 1:
+        # the order of a sorted set: the score, then the member as a string
+        entries.sort(key=lambda entry: (float(entry[1]), entry[0]))
+    return [(int(item_id), price) for item_id, price in entries[:count]]
+
+async def scan_items(count: int):
+    """
+    Yields all the items, one SCAN at a time, with the hashes found by each SCAN read in a single pipeline. Only one
+    page is in memory, the next SCAN is sent when the caller asks for the next page. The nodes are scanned one after
+    the other.
+    Like SCAN, an item can be returned twice, and an item moved to its bucket during the scan can be missed.
+    :param count: number of keys examined by each SCAN
+    :return: A list of items per SCAN, possibly empty
+    """
+    for client in shards:
+        async for items in scan_shard(reader(client), count):
+            yield items
+
+async def scan_shard(client: Redis, count: int):
+    """
+    Same as scan_items() for the items of a single node.
+    """
+    cursor = None
+    while cursor != 0:
+        cursor, keys = await client.scan(cursor or 0, match='item*:*', count=count, _type='hash')
+        keys = [key for key in keys if key.partition(':')[0] in ('item', 'items')]
+        async with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            hashes = await pipe.execute()
+        items = []
+        for key, result in zip(keys, hashes):
+            if key.startswith('items:'):
+                items += [unpack(int(item_id), value) for item_id, value in result.items()]
+            elif result:
+                items.append(from_hash(result))
+        yield items
+
+def item_ids_of(key: str, fields: list) -> list[int]:
+    """
+    The IDs of the items held by a Redis key, used to invalidate the cache when a key is deleted directly.
+    :param key: Redis key
+    :param fields: fields of the hash
+    """
+    kind, _, suffix = key.partition(':')
+    if kind == 'item' and suffix.isdigit():
+        return [int(suffix)]
+    if kind == 'items' and suffix.isdigit():
+        return [int(field) for field in fields if field.isdigit()]
+    return []
@@ -0,0 +1,327 @@
+# benchmark.py
+"""
+In-process benchmark of the endpoints of every router. The requests go through the whole app (middlewares,
+validation, serialization, Redis) with an ASGI client, without a network or a server in between.
+
+By default Redis is replaced by fakeredis, an in-memory stand-in, so the numbers measure the Python side of a
+request. Use '--redis server' to run against REDIS_HOSTNAME:REDIS_PORT, the items and keys created are deleted at
+the end. Needs:
+    pip3 install -r requirements-dev.txt
+
+Run it from the 'src' directory:
+    python3 benchmark.py                                    # print the results
+    python3 benchmark.py --only get,post -n 5000 -c 50      # some routers, 5000 requests, 50 concurrent
+    python3 benchmark.py --save baseline.json               # save the results as a baseline
+    python3 benchmark.py --compare baseline.json            # flag the regressions of more than 10%
+
+With --compare, an endpoint is a regression if its p95 or p99 is higher, or its throughput lower, by more than
+--threshold percent. The exit code is 1 if there's at least one regression.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+# IDs used by the benchmark, far from the IDs of the examples
+SEED_BASE = 1_000_000     # items read and updated
+SEED_COUNT = 1_000
+CREATE_BASE = 2_000_000   # items created by POST, deleted by DELETE
+BATCH_BASE = 3_000_000    # items created by POST batch, deleted by DELETE batch
+BATCH_SIZE = 100
+KEY_PREFIX = 'benchmark:key:'
+EMAIL = 'benchmark@example.com'
+PASSWORD = 'Benchmark1'
+
+# copy of the user database the benchmark writes to, see use_temporary_users()
+_users = None
+
+class Case:
+    """
+    An endpoint to benchmark. 'url' and 'body' are called with the number of the request, so each request can work
+    on its own item. 'weight' scales the number of requests, for the endpoints that hash a password.
+    """
+    def __init__(self, router: str, name: str, method: str, url, body=None, expect: int = 200,
+                 weight: float = 1.0):
+        self.router = router
+        self.name = name
+        self.method = method
+        self.url = url if callable(url) else lambda i, url=url: url
+        self.body = body
+        self.expect = expect
+        self.weight = weight
+
+    @property
+    def key(self) -> str:
+        return f'{self.router} {self.name}'
+
+
+def item(item_id: int, price: float = 9.99) -> dict:
+    return {"id": item_id, "description": "Benchmark item", "price": price, "quantity": 10, "category": "tools"}
+
+def seed_id(i: int) -> int:
+    return SEED_BASE + i % SEED_COUNT
+
+# The order matters: the items created by POST are deleted by DELETE
+CASES = [
+    Case('get', 'item by id', 'GET', lambda i: f'/api/item/{seed_id(i)}'),
+    Case('get', 'item by id and price (path)', 'GET', lambda i: f'/api/item/price/{seed_id(i)}/9.99'),
+    Case('get', 'item by id and price (query)', 'GET',
+         lambda i: f'/api/item/0/price?item_id={seed_id(i)}&price=9.99'),
+    Case('get', 'item by id and price (body)', 'GET', '/api/item/1/price',
+         body=lambda i: {"item_id": seed_id(i), "price": 9.99}),
+    Case('get', f'batch of {BATCH_SIZE}', 'GET', '/api/items/batch',
+         body=lambda i: {"item_ids": [seed_id(i * BATCH_SIZE + k) for k in range(BATCH_SIZE)]}),
+    Case('get', 'missing item', 'GET', lambda i: f'/api/item/{CREATE_BASE - 1 - i}', expect=404),
+    Case('get', 'items by category and price', 'GET', '/api/items?category=tools&max_price=10&count=100'),
+    Case('post', 'item', 'POST', '/api/item', body=lambda i: item(CREATE_BASE + i), expect=201),
+    Case('post', f'batch of {BATCH_SIZE}', 'POST', '/api/items/batch',
+         body=lambda i: [item(BATCH_BASE + i * BATCH_SIZE + k) for k in range(BATCH_SIZE)]),
+    Case('put', 'item', 'PUT', '/api/item/id', body=lambda i: item(seed_id(i))),
+    Case('patch', 'price', 'PATCH', '/api/item/id/price', body=lambda i: {"item_id": seed_id(i), "price": 9.99}),
+    Case('patch', 'quantity', 'PATCH', '/api/item/id/quantity',
+         body=lambda i: {"item_id": seed_id(i), "quantity": 10}),
+    Case('delete', 'item', 'DELETE', '/api/delete/id/', body=lambda i: {"item_id": CREATE_BASE + i}),
+    Case('delete', f'batch of {BATCH_SIZE}', 'DELETE', '/api/items/batch',
+         body=lambda i: {"item_ids": [BATCH_BASE + i * BATCH_SIZE + k for k in range(BATCH_SIZE)]}),
+    Case('head', 'root', 'HEAD', '/'),
+    Case('head', 'item', 'HEAD', lambda i: f'/api/item/{seed_id(i)}'),
+    Case('options', 'item', 'OPTIONS', '/api/item', expect=204),
+    Case('trace', 'item', 'TRACE', '/api/item'),
+    Case('users', 'all users', 'GET', '/api/users'),
+    Case('users', 'user by email', 'GET', '/api/user/email', body=lambda i: {"email": EMAIL}),
+    Case('users', 'validate password', 'GET', '/api/user/validate',
+         body=lambda i: {"email": EMAIL, "password": PASSWORD}, weight=0.1),
+    Case('users', 'token', 'POST', '/api/user/token', body=lambda i: {"email": EMAIL, "password": PASSWORD},
+         weight=0.1),
+    Case('users', 'signup', 'POST', '/api/user/signup', expect=201, weight=0.02,
+         body=lambda i: {"fullname": "Benchmark", "email": f"benchmark{i}@example.com", "password": PASSWORD,
+                         "role": "admin"}),
+    Case('users', 'hashing stats', 'GET', '/api/users/hashing'),
+    Case('redis_db', 'hit counter', 'GET', '/redis'),
+    Case('redis_db', 'keys', 'GET', f'/api/redis/keys?match={KEY_PREFIX}*&count=100'),
+    Case('redis_db', 'delete key', 'DELETE', lambda i: f'/api/redis/key/{KEY_PREFIX}{i}'),
+    Case('cache', 'stats', 'GET', '/api/cache/stats'),
+    Case('metrics', 'scrape', 'GET', '/metrics'),
+]
+
+def percentile(latencies: list[float], p: float) -> float:
+    # nearest rank, latencies are sorted
+    return latencies[min(len(latencies) - 1, max(0, round(p / 100 * len(latencies)) - 1))]
+
+def use_fakeredis() -> None:
+    """
+    Replaces the connections of the Redis pools by connections to in-memory fakeredis servers, one per node.
+    """
+    import fakeredis
+    from fakeredis.aioredis import FakeConnection
+    import app.redis_db as redis_db
+
+    scripts = {}
+
+    class Connection(FakeConnection):
+        async def _connect(self):
+            await super()._connect()
+            # fakeredis keeps the scripts per connection, Redis keeps them per server
+            self._sock.script_cache = scripts
+
+    for client in redis_db.shards:
+        client.connection_pool.connection_class = Connection
+        client.connection_pool.connection_kwargs['server'] = fakeredis.FakeServer()
+
+def use_temporary_users() -> str:
+    """
+    Points FAKEAPI_USR_DATABASE to a copy of the user database in a temporary directory, so the users created by the
+    benchmark are never written to the real file. jwtauth reads the variable when it's imported, it must be called
+    before the app is imported.
+    :return: The path of the copy
+    """
+    global _users
+    if 'jwtauth.model' in sys.modules:
+        raise RuntimeError('The user database must be replaced before the app is imported')
+    _users = os.path.join(tempfile.mkdtemp(prefix='fakeapi-benchmark-'), 'users.json')
+    if os.path.exists(os.getenv('FAKEAPI_USR_DATABASE', 'users.json')):
+        shutil.copyfile(os.getenv('FAKEAPI_USR_DATABASE', 'users.json'), _users)
+    os.environ['FAKEAPI_USR_DATABASE'] = _users
+    return _users
+
+async def setup(client, requests: int) -> dict:
+    """
+    Creates the items, keys and user the cases work on, for the measured requests and the warmup.
+    :return: The headers of every request, with a token if the write routes require one
+    """
+    from app.redis_db import redis
+    import app.storage as storage
+
+    results = await storage.create_items([item(item_id) for item_id in range(SEED_BASE, SEED_BASE + SEED_COUNT)])
+    if not all(result is True for result in results):
+        logging.warning('Some items of the benchmark already exist')
+    async with redis.pipeline(transaction=False) as pipe:
+        for i in range(requests + warmup(requests)):
+            pipe.hset(KEY_PREFIX + str(i), mapping={"value": i})
+        await pipe.execute()
+    await client.post('/api/user/signup', json={"fullname": "Benchmark", "email": EMAIL, "password": PASSWORD,
+                                                "role": "admin"})
+    response = await client.post('/api/user/token', json={"email": EMAIL, "password": PASSWORD})
+    if response.status_code != 200:
+        return {}
+    return {"Authorization": f'Bearer {response.json()["access_token"]}'}
+
+async def cleanup(requests: int) -> None:
+    from app.redis_db import redis
+    import app.storage as storage
+
+    requests += warmup(requests)
+    item_ids = list(range(SEED_BASE, SEED_BASE + SEED_COUNT)) + list(range(CREATE_BASE, CREATE_BASE + requests)) + \
+        list(range(BATCH_BASE, BATCH_BASE + requests * BATCH_SIZE))
+    for start in range(0, len(item_ids), 10_000):
+        for result in await storage.delete_items(item_ids[start:start + 10_000]):
+            if isinstance(result, Exception):
+                raise result
+    async with redis.pipeline(transaction=False) as pipe:
+        for i in range(requests):
+            pipe.unlink(KEY_PREFIX + str(i))
+        await pipe.execute()
+
+def warmup(requests: int) -> int:
+    return max(1, requests // 10)
+
+async def run_case(client, case: Case, requests: int, concurrency: int, headers: dict, offset: int = 0) -> dict:
+    """
+    Sends the requests offset to offset + requests - 1 of a case.
+    :return: The throughput and the latency percentiles
+    """
+    latencies = []
+    errors = 0
+    next_request = 0
+
+    async def worker():
+        nonlocal next_request, errors
+        while next_request < requests:
+            i = offset + next_request
+            next_request += 1
+            body = case.body(i) if case.body else None
+            start = time.perf_counter()
+            response = await client.request(case.method, case.url(i), json=body, headers=headers)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code != case.expect:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(min(concurrency, requests))))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"router": case.router, "endpoint": case.name, "requests": requests, "errors": errors,
+            "rps": round(requests / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3)}
+
+async def benchmark(args) -> dict:
+    import httpx
+    from main import create_app
+    from jwtauth.model import USR_DATABASE
+
+    if _users is None or USR_DATABASE != _users:
+        raise RuntimeError('Call use_temporary_users() first, the benchmark would write to the real user database')
+    if args.redis == 'fake':
+        use_fakeredis()
+    app = create_app()
+    cases = [case for case in CASES if not args.only or case.router in args.only]
+    results = {}
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as client:
+            headers = await setup(client, args.requests)
+            try:
+                for case in cases:
+                    requests = max(1, int(args.requests * case.weight))
+                    # the warmup works on its own items, after the ones of the measured requests
+                    await run_case(client, case, warmup(requests), args.concurrency, headers, offset=requests)
+                    result = await run_case(client, case, requests, args.concurrency, headers)
+                    results[case.key] = result
+                    print_result(result)
+            finally:
+                if args.redis == 'server':
+                    await cleanup(args.requests)
+    return results
+
+def print_header() -> None:
+    print(f'{"router":<9} {"endpoint":<30} {"requests":>8} {"errors":>6} {"req/s":>9} '
+          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+
+def print_result(result: dict) -> None:
+    print(f'{result["router"]:<9} {result["endpoint"]:<30} {result["requests"]:>8} {result["errors"]:>6} '
+          f'{result["rps"]:>9} {result["p50_ms"]:>8} {result["p95_ms"]:>8} {result["p99_ms"]:>8}')
+
+def compare(baseline: dict, results: dict, threshold: float) -> int:
+    """
+    Prints the change of each endpoint against the baseline.
+    :return: The number of regressions
+    """
+    regressions = 0
+    print(f'\nCompared to the baseline of {baseline["meta"]["date"]} (threshold {threshold}%)')
+    print(f'{"endpoint":<40} {"req/s":>9} {"p50":>9} {"p95":>9} {"p99":>9}')
+    for key, result in results.items():
+        before = baseline['results'].get(key)
+        if before is None:
+            print(f'{key:<40} {"new":>9}')
+            continue
+        change = {metric: (result[metric] - before[metric]) / before[metric] * 100 if before[metric] else 0.0
+                  for metric in ('rps', 'p50_ms', 'p95_ms', 'p99_ms')}
+        regression = change['rps'] < -threshold or change['p95_ms'] > threshold or change['p99_ms'] > threshold
+        regressions += regression
+        print(f'{key:<40} {change["rps"]:>+8.1f}% {change["p50_ms"]:>+8.1f}% {change["p95_ms"]:>+8.1f}% '
+              f'{change["p99_ms"]:>+8.1f}%{"  REGRESSION" if regression else ""}')
+    return regressions
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='In-process benchmark of the FakeAPI endpoints')
+    parser.add_argument('-n', '--requests', type=int, default=1000, help='number of requests per endpoint')
+    parser.add_argument('-c', '--concurrency', type=int, default=10, help='number of concurrent requests')
+    parser.add_argument('--only', type=lambda s: s.split(','), help='comma separated list of routers')
+    parser.add_argument('--redis', choices=('fake', 'server'), default='fake',
+                        help='fakeredis in memory, or the server at REDIS_HOSTNAME:REDIS_PORT')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results to a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=10.0, help='regression threshold, in percent')
+    parser.add_argument('--log-level', default='warning', help='log level of the app during the benchmark')
+    args = parser.parse_args()
+
+    users = use_temporary_users()
+    os.environ.setdefault('FAKEAPI_JWT_SECRET', 'benchmark')
+
+    import app.logs
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    print_header()
+    try:
+        results = asyncio.run(benchmark(args))
+    finally:
+        shutil.rmtree(os.path.dirname(users))
+
+    if args.save:
+        import app.storage as storage
+        meta = {"date": datetime.now(timezone.utc).isoformat(timespec='seconds'), "hostname": platform.node(),
+                "python": platform.python_version(), "redis": args.redis, "item_encoding": storage.ITEM_ENCODING,
+                "requests": args.requests, "concurrency": args.concurrency}
+        with open(args.save, 'w', encoding='utf-8') as baseline:
+            json.dump({"meta": meta, "results": results}, baseline, indent=3)
+        print(f'\nResults saved to "{args.save}"')
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as baseline:
+            regressions = compare(json.load(baseline), results, args.threshold)
+        if regressions:
+            print(f'\n{regressions} regression(s)')
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+# jwtauth/auth.py
+"""
+Issuance and verification of JSON Web Tokens.
+
+A token is issued by POST /api/user/token and sent back in the header 'Authorization: Bearer <token>'.
+Verifying the signature of a token on every request is expensive, especially with RS256/ES256. A verified token
+is kept in an LRU, keyed by the SHA-256 of the token, until it expires. A token that fails the verification
+is never cached.
+"""
+import secrets
+import time
+from collections import OrderedDict
+from hashlib import sha256
+import jwt
+from fastapi import Depends, HTTPException, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from jwtauth.model import UserSchema, JWT_ALGORITHM, JWT_SECRET, JWT_PRIVATE_KEY, JWT_CERTIFICATE, \
+    JWT_EXPIRATION, JWT_CACHE_SIZE, JWT_REQUIRED, WORKERS
+from app.logs import logger
+
+def _load_keys() -> tuple:
+    """
+    A random secret is only known by the worker that generated it: with more than one worker, a token would be
+    rejected by the others, so FAKEAPI_JWT_SECRET is required.
+    :return: The key to sign and the key to verify the tokens
+    """
+    if JWT_ALGORITHM == 'HS256':
+        if JWT_SECRET:
+            return JWT_SECRET, JWT_SECRET
+        if WORKERS > 1:
+            raise RuntimeError(f'FAKEAPI_JWT_SECRET is required with FAKEAPI_WORKERS={WORKERS}, '
+                               f'the workers must share the secret of the tokens')
+        logger.warning('FAKEAPI_JWT_SECRET not set, a random secret is generated')
+        secret = secrets.token_urlsafe(32)
+        return secret, secret
+    if JWT_ALGORITHM in ('RS256', 'ES256'):
+        # 'cryptography' is only needed for the asymmetric algorithms
+        from cryptography import x509
+        with open(JWT_PRIVATE_KEY, 'r', encoding='utf-8') as f:
+            private_key = f.read()
+        with open(JWT_CERTIFICATE, 'rb') as f:
+            public_key = x509.load_pem_x509_certificate(f.read()).public_key()
+        return private_key, public_key
+    raise ValueError(f'Unsupported JWT algorithm: {JWT_ALGORITHM}')
+
+
+_signing_key, _verifying_key = _load_keys()
+
+class TokenCache:
+    """
+    LRU of the claims of verified tokens. An entry is dropped when it's read after the expiration of its token.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        self._entries: OrderedDict[bytes, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest: bytes) -> dict | None:
+        claims = self._entries.get(digest)
+        if claims is None:
+            self.misses += 1
+            return None
+        if claims['exp'] <= time.time():
+            del self._entries[digest]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(digest)
+        self.hits += 1
+        return claims
+
+    def put(self, digest: bytes, claims: dict) -> None:
+        if self.size <= 0:
+            return
+        self._entries[digest] = claims
+        self._entries.move_to_end(digest)
+        if len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+token_cache = TokenCache(JWT_CACHE_SIZE)
+
+def issue_token(user: UserSchema) -> tuple[str, int]:
+    """
+    :return: A signed token for the user and its lifetime in seconds
+    """
+    now = int(time.time())
+    payload = {"sub": user.email, "role": user.role.value, "iat": now, "exp": now + JWT_EXPIRATION}
+    return jwt.encode(payload, _signing_key, algorithm=JWT_ALGORITHM), JWT_EXPIRATION
+
+def verify_token(token: str) -> dict:
+    """
+    :return: The claims of the token
+    :raise jwt.InvalidTokenError: if the signature is invalid or the token expired
+    """
+    digest = sha256(token.encode('utf-8')).digest()
+    claims = token_cache.get(digest)
+    if claims is None:
+        claims = jwt.decode(token, _verifying_key, algorithms=[JWT_ALGORITHM], options={"require": ["exp", "sub"]})
+        token_cache.put(digest, claims)
+    return claims
+
+_bearer = HTTPBearer(auto_error=False)
+
+async def require_token(credentials: HTTPAuthorizationCredentials | None = Depends(_bearer)) -> dict | None:
+    """
+    Dependency of the routes that need a valid token, the default. It does nothing if FAKEAPI_JWT_REQUIRED is set
+    to false.
+        @router.post("/api/item", dependencies=[Depends(require_token)])
+    :return: The claims of the token
+    """
+    if not JWT_REQUIRED:
+        return None
+    if credentials is None:
+        strError = "Missing bearer token"
+    else:
+        try:
+            return verify_token(credentials.credentials)
+        except jwt.InvalidTokenError as e:
+            strError = f"Invalid token: {e}"
+    raise HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=strError,
+        headers={"X-Fake-REST-API": strError, "WWW-Authenticate": "Bearer"},
+    )
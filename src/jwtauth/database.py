@@ -3,6 +3,10 @@
 
 import logging
 import json
+import os
+import shutil
+import tempfile
+import threading
 from jwtauth.model import UserSchema, USR_DATABASE, Role
 from pydantic import parse_obj_as
 from fastapi.encoders import jsonable_encoder
@@ -10,30 +14,44 @@ from fastapi.encoders import jsonable_encoder
 def writeJSON(filename: str, myList: list[UserSchema]) -> bool:
     """
     Writes the list of Pydantic model "UserSchema" to a file.
+    The list is written to a temporary file of the same directory that replaces the file, so a worker that reads
+    the file at the same time gets the old or the new list, never a part of it. See UserRepository.
     :param filename: name of the file
     :param myList: the list of Pydantic model "UserSchema"
     :return: True if success, False otherwise
     """
-    try:
-        out_file = open(filename, 'x', encoding='utf-8')
-        logging.info(f'File "{filename}" was created')
-    except FileExistsError:
-        out_file = open(filename, 'w', encoding='utf-8')
-        logging.warning(f'Existing file "{filename}" was overwitten')
-    except IOError as e:
-        logging.error(f'{e}')
-        return False
     # each UserSchema of myList is converted from Pydantic model to a dict and added to a list
     try:
         record = [jsonable_encoder(d) for d in myList]
     except Exception as e:
         # "myList" was empty, just write an empty list in the JSON file
-        logging.error(f'Error {e}')
+        logging.error('Error %s', e)
         record = []
 
-    # the list of dict is saved to a JSON file
-    json.dump(record, out_file, indent=3)
-    out_file.close()
+    exists = os.path.exists(filename)
+    try:
+        fd, temp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                         prefix=os.path.basename(filename) + '.', suffix='.tmp')
+    except OSError as e:
+        logging.error('%s', e)
+        return False
+    try:
+        # the list of dict is saved to a JSON file
+        with os.fdopen(fd, 'w', encoding='utf-8') as out_file:
+            json.dump(record, out_file, indent=3)
+        if exists:
+            shutil.copymode(filename, temp_name)
+        else:
+            os.chmod(temp_name, 0o644)
+        os.replace(temp_name, filename)
+    except OSError as e:
+        logging.error('%s', e)
+        os.unlink(temp_name)
+        return False
+    if exists:
+        logging.warning('Existing file "%s" was overwitten', filename)
+    else:
+        logging.info('File "%s" was created', filename)
     return True
 
 def readJSON(filename: str) -> list[UserSchema]:
@@ -60,6 +78,84 @@ def readUsrData() -> list[UserSchema]:
 def writeUsrData(listOfItems):
     writeJSON(USR_DATABASE, listOfItems)
 
+class UserRepository:
+    """
+    The users of a JSON file, kept in memory and indexed by email and by ID.
+    The file is parsed again only when its modification time or size changed, so a lookup costs a 'stat' and
+    a dict access instead of a parse of the whole file.
+    The lookups run on the event loop and add() in the threadpool. A lookup never waits for the lock held by add()
+    while it writes the file, it uses the users indexed before.
+    """
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._signature = None
+        self._users: list[UserSchema] = []
+        self._by_email: dict[str, UserSchema] = {}
+        self._by_id: dict[str, UserSchema] = {}
+        # create_user runs in the threadpool, writes are serialized
+        self._lock = threading.Lock()
+
+    def _stat(self) -> tuple[int, int] | None:
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _index(self, users: list[UserSchema]) -> None:
+        self._users = users
+        self._by_email = {u.email: u for u in users}
+        self._by_id = {str(u.id): u for u in users}
+
+    def _refresh(self, wait: bool = False) -> None:
+        """
+        Parses the file again if it changed.
+        :param wait: wait for the lock, otherwise the users indexed before are kept while another thread holds it
+        """
+        signature = self._stat()
+        if signature == self._signature:
+            return
+        if not self._lock.acquire(blocking=wait):
+            return
+        try:
+            # the file could have been reloaded by another thread while we were waiting
+            signature = self._stat()
+            if signature != self._signature:
+                self._index(readJSON(self.filename))
+                self._signature = signature
+        finally:
+            self._lock.release()
+
+    def all(self) -> list[UserSchema]:
+        self._refresh()
+        return self._users
+
+    def by_email(self, email: str) -> UserSchema | None:
+        self._refresh()
+        return self._by_email.get(email)
+
+    def by_id(self, user_id: str) -> UserSchema | None:
+        self._refresh()
+        return self._by_id.get(str(user_id))
+
+    def add(self, user: UserSchema) -> bool:
+        """
+        Adds a user and saves the file.
+        :return: False if a user with the same email already exists
+        """
+        self._refresh(wait=True)
+        with self._lock:
+            if user.email in self._by_email:
+                return False
+            users = self._users + [user]
+            writeJSON(self.filename, users)
+            self._index(users)
+            self._signature = self._stat()
+        return True
+
+
+users = UserRepository(USR_DATABASE)
+
 
 if __name__ == "__main__":
     importedSyntheticUsrData: list[UserSchema]
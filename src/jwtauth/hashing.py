@@ -0,0 +1,109 @@
+# jwtauth/hashing.py
+"""
+Password hashing and verification in a pool of processes.
+
+PBKDF2 is slow on purpose and holds the GIL, done in the event loop it stalls every other request of the worker.
+The work is sent to FAKEAPI_HASH_WORKERS processes instead, so a burst of logins uses all the cores. At most
+FAKEAPI_HASH_QUEUE_MAX passwords can be pending, the next ones are rejected right away with a 503.
+"""
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
+from passlib.hash import pbkdf2_sha256
+from jwtauth.model import WORKERS, HASH_WORKERS, HASH_QUEUE_MAX
+import app.metrics as metrics
+
+PROCESSES = HASH_WORKERS or max(1, (os.cpu_count() or 1) // WORKERS)
+_executor: ProcessPoolExecutor | None = None
+
+class HashStats:
+    def __init__(self):
+        self.pending = 0
+        self.completed = 0
+        # raised an exception, like an invalid hash or a broken pool, or cancelled
+        self.failed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {"workers": PROCESSES, "queue_max": HASH_QUEUE_MAX,
+                "pending": self.pending, "completed": self.completed, "failed": self.failed,
+                "rejected": self.rejected,
+                "avg_seconds": round(self.total_seconds / self.completed, 6) if self.completed else 0.0,
+                "max_seconds": round(self.max_seconds, 6)}
+
+
+stats = HashStats()
+
+def hashing_metrics() -> list:
+    return [('fakeapi_hash_pending', 'gauge', 'Passwords waiting to be hashed or verified', [('', stats.pending)]),
+            ('fakeapi_hash_completed_total', 'counter', 'Passwords hashed or verified', [('', stats.completed)]),
+            ('fakeapi_hash_failed_total', 'counter', 'Hashes or verifications that failed or were cancelled',
+             [('', stats.failed)]),
+            ('fakeapi_hash_rejected_total', 'counter', 'Passwords rejected because the queue was full',
+             [('', stats.rejected)]),
+            ('fakeapi_hash_seconds_total', 'counter', 'Time spent on the passwords hashed or verified',
+             [('', stats.total_seconds)])]
+
+
+metrics.add_collector(hashing_metrics)
+
+def _hash(password: str) -> str:
+    return pbkdf2_sha256.hash(password)
+
+def _verify(password: str, hashed: str) -> bool:
+    return pbkdf2_sha256.verify(password, hashed)
+
+def start() -> None:
+    """
+    Creates the pool of PROCESSES processes of this worker. They're spawned, not forked, because the server is
+    already multi-threaded, and started on the first submit.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+
+def stop() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+async def _submit(fn, *args):
+    if stats.pending >= HASH_QUEUE_MAX:
+        stats.rejected += 1
+        strError = "Too many passwords waiting to be verified, try again later"
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError, "Retry-After": "1"},
+        )
+    start()
+    stats.pending += 1
+    begin = time.perf_counter()
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    except BaseException:
+        stats.failed += 1
+        raise
+    finally:
+        stats.pending -= 1
+    # only the successful calls are in the latency
+    elapsed = time.perf_counter() - begin
+    stats.completed += 1
+    stats.total_seconds += elapsed
+    stats.max_seconds = max(stats.max_seconds, elapsed)
+    return result
+
+async def hash_password(password: str) -> str:
+    return await _submit(_hash, password)
+
+async def verify_password(password: str, hashed: str) -> bool:
+    """
+    :raise ValueError: if 'hashed' isn't a valid PBKDF2 hash
+    """
+    return await _submit(_verify, password, hashed)
@@ -16,6 +16,33 @@ USR_DATABASE = getenv('FAKEAPI_USR_DATABASE', 'users.json')
 HOSTNAME = getenv('FAKEAPI_INTF', '0.0.0.0')
 # The TCP port for Uvicorn
 PORT = int(getenv('FAKEAPI_PORT', 8000))
+# Number of Uvicorn worker processes
+WORKERS = int(getenv('FAKEAPI_WORKERS', 1))
+# Number of processes that hash and verify passwords, per Uvicorn worker. Defaults to the number of CPUs shared
+# between the Uvicorn workers
+HASH_WORKERS = int(getenv('FAKEAPI_HASH_WORKERS', 0)) or None
+# Maximum number of passwords waiting to be hashed or verified, more requests are rejected with a 503
+HASH_QUEUE_MAX = int(getenv('FAKEAPI_HASH_QUEUE_MAX', 256))
+
+"""
+JSON Web Tokens
+    FAKEAPI_JWT_ALGORITHM: HS256 (shared secret), RS256 or ES256 (private key to sign, certificate to verify)
+    FAKEAPI_JWT_SECRET: secret for HS256. If it's not set, a random secret is generated, which is only possible with
+                        a single worker: the app refuses to start with FAKEAPI_WORKERS > 1 and no secret
+    FAKEAPI_JWT_PRIVATE_KEY/FAKEAPI_JWT_CERTIFICATE: PEM files for RS256 and ES256, default to the server key and
+                        certificate. The 'cryptography' module is required: pip install "PyJWT[crypto]"
+    FAKEAPI_JWT_EXPIRATION: lifetime of a token, in seconds
+    FAKEAPI_JWT_CACHE_SIZE: number of verified tokens kept in memory, 0 to verify the signature on every request
+    FAKEAPI_JWT_REQUIRED: a valid token is required on the item write routes (POST/PUT/PATCH/DELETE) and on
+                          DELETE /api/redis/key. Set it to false to leave them open, for a lab without users
+"""
+JWT_ALGORITHM = getenv('FAKEAPI_JWT_ALGORITHM', 'HS256')
+JWT_SECRET = getenv('FAKEAPI_JWT_SECRET', '')
+JWT_PRIVATE_KEY = getenv('FAKEAPI_JWT_PRIVATE_KEY', 'server-key.pem')
+JWT_CERTIFICATE = getenv('FAKEAPI_JWT_CERTIFICATE', 'server-crt.pem')
+JWT_EXPIRATION = int(getenv('FAKEAPI_JWT_EXPIRATION', 900))
+JWT_CACHE_SIZE = int(getenv('FAKEAPI_JWT_CACHE_SIZE', 4096))
+JWT_REQUIRED = getenv('FAKEAPI_JWT_REQUIRED', 'true').lower() not in ('0', 'false', 'no')
 
 class Role(Enum):
     ADMIN = 'admin'
@@ -46,6 +73,11 @@ class EmailPassword(BaseModel):
     email: EmailStr = Field(...)
     password: Annotated[str, Field(max_length=128)]
 
+class Token(BaseModel):
+    access_token: str
+    token_type: str = 'bearer'
+    expires_in: int
+
 
 if __name__ == "__main__":
     import json
@@ -5,14 +5,17 @@ This module contains all the API related to users authentication using JWT.
 import uuid
 
 from fastapi import APIRouter, HTTPException, status, Request
-from jwtauth.model import UserSchema, Email, EmailPassword
+from starlette.concurrency import run_in_threadpool
+from jwtauth.model import UserSchema, Email, EmailPassword, Token
 import jwtauth.database as db
-from passlib.hash import pbkdf2_sha256
+import jwtauth.hashing as hashing
+import jwtauth.auth as auth
+from app.responses import FastJSONResponse
 
 router = APIRouter()
 
 @router.post("/api/user/signup", status_code=status.HTTP_201_CREATED, tags=["post"])
-def create_user(user: UserSchema) -> dict:
+async def create_user(user: UserSchema) -> FastJSONResponse:
     """
     TODO: https://fastapi.tiangolo.com/tutorial/extra-models/
     Create a user in the "users" database for authentication of some endpoints.
@@ -29,26 +32,24 @@ def create_user(user: UserSchema) -> dict:
     :param user: The new user to add to the user's database
     :return: The newly created user is returned
     """
-    users = db.readUsrData()
-    record = [d for d in users if d.email == user.email]
-    if record:
-        # record is a list with only one element, if ID is unique 😉
-        strError = f"ID {user.email} already exists, adding item failed"
-        raise HTTPException(
-            status_code=status.HTTP_406_NOT_ACCEPTABLE,
-            detail=strError,
-            headers={"X-Fake-REST-API": strError},
-        )
-    # generate a UUID
-    user.id = uuid.uuid4()
-    # hash the password before saving to the database
-    user.password = pbkdf2_sha256.hash(user.password)
-    users.append(user)
-    db.writeUsrData(users)
-    return dict(user)
+    if db.users.by_email(user.email) is None:
+        # generate a UUID
+        user.id = uuid.uuid4()
+        # hash the password before saving to the database
+        user.password = await hashing.hash_password(user.password)
+        # the file is written in the threadpool
+        if await run_in_threadpool(db.users.add, user):
+            return FastJSONResponse(user.dict(), status_code=status.HTTP_201_CREATED)
+
+    strError = f"ID {user.email} already exists, adding item failed"
+    raise HTTPException(
+        status_code=status.HTTP_406_NOT_ACCEPTABLE,
+        detail=strError,
+        headers={"X-Fake-REST-API": strError},
+    )
 
 @router.get("/api/users", tags=["get"])
-async def all_users(request: Request) -> dict:
+async def all_users(request: Request) -> FastJSONResponse:
     """
     Returns all the users. No parameter needed.
 
@@ -57,8 +58,8 @@ async def all_users(request: Request) -> dict:
 
     :return: All the elements
     """
-    users = db.readUsrData()
-    return {"message": "Users database", "method": request.method, "users": users}
+    # the users are serialized by orjson, without the jsonable_encoder() pass
+    return FastJSONResponse({"message": "Users database", "method": request.method, "users": db.users.all()})
 
 @router.get("/api/user/email", status_code=status.HTTP_200_OK, tags=["content_parameter"])
 async def user_email(userEmail: Email) -> dict:
@@ -71,11 +72,9 @@ async def user_email(userEmail: Email) -> dict:
     :param userEmail: The email address of the user we want to retreive
     :return: The user or error 404 if not found
     """
-    users = db.readUsrData()
-    record = [d for d in users if d.email == userEmail.email]
+    record = db.users.by_email(userEmail.email)
     if record:
-        # record is a list with only one element, if email is unique 😉
-        return {"user": record[0]}
+        return {"user": record}
 
     strError = f"User with email {userEmail.email} was not found"
     raise HTTPException(
@@ -98,13 +97,10 @@ async def user_validation(userCredential: EmailPassword) -> dict:
     :param userCredential: The email address of the user we want to retreive
     :return: See above
     """
-    users = db.readUsrData()
-    record = [d for d in users if d.email == userCredential.email]
+    record = db.users.by_email(userCredential.email)
     if record:
-        print(record[0])
-        # record is a list with only one element, if email is unique 😉
         try:
-            verification = pbkdf2_sha256.verify(userCredential.password, record[0].password)
+            verification = await hashing.verify_password(userCredential.password, record.password)
             if verification:
                 return {"credential": verification}
             else:
@@ -124,6 +120,45 @@ async def user_validation(userCredential: EmailPassword) -> dict:
         headers={"X-Fake-REST-API": strError},
     )
 
+@router.post("/api/user/token", status_code=status.HTTP_200_OK, response_model=Token, tags=["post"])
+async def user_token(userCredential: EmailPassword) -> Token:
+    """
+    This API returns a signed JWT if the user exists and the password is valid, 401 otherwise.
+    Send the token in the header 'Authorization: Bearer <token>' to the routes that require it.
+
+    Example with curl:
+        curl -X POST -H "Content-type: application/json" -H "Accept: application/json" \
+        -d '{"email": "user6@example.com", "password": "Password6"}' -i -L "http://localhost:8000/api/user/token"
+    :param userCredential: The email address and password of the user
+    :return: The token and its lifetime in seconds
+    """
+    record = db.users.by_email(userCredential.email)
+    try:
+        verification = record is not None and await hashing.verify_password(userCredential.password, record.password)
+    except ValueError:
+        verification = False
+    if not verification:
+        strError = f"Invalid email address or password"
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=strError,
+            headers={"X-Fake-REST-API": strError, "WWW-Authenticate": "Bearer"},
+        )
+    access_token, expires_in = auth.issue_token(record)
+    return Token(access_token=access_token, expires_in=expires_in)
+
+@router.get("/api/users/hashing", tags=["get"])
+async def hashing_stats() -> dict:
+    """
+    Returns the queue depth and the latency of the password hashing processes of the worker.
+
+    Example with curl:
+        curl -H "Content-type: application/json" -H "Accept: application/json" -i -L \
+        "http://localhost:8000/api/users/hashing"
+    :return: The counters of the hashing pool
+    """
+    return {"hashing": hashing.stats.as_dict()}
+
 
 if __name__ == "__main__":
     import uvicorn
@@ -12,10 +12,11 @@ Example of queries within the Redis client:
     redis.lab:6379> HGETALL item:100
 """
 import uvicorn
-import logging
 import platform
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from app.definitions import tags_metadata, HOSTNAME, PORT, SERVER_CRT, SERVER_KEY
+from app.definitions import tags_metadata, HOSTNAME, PORT, SERVER_CRT, SERVER_KEY, WORKERS, LOOP, HTTP, BACKLOG, \
+    KEEPALIVE, LIMIT_CONCURRENCY
 
 import app.delete as delete     # DELETE method
 import app.get as get           # GET method
@@ -26,22 +27,47 @@ import app.post as post         # POST method
 import app.put as put           # PUT method
 import app.trace as trace       # TRACE method
 import jwtauth.users as users   # module for users
+import jwtauth.hashing as hashing   # password hashing processes
 import app.redis_db as redis    # GET method with Redis database
+import app.cache as cache       # in-process item cache
+import app.replicas as replicas # reads from the Redis replicas
+import app.idempotency as idempotency   # Idempotency-Key of the write routes
+import app.scripts as scripts   # Lua scripts
+import app.metrics as metrics   # Prometheus metrics
+import app.compression as compression   # gzip, brotli and zstd responses
+from app.responses import FastJSONResponse
+from app.logs import logger, UVICORN_LOG_CONFIG
 
-if __name__ == "__main__":
-    # logger config
-    logger = logging.getLogger()
-    logging.basicConfig(level=logging.INFO,
-                        format='%(levelname)s: %(asctime)s %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S')
-    logging.info(f'Hostname: {platform.node()} listening on interface {HOSTNAME}:{PORT}')
-
-    if not SERVER_KEY:
-        logging.info(f'HTTP activated')
-    else:
-        logging.info(f'HTTPS activated with Server Certificate={SERVER_CRT} - Server Private Key={SERVER_KEY}')
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    The Redis connection pools, the replica lag watcher, the cache invalidation subscriber, the visit counter flusher
+    and the password hashing processes live as long as the app. They are stopped even if the startup or the app
+    fails, each stop does nothing for what wasn't started.
+    """
+    try:
+        await redis.open_redis()
+        await scripts.load_scripts()
+        await replicas.start()
+        await cache.start()
+        await redis.start_hits()
+        hashing.start()
+        yield
+    finally:
+        hashing.stop()
+        await redis.stop_hits()
+        await cache.stop()
+        await replicas.stop()
+        await redis.close_redis()
 
-    app = FastAPI(openapi_tags=tags_metadata)
+def create_app() -> FastAPI:
+    """
+    App factory. Every worker process builds its own app, so its Redis pool and its background tasks are created
+    in the worker, after the fork, by the lifespan.
+        uvicorn main:create_app --factory
+    """
+    # The Redis connection pool is opened and closed in the lifespan of the app
+    app = FastAPI(openapi_tags=tags_metadata, lifespan=lifespan, default_response_class=FastJSONResponse)
     app.include_router(delete.router)
     app.include_router(get.router)
     app.include_router(head.router)
@@ -56,12 +82,48 @@ if __name__ == "__main__":
 
     # Redis example
     app.include_router(redis.router)
+    app.include_router(cache.router)
+
+    # 503 while the circuit breaker of Redis is open
+    app.add_exception_handler(redis.CircuitOpenError, redis.circuit_open_handler)
+
+    # The responses are kept before they're compressed, a replay is compressed for the client that retries
+    app.add_middleware(idempotency.IdempotencyMiddleware)
+
+    # The reads of a client that just wrote go to the Redis primaries
+    app.add_middleware(replicas.ReadYourWritesMiddleware)
+
+    # The responses are compressed inside the metrics middleware, the latency includes the compression
+    app.add_middleware(compression.CompressionMiddleware)
+
+    # Prometheus metrics
+    app.include_router(metrics.router)
+    app.add_middleware(metrics.MetricsMiddleware)
+    return app
+
+if __name__ == "__main__":
+    # the root logger is configured by app/logs.py
+    logger.info('Hostname: %s listening on interface %s:%s', platform.node(), HOSTNAME, PORT)
+    logger.info('Workers: %s - loop: %s - http: %s - backlog: %s - keep-alive: %ss - concurrency limit: %s',
+                WORKERS, LOOP, HTTP, BACKLOG, KEEPALIVE, LIMIT_CONCURRENCY)
+
+    if not SERVER_KEY:
+        logger.info('HTTP activated')
+    else:
+        logger.info('HTTPS activated with Server Certificate=%s - Server Private Key=%s', SERVER_CRT, SERVER_KEY)
 
-    # Start the server
-    uvicorn.run(app, host=HOSTNAME, port=PORT,
+    # Start the server. With more than one worker, Uvicorn needs the import string of the app factory
+    uvicorn.run("main:create_app", factory=True, host=HOSTNAME, port=PORT,
+                workers=WORKERS,
+                loop=LOOP,
+                http=HTTP,
+                backlog=BACKLOG,
+                timeout_keep_alive=KEEPALIVE,
+                limit_concurrency=LIMIT_CONCURRENCY,
                 ssl_keyfile=SERVER_KEY,
                 ssl_certfile=SERVER_CRT,
                 # ssl_ca_certs="ca-chain.pem",
                 # ssl_ciphers="TLSv1.2",
                 access_log=True,
+                log_config=UVICORN_LOG_CONFIG,
                 log_level="info")
@@ -0,0 +1,106 @@
+# tests/conftest.py
+"""
+Fixtures of the tests. Redis is replaced by fakeredis, an in-memory server per node and per test, like the
+benchmark does. Needs:
+    pip3 install -r requirements-dev.txt
+
+Run them from the 'src' directory:
+    python3 -m pytest -q tests
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# set before the modules of the app read them: the tests don't write the users of the repository
+_users = os.path.join(tempfile.mkdtemp(prefix='fakeapi-tests-'), 'users.json')
+shutil.copyfile(os.path.join(SRC, 'jwtauth', 'users.json'), _users)
+os.environ['FAKEAPI_USR_DATABASE'] = _users
+os.environ.setdefault('FAKEAPI_JWT_SECRET', 'tests')
+os.environ.setdefault('FAKEAPI_LOG_LEVEL', 'WARNING')
+
+import httpx
+import pytest
+from benchmark import use_fakeredis
+import app.storage as storage
+from app.redis_db import shards, CircuitBreaker
+from app.cache import cache
+
+def make_item(item_id: int, price: float = 9.99, category: str = 'tools', description: str = 'Hammer') -> dict:
+    return {"id": item_id, "description": description, "price": price, "quantity": 20, "category": category}
+
+@pytest.fixture(autouse=True)
+def fake_redis():
+    """
+    A new, empty fakeredis server for each node. The connections of the previous test are dropped, they're bound to
+    its server and its event loop.
+    """
+    use_fakeredis()
+    for client in shards:
+        client.connection_pool.reset()
+        client.breaker.state = CircuitBreaker.CLOSED
+        client.breaker.failures = 0
+    yield
+
+@pytest.fixture(params=['hash', 'bucket'])
+def encoding(request, monkeypatch):
+    """
+    Runs the test with both encodings of the items, see app/storage.py.
+    """
+    monkeypatch.setattr(storage, 'BUCKETS', request.param == 'bucket')
+    return request.param
+
+@pytest.fixture
+def cached(monkeypatch):
+    """
+    Enables the item cache, empty, for the test.
+    """
+    monkeypatch.setattr(cache, 'size', 100)
+    cache.clear()
+    yield cache
+    cache.clear()
+
+@pytest.fixture
+def run():
+    """
+    Runs a coroutine function with an HTTP client of the app, inside the lifespan of the app:
+        run(body), with async def body(client: httpx.AsyncClient)
+    The client sends the token of an admin, required by the write routes.
+    """
+    from main import create_app
+    from jwtauth.auth import issue_token
+    from jwtauth.model import UserSchema
+
+    admin = UserSchema(fullname='Tests', email='tests@example.com', password='Tests', role='admin')
+    headers = {"Authorization": f'Bearer {issue_token(admin)[0]}'}
+
+    def runner(body, timeout: float = 30):
+        async def scenario():
+            app = create_app()
+            async with app.router.lifespan_context(app):
+                transport = httpx.ASGITransport(app=app)
+                async with httpx.AsyncClient(transport=transport, base_url='http://tests', headers=headers) as client:
+                    result = await body(client)
+            return result
+
+        def target():
+            try:
+                outcome['result'] = asyncio.run(scenario())
+            except BaseException as e:
+                outcome['error'] = e
+
+        # in a thread, a shutdown that never returns fails the test instead of blocking the run
+        outcome = {}
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            pytest.fail(f'The app did not stop within {timeout}s')
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    return runner
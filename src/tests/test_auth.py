@@ -0,0 +1,97 @@
+# tests/test_auth.py
+"""
+The JSON Web Tokens of jwtauth/auth.py: issuance, verification, the cache of verified tokens and the write routes
+that require one.
+"""
+import time
+import jwt
+import pytest
+import jwtauth.auth as auth
+from jwtauth.model import UserSchema
+from tests.conftest import make_item
+
+USER = UserSchema(fullname='User3 Name3', email='user3@example.com', password='Password3', role='admin')
+
+@pytest.fixture(autouse=True)
+def token_cache(monkeypatch):
+    monkeypatch.setattr(auth, 'token_cache', auth.TokenCache(10))
+    return auth.token_cache
+
+def test_issue_and_verify(token_cache):
+    token, expires_in = auth.issue_token(USER)
+    claims = auth.verify_token(token)
+    assert (claims['sub'], claims['role']) == ('user3@example.com', 'admin')
+    assert claims['exp'] - claims['iat'] == expires_in
+    # the second verification is a hit of the cache
+    assert auth.verify_token(token) == claims
+    assert (token_cache.hits, token_cache.misses) == (1, 1)
+
+def test_invalid_tokens_are_not_cached(token_cache, monkeypatch):
+    token, _ = auth.issue_token(USER)
+    with pytest.raises(jwt.InvalidSignatureError):
+        auth.verify_token(token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB'))
+    monkeypatch.setattr(auth, 'JWT_EXPIRATION', -10)
+    expired, _ = auth.issue_token(USER)
+    with pytest.raises(jwt.ExpiredSignatureError):
+        auth.verify_token(expired)
+    assert len(token_cache._entries) == 0
+
+def test_cached_token_expires():
+    cache = auth.TokenCache(10)
+    cache.put(b'1', {"exp": time.time() - 1})
+    # the token expired while it was in the cache, it's dropped
+    assert cache.get(b'1') is None
+    assert len(cache._entries) == 0
+
+def test_token_cache_is_an_lru():
+    cache = auth.TokenCache(2)
+    claims = {"exp": time.time() + 60}
+    cache.put(b'1', claims)
+    cache.put(b'2', claims)
+    cache.get(b'1')
+    cache.put(b'3', claims)
+    assert list(cache._entries) == [b'1', b'3']
+    assert auth.TokenCache(0).put(b'1', claims) is None
+
+def test_write_routes_require_a_token(run):
+    async def body(client):
+        # without the token of the other tests
+        del client.headers['Authorization']
+        response = await client.post('/api/item', json=make_item(5))
+        assert response.status_code == 401
+        assert response.headers['WWW-Authenticate'] == 'Bearer'
+        response = await client.post('/api/item', json=make_item(5), headers={"Authorization": "Bearer nope"})
+        assert response.status_code == 401
+        assert response.headers['X-Fake-REST-API'].startswith('Invalid token')
+        response = await client.post('/api/user/token', json={"email": USER.email, "password": 'Password2'})
+        assert response.status_code == 401
+        response = await client.post('/api/user/token', json={"email": USER.email, "password": 'Password3'})
+        assert response.status_code == 200
+        headers = {"Authorization": f'Bearer {response.json()["access_token"]}'}
+        assert (await client.post('/api/item', json=make_item(5), headers=headers)).status_code == 201
+        assert (await client.delete('/api/redis/key/item:5')).status_code == 401
+        # the reads don't need one
+        assert (await client.get('/api/item/5')).status_code == 200
+
+    run(body)
+
+def test_write_routes_without_tokens(run, monkeypatch):
+    """
+    FAKEAPI_JWT_REQUIRED=false leaves the write routes open.
+    """
+    monkeypatch.setattr(auth, 'JWT_REQUIRED', False)
+
+    async def body(client):
+        del client.headers['Authorization']
+        assert (await client.post('/api/item', json=make_item(5))).status_code == 201
+        assert (await client.delete('/api/redis/key/item:5')).status_code == 200
+
+    run(body)
+
+def test_random_secret_needs_a_single_worker(monkeypatch):
+    monkeypatch.setattr(auth, 'JWT_SECRET', '')
+    signing_key, verifying_key = auth._load_keys()
+    assert signing_key == verifying_key and signing_key != 'tests'
+    monkeypatch.setattr(auth, 'WORKERS', 2)
+    with pytest.raises(RuntimeError):
+        auth._load_keys()
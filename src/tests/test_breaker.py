@@ -0,0 +1,63 @@
+# tests/test_breaker.py
+"""
+The states of the circuit breaker of a Redis node, see app/redis_db.py.
+"""
+import asyncio
+import pytest
+from app.redis_db import redis, CircuitBreaker, CircuitOpenError
+
+def test_transitions():
+    async def scenario():
+        breaker = CircuitBreaker('tests:6379', threshold=2, probe_interval=0.01)
+        breaker.client = redis
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.check()
+        # a success resets the count of consecutive failures
+        breaker.success()
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.trips == 1
+        with pytest.raises(CircuitOpenError):
+            breaker.check()
+        # the probe PINGs the node, it answers
+        await asyncio.sleep(0.1)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        breaker.check()
+        # the first failure while half open opens it again
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert breaker.trips == 2
+        await asyncio.sleep(0.1)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        breaker.success()
+        assert breaker.state == CircuitBreaker.CLOSED
+        assert breaker.failures == 0
+        await breaker.stop()
+        await redis.connection_pool.disconnect()
+
+    asyncio.run(scenario())
+
+def test_open_breaker_fails_fast(run, monkeypatch):
+    server = redis.connection_pool.connection_kwargs['server']
+    monkeypatch.setattr(redis.breaker, 'probe_interval', 0.01)
+
+    async def body(client):
+        server.connected = False
+        statuses = [(await client.get('/api/item/5')).status_code for _ in range(redis.breaker.threshold + 2)]
+        # connection errors until the breaker opens, then 503 without contacting Redis
+        assert statuses[:redis.breaker.threshold] == [500] * redis.breaker.threshold
+        assert statuses[-1] == 503
+        assert redis.breaker.state == CircuitBreaker.OPEN
+        assert (await client.get('/api/health/ready')).status_code == 503
+        assert (await client.get('/api/health/live')).status_code == 200
+        server.connected = True
+        await asyncio.sleep(0.1)
+        assert redis.breaker.state == CircuitBreaker.HALF_OPEN
+        assert (await client.get('/api/item/5')).status_code == 404
+        assert redis.breaker.state == CircuitBreaker.CLOSED
+        assert (await client.get('/api/health/ready')).status_code == 200
+
+    run(body)
@@ -0,0 +1,59 @@
+# tests/test_cache.py
+"""
+The item cache of app/cache.py: invalidation by the writes of this worker and of the others, and the shutdown of
+its subscriber.
+"""
+import asyncio
+import time
+import app.cache as cache_module
+from app.redis_db import redis
+from tests.conftest import make_item
+
+async def subscribed() -> None:
+    while not (await redis.pubsub_numsub(cache_module.INVALIDATE_CHANNEL))[0][1]:
+        await asyncio.sleep(0.01)
+
+def test_write_invalidates(run, cached):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        assert (await client.get('/api/item/5')).json()['Item']['price'] == 9.99
+        assert (await client.get('/api/item/5')).json()['Item']['price'] == 9.99
+        assert cached.hits == 1
+        await client.put('/api/item/id', json=make_item(5, price=1))
+        assert (await client.get('/api/item/5')).json()['Item']['price'] == 1
+        await client.request('DELETE', '/api/delete/id/', json={"item_id": 5})
+        assert (await client.get('/api/item/5')).status_code == 404
+
+    run(body)
+
+def test_invalidation_of_another_worker(run, cached):
+    async def body(client):
+        await subscribed()
+        await client.post('/api/item', json=make_item(5))
+        await client.post('/api/item', json=make_item(6))
+        await client.request('GET', '/api/items/batch', json={"item_ids": [5, 6]})
+        assert 5 in cached._entries and 6 in cached._entries
+        await redis.publish(cache_module.INVALIDATE_CHANNEL, 'another-worker 5')
+        for _ in range(100):
+            if 5 not in cached._entries:
+                break
+            await asyncio.sleep(0.01)
+        assert 5 not in cached._entries
+        assert 6 in cached._entries
+
+    run(body)
+
+def test_lifespan_shutdown(run, cached):
+    """
+    The subscriber stops with the app, after traffic. A shutdown stuck in cache.stop() fails on the timeout of run().
+    """
+    async def body(client):
+        await subscribed()
+        for item_id in range(1, 21):
+            await client.post('/api/item', json=make_item(item_id))
+            await client.get(f'/api/item/{item_id}')
+        return time.monotonic()
+
+    stopping = run(body, timeout=cache_module.STOP_TIMEOUT * 2)
+    assert time.monotonic() - stopping < cache_module.STOP_TIMEOUT
+    assert cache_module._listener is None
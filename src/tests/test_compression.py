@@ -0,0 +1,90 @@
+# tests/test_compression.py
+"""
+The compression of the responses, see app/compression.py. httpx decodes gzip, br and zstd, the tests compare the
+decoded bodies.
+"""
+import json
+import pytest
+import app.compression as compression
+from app.compression import negotiate
+from tests.conftest import make_item
+
+@pytest.fixture
+def items(run):
+    """
+    Runs a body with 50 items in Redis, enough for the responses of /api/items to be compressed.
+    """
+    def runner(body):
+        async def with_items(client):
+            await client.post('/api/items/batch', json=[make_item(item_id) for item_id in range(1, 51)])
+            return await body(client)
+        return run(with_items)
+
+    return runner
+
+def test_negotiate(monkeypatch):
+    monkeypatch.setattr(compression, 'ENCODINGS', ['zstd', 'br', 'gzip'])
+    assert negotiate('gzip, deflate, br;q=0.5') == 'br'
+    assert negotiate('gzip;q=0, *') == 'zstd'
+    assert negotiate('br;q=nope, gzip') == 'gzip'
+    assert negotiate('identity') is None
+    assert negotiate('*;q=0') is None
+
+@pytest.mark.parametrize('encoding', compression.ENCODINGS)
+def test_encodings(items, encoding):
+    async def body(client):
+        plain = await client.get('/api/items', params={"count": 50}, headers={"Accept-Encoding": "identity"})
+        assert 'Content-Encoding' not in plain.headers
+        assert int(plain.headers['Content-Length']) >= compression.COMPRESSION_MIN_SIZE
+        response = await client.get('/api/items', params={"count": 50}, headers={"Accept-Encoding": encoding})
+        assert response.headers['Content-Encoding'] == encoding
+        assert response.headers['Vary'] == plain.headers['Vary'] == 'Accept-Encoding'
+        assert int(response.headers['Content-Length']) < int(plain.headers['Content-Length'])
+        assert response.json() == plain.json()
+
+    items(body)
+
+def test_small_response_is_sent_as_is(run):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        response = await client.get('/api/item/5', headers={"Accept-Encoding": "gzip"})
+        assert 'Content-Encoding' not in response.headers
+        # the response depends on Accept-Encoding, even when it isn't compressed
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        response = await client.get('/api/item/5')
+        assert response.headers['Vary'] == 'Accept-Encoding'
+
+    run(body)
+
+def test_streamed_response(items):
+    async def body(client):
+        response = await client.get('/api/items/export', params={"count": 10}, headers={"Accept-Encoding": "gzip"})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Content-Length' not in response.headers
+        exported = [json.loads(line) for line in response.text.splitlines()]
+        assert sorted(item['id'] for item in exported) == list(range(1, 51))
+
+    items(body)
+
+def test_etag_of_a_compressed_response(run, monkeypatch):
+    """
+    Each content-coding has its own ETag, and any of them can be sent back.
+    """
+    monkeypatch.setattr(compression, 'COMPRESSION_MIN_SIZE', 1)
+
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        plain = await client.get('/api/item/5', headers={"Accept-Encoding": "identity"})
+        gzip = await client.get('/api/item/5', headers={"Accept-Encoding": "gzip"})
+        assert plain.headers['Vary'] == gzip.headers['Vary'] == 'Accept-Encoding'
+        assert gzip.headers['Content-Encoding'] == 'gzip'
+        assert gzip.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+        response = await client.get('/api/item/5', headers={"If-None-Match": gzip.headers['ETag'],
+                                                            "Accept-Encoding": "gzip"})
+        assert response.status_code == 304
+        assert response.headers['ETag'] == gzip.headers['ETag']
+        response = await client.put('/api/item/id', json=make_item(5, price=1),
+                                    headers={"If-Match": gzip.headers['ETag']})
+        assert response.status_code == 200
+
+    run(body)
@@ -0,0 +1,93 @@
+# tests/test_cursors.py
+"""
+The keyset cursors of /api/items and the SCAN cursors of /api/redis/keys.
+"""
+import pytest
+from fastapi import HTTPException
+from app.redis_db import redis, encode_cursor, decode_cursor
+from tests.conftest import make_item
+
+# prices with ties, the ties are ordered by ID as a string
+PRICES = {item_id: [5.0, 1.5, 9.99, 1.5, 20.0][item_id % 5] for item_id in range(1, 31)}
+
+def expected_order(item_ids) -> list[int]:
+    return sorted(item_ids, key=lambda item_id: (PRICES[item_id], str(item_id)))
+
+async def read_pages(client, count: int, **params) -> list[list[int]]:
+    pages = []
+    cursor = None
+    while True:
+        response = await client.get('/api/items', params={**params, "count": count,
+                                                          **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        pages.append([item['id'] for item in response.json()['items']])
+        cursor = response.json()['cursor']
+        if cursor is None:
+            return pages
+
+def test_pages_follow_the_index(run, encoding):
+    async def body(client):
+        await client.post('/api/items/batch', json=[make_item(item_id, price=price)
+                                                    for item_id, price in PRICES.items()])
+        pages = await read_pages(client, 7)
+        assert [len(page) for page in pages] == [7, 7, 7, 7, 2]
+        assert [item_id for page in pages for item_id in page] == expected_order(PRICES)
+        pages = await read_pages(client, 4, min_price=1.5, max_price=5)
+        assert [item_id for page in pages for item_id in page] == \
+            expected_order([item_id for item_id, price in PRICES.items() if price <= 5])
+
+    run(body)
+
+def test_page_after_a_deleted_item(run):
+    """
+    The last item of a page is deleted before the next page is read, the next page starts where it was.
+    """
+    async def body(client):
+        await client.post('/api/items/batch', json=[make_item(item_id, price=price)
+                                                    for item_id, price in PRICES.items()])
+        response = (await client.get('/api/items', params={"count": 10})).json()
+        last = response['items'][-1]['id']
+        await client.request('DELETE', '/api/delete/id/', json={"item_id": last})
+        rest = (await client.get('/api/items', params={"count": 100, "cursor": response['cursor']})).json()
+        order = expected_order(PRICES)
+        assert [item['id'] for item in rest['items']] == order[order.index(last) + 1:]
+        assert rest['cursor'] is None
+
+    run(body)
+
+def test_invalid_page_cursor(run):
+    async def body(client):
+        response = await client.get('/api/items', params={"cursor": "not a cursor"})
+        assert response.status_code == 400
+        assert response.headers['X-Fake-REST-API'].startswith('Invalid cursor')
+
+    run(body)
+
+def test_scan_cursor_round_trip():
+    assert encode_cursor(0, 0) is None
+    assert decode_cursor(None) == (0, 0, None)
+    assert decode_cursor(encode_cursor(0, 17)) == (0, 17, None)
+
+def test_invalid_scan_cursor():
+    with pytest.raises(HTTPException) as error:
+        decode_cursor('not a cursor')
+    assert error.value.status_code == 400
+
+def test_keys_pages(run):
+    async def body(client):
+        keys = {f'tests:key:{i}' for i in range(50)}
+        await redis.mset({key: 1 for key in keys})
+        found = []
+        cursor = None
+        while True:
+            response = await client.get('/api/redis/keys', params={"match": "tests:key:*", "count": 10,
+                                                                   **({"cursor": cursor} if cursor else {})})
+            assert response.status_code == 200
+            found += response.json()['keys']
+            cursor = response.json()['cursor']
+            if cursor is None:
+                break
+        # SCAN can return a key twice, never miss one
+        assert set(found) == keys
+
+    run(body)
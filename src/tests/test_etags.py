@@ -0,0 +1,67 @@
+# tests/test_etags.py
+"""
+The conditional requests of app/etags.py.
+"""
+from app.etags import condition, encoded, not_modified
+from tests.conftest import make_item
+
+def test_condition():
+    assert condition(None) == ''
+    assert condition(' * ') == '*'
+    assert condition('"12", W/"13", "14-gzip"') == ' 12 14 '
+
+def test_not_modified():
+    assert encoded('"12"', 'br') == '"12-br"'
+    # the ETag of the 304 is the one of the representation of the client
+    assert not_modified(12, '"11", W/"12-br"', None) == '"12-br"'
+    assert not_modified(12, '"12"', None) == '"12"'
+    assert not_modified(12, '*', None) == '"12"'
+    assert not_modified(12, '"11-gzip"', None) is None
+    assert not_modified(12, None, None) is None
+
+def test_if_none_match(run, encoding):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        response = await client.get('/api/item/5')
+        tag = response.headers['ETag']
+        assert (await client.get('/api/item/5', headers={"If-None-Match": tag})).status_code == 304
+        assert (await client.head('/api/item/5', headers={"If-None-Match": tag})).status_code == 304
+        await client.put('/api/item/id', json=make_item(5, price=1))
+        assert (await client.get('/api/item/5', headers={"If-None-Match": tag})).status_code == 200
+
+    run(body)
+
+def test_if_modified_since(run):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        response = await client.get('/api/item/5')
+        modified = response.headers['Last-Modified']
+        assert (await client.get('/api/item/5', headers={"If-Modified-Since": modified})).status_code == 304
+        response = await client.get('/api/item/5', headers={"If-Modified-Since": 'Sat, 01 Jan 2000 00:00:00 GMT'})
+        assert response.status_code == 200
+        # If-None-Match wins over If-Modified-Since
+        response = await client.get('/api/item/5', headers={"If-Modified-Since": modified, "If-None-Match": '"1"'})
+        assert response.status_code == 200
+
+    run(body)
+
+def test_if_match_returns_412(run, encoding):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        tag = (await client.get('/api/item/5')).headers['ETag']
+        response = await client.put('/api/item/id', json=make_item(5, price=1), headers={"If-Match": tag})
+        assert response.status_code == 200
+        # the client that read the item before the write
+        for method, url, json in (('PUT', '/api/item/id', make_item(5, price=2)),
+                                  ('PATCH', '/api/item/id/price', {"item_id": 5, "price": 3}),
+                                  ('DELETE', '/api/delete/id/', {"item_id": 5})):
+            response = await client.request(method, url, json=json, headers={"If-Match": tag})
+            assert response.status_code == 412, method
+            assert 'X-Fake-REST-API' in response.headers
+        assert (await client.get('/api/item/5')).json()['Item']['price'] == 1
+        # a weak ETag never matches
+        weak = 'W/' + (await client.get('/api/item/5')).headers['ETag']
+        response = await client.request('DELETE', '/api/delete/id/', json={"item_id": 5}, headers={"If-Match": weak})
+        assert response.status_code == 412
+
+    run(body)
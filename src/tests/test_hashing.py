@@ -0,0 +1,53 @@
+# tests/test_hashing.py
+"""
+The pool of processes that hash and verify the passwords, see jwtauth/hashing.py.
+"""
+import asyncio
+import pytest
+from fastapi import HTTPException
+import jwtauth.hashing as hashing
+
+@pytest.fixture(autouse=True)
+def stats(monkeypatch):
+    monkeypatch.setattr(hashing, 'stats', hashing.HashStats())
+    return hashing.stats
+
+def test_hash_and_verify(stats):
+    async def scenario():
+        hashed = await hashing.hash_password('Password1')
+        assert hashed.startswith('$pbkdf2-sha256$')
+        assert await hashing.verify_password('Password1', hashed) is True
+        assert await hashing.verify_password('Password2', hashed) is False
+        # an invalid hash fails in the process, it's counted apart from the completed ones
+        with pytest.raises(ValueError):
+            await hashing.verify_password('Password1', 'not a hash')
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        hashing.stop()
+    assert (stats.completed, stats.failed, stats.pending) == (3, 1, 0)
+    assert stats.max_seconds > 0
+
+def test_full_queue_is_rejected(stats, monkeypatch):
+    monkeypatch.setattr(hashing, 'HASH_QUEUE_MAX', 0)
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(hashing.hash_password('Password1'))
+    assert error.value.status_code == 503
+    assert error.value.headers['Retry-After'] == '1'
+    assert (stats.rejected, stats.completed) == (1, 0)
+
+def test_signup_and_validate(run):
+    async def body(client):
+        user = {"fullname": "Hashing", "email": "hashing@example.com", "password": "Password1", "role": "admin"}
+        response = await client.post('/api/user/signup', json=user)
+        assert response.status_code == 201
+        assert response.json()['password'] != 'Password1'
+        credentials = {"email": user['email'], "password": 'Password1'}
+        assert (await client.request('GET', '/api/user/validate', json=credentials)).json() == {"credential": True}
+        response = await client.request('GET', '/api/user/validate', json={**credentials, "password": 'Password2'})
+        assert response.status_code == 401
+        stats = (await client.get('/api/users/hashing')).json()['hashing']
+        assert (stats['completed'], stats['pending']) == (3, 0)
+
+    run(body)
@@ -0,0 +1,94 @@
+# tests/test_idempotency.py
+"""
+The Idempotency-Key of the write routes, see app/idempotency.py.
+"""
+import asyncio
+from redis import exceptions
+import app.idempotency as idempotency
+import app.storage as storage
+from tests.conftest import make_item
+
+KEY = {"Idempotency-Key": "8e03978e-40d5-43e8-bc93-6894a57f9324"}
+
+def test_replay(run):
+    async def body(client):
+        first = await client.post('/api/item', json=make_item(5), headers=KEY)
+        assert first.status_code == 201
+        replay = await client.post('/api/item', json=make_item(5), headers=KEY)
+        # without the key, the second POST is a 400, the item exists
+        assert replay.status_code == 201
+        assert replay.headers['Idempotent-Replayed'] == 'true'
+        assert replay.json() == first.json()
+        assert 'Idempotent-Replayed' not in first.headers
+
+    run(body)
+
+def test_fingerprint_mismatch(run):
+    async def body(client):
+        assert (await client.post('/api/item', json=make_item(5), headers=KEY)).status_code == 201
+        response = await client.post('/api/item', json=make_item(6), headers=KEY)
+        assert response.status_code == 422
+        assert 'X-Fake-REST-API' in response.headers
+        response = await client.put('/api/item/id', json=make_item(5), headers=KEY)
+        assert response.status_code == 422
+        assert (await client.get('/api/item/6')).status_code == 404
+
+    run(body)
+
+def test_concurrent_duplicates_run_once(run, monkeypatch):
+    created = []
+    create_item = storage.create_item
+
+    async def slow_create(item):
+        created.append(item['id'])
+        await asyncio.sleep(0.1)
+        return await create_item(item)
+
+    monkeypatch.setattr(storage, 'create_item', slow_create)
+
+    async def body(client):
+        responses = await asyncio.gather(*[client.post('/api/item', json=make_item(5), headers=KEY)
+                                           for _ in range(5)])
+        assert [response.status_code for response in responses] == [201] * 5
+        assert len({response.json()['version'] for response in responses}) == 1
+        assert created == [5]
+
+    run(body)
+
+def test_conflict_while_in_progress(run, monkeypatch):
+    create_item = storage.create_item
+
+    async def slow_create(item):
+        await asyncio.sleep(0.3)
+        return await create_item(item)
+
+    monkeypatch.setattr(storage, 'create_item', slow_create)
+    monkeypatch.setattr(idempotency, 'IDEMPOTENCY_WAIT', 0.05)
+
+    async def body(client):
+        first = asyncio.create_task(client.post('/api/item', json=make_item(5), headers=KEY))
+        await asyncio.sleep(0.05)
+        response = await client.post('/api/item', json=make_item(5), headers=KEY)
+        assert response.status_code == 409
+        assert (await first).status_code == 201
+
+    run(body)
+
+def test_server_error_releases_the_key(run, monkeypatch):
+    create_item = storage.create_item
+    failures = [exceptions.ConnectionError('down')]
+
+    async def failing_create(item):
+        if failures:
+            raise failures.pop()
+        return await create_item(item)
+
+    monkeypatch.setattr(storage, 'create_item', failing_create)
+
+    async def body(client):
+        assert (await client.post('/api/item', json=make_item(5), headers=KEY)).status_code == 500
+        response = await client.post('/api/item', json=make_item(5), headers=KEY)
+        assert response.status_code == 201
+        assert 'Idempotent-Replayed' not in response.headers
+
+    run(body)
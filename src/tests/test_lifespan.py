@@ -0,0 +1,31 @@
+# tests/test_lifespan.py
+"""
+The startup and the shutdown of the background tasks and of the processes of the app, see lifespan in main.py.
+"""
+import pytest
+import app.redis_db as redis_db
+import jwtauth.hashing as hashing
+
+def test_stopped_when_the_app_fails(run):
+    async def body(client):
+        assert hashing._executor is not None and redis_db._flusher is not None
+        raise RuntimeError('failed')
+
+    with pytest.raises(RuntimeError):
+        run(body)
+    assert hashing._executor is None and redis_db._flusher is None
+
+def test_stopped_when_the_startup_fails(run, monkeypatch):
+    """
+    The last step of the startup fails, after the visit counter flusher started.
+    """
+    def start():
+        raise OSError('no processes')
+
+    async def body(client):
+        pass
+
+    monkeypatch.setattr(hashing, 'start', start)
+    with pytest.raises(OSError):
+        run(body)
+    assert redis_db._flusher is None
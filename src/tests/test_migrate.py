@@ -0,0 +1,62 @@
+# tests/test_migrate.py
+"""
+The move of the 'item:<id>' hashes to the buckets of the 'bucket' encoding, and the reindexing of the items, see
+app/migrate.py.
+"""
+import asyncio
+import app.storage as storage
+from app.migrate import migrate, reindex
+from app.redis_db import redis
+from tests.conftest import make_item
+
+async def create_legacy(monkeypatch, item_ids) -> None:
+    monkeypatch.setattr(storage, 'BUCKETS', False)
+    for item_id in item_ids:
+        await storage.create_item(make_item(item_id, description=f'Item {item_id}'))
+    monkeypatch.setattr(storage, 'BUCKETS', True)
+
+def test_migrate(monkeypatch):
+    async def scenario():
+        await create_legacy(monkeypatch, range(1, 6))
+        before = await storage.read_items(list(range(1, 6)))
+        # the items not migrated yet are read from their legacy hash
+        assert [item['description'] for item in before] == [f'Item {item_id}' for item_id in range(1, 6)]
+        assert await migrate(count=100, dry_run=True) == 0
+        assert await redis.exists(*[storage.legacy_key(item_id) for item_id in range(1, 6)]) == 5
+        # a single SCAN, the SCAN of fakeredis skips keys when some are deleted between two calls
+        assert await migrate(count=100, dry_run=False) == 5
+        assert await redis.exists(*[storage.legacy_key(item_id) for item_id in range(1, 6)]) == 0
+        assert await redis.hlen(storage.bucket_key(1)) == 5
+        # same items, same versions
+        assert await storage.read_items(list(range(1, 6))) == before
+        assert await migrate(count=100, dry_run=False) == 0
+        await redis.connection_pool.disconnect()
+
+    asyncio.run(scenario())
+
+def test_write_of_a_legacy_item(monkeypatch):
+    async def scenario():
+        await create_legacy(monkeypatch, [1, 2])
+        version = (await storage.read_item(1))['version']
+        # an update moves the item to its bucket, a delete removes both
+        assert await storage.update_item(1, {"price": 2.5}) > version
+        assert await redis.exists(storage.legacy_key(1)) == 0
+        assert (await storage.read_item(1))['price'] == 2.5
+        assert await storage.delete_item(2) > 0
+        assert await storage.read_item(2) == {}
+        assert await storage.create_item(make_item(2)) > 0
+        await redis.connection_pool.disconnect()
+
+    asyncio.run(scenario())
+
+def test_reindex(encoding):
+    async def scenario():
+        for item_id in range(1, 4):
+            await storage.create_item(make_item(item_id, price=item_id))
+        await redis.delete(storage.PRICE_INDEX, storage.category_index('tools'))
+        assert await reindex(count=10) == 3
+        assert await redis.zrange(storage.PRICE_INDEX, 0, -1, withscores=True) == [('1', 1), ('2', 2), ('3', 3)]
+        assert await redis.zcard(storage.category_index('tools')) == 3
+        await redis.connection_pool.disconnect()
+
+    asyncio.run(scenario())
@@ -0,0 +1,113 @@
+# tests/test_replicas.py
+"""
+The reads routed to the replicas and read-your-writes, see app/replicas.py. fakeredis doesn't replicate: the replica
+is another server, the tests copy the items to it, or not, to play the replication and its lag.
+"""
+import math
+import fakeredis
+import pytest
+import app.replicas as replicas
+import app.storage as storage
+from app.redis_db import redis, CircuitBreaker, decode_cursor
+from tests.conftest import make_item
+
+ADDRESS = 'replica:6379'
+
+@pytest.fixture
+def replica(monkeypatch):
+    """
+    A replica of the first node, always fresh. Its lag isn't measured, the tests set it.
+    """
+    replica_set = replicas.Replicas(redis, [ADDRESS])
+    client = replica_set.clients[ADDRESS]
+    client.connection_pool.connection_class = redis.connection_pool.connection_class
+    client.connection_pool.connection_kwargs['server'] = fakeredis.FakeServer()
+    replica_set.fresh_as_of[ADDRESS] = math.inf
+
+    async def measure():
+        pass
+
+    monkeypatch.setattr(replica_set, 'measure', measure)
+    monkeypatch.setitem(replicas.replica_sets, redis, replica_set)
+    return replica_set
+
+async def replicate(replica_set, item_id: int) -> None:
+    client = replica_set.clients[ADDRESS]
+    key = storage.legacy_key(item_id)
+    await client.hset(key, mapping=await redis.hgetall(key))
+
+def test_reads_go_to_the_replica(run, replica):
+    async def body(client):
+        assert (await client.post('/api/item', json=make_item(5))).status_code == 201
+        assert replicas.WRITE_COOKIE in client.cookies
+        # the client that wrote reads from the primary
+        assert (await client.get('/api/item/5')).status_code == 200
+        # another client reads from the replica, the write didn't reach it yet
+        client.cookies.clear()
+        assert (await client.get('/api/item/5')).status_code == 404
+        await replicate(replica, 5)
+        assert (await client.get('/api/item/5')).json()['Item']['id'] == 5
+        assert (await client.get('/api/items', params={"count": 10})).json()['items'] == []
+
+    run(body)
+
+def test_stale_or_open_replica_is_not_read(run, replica):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        client.cookies.clear()
+        replica.fresh_as_of[ADDRESS] = -math.inf
+        assert (await client.get('/api/item/5')).status_code == 200
+        replica.fresh_as_of[ADDRESS] = math.inf
+        breaker = replica.clients[ADDRESS].breaker
+        breaker.state = CircuitBreaker.OPEN
+        try:
+            assert (await client.get('/api/item/5')).status_code == 200
+        finally:
+            breaker.state = CircuitBreaker.CLOSED
+        assert (await client.get('/api/item/5')).status_code == 404
+
+    run(body)
+
+def test_cache_keeps_only_the_reads_of_a_primary(run, replica, cached):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        await client.post('/api/item', json=make_item(6))
+        await replicate(replica, 5)
+        # read from the primary, by the client that wrote
+        assert (await client.get('/api/item/6')).status_code == 200
+        assert 6 in cached._entries
+        client.cookies.clear()
+        assert (await client.get('/api/item/5')).status_code == 200
+        await client.request('GET', '/api/items/batch', json={"item_ids": [5]})
+        assert 5 not in cached._entries
+        # the item cached from the primary is newer than the replica
+        assert (await client.get('/api/item/6')).status_code == 200
+
+    run(body)
+
+def test_failed_write_sets_no_cookie(run, replica):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        client.cookies.clear()
+        assert (await client.post('/api/item', json=make_item(5))).status_code == 400
+        assert replicas.WRITE_COOKIE not in client.cookies
+
+    run(body)
+
+def test_scan_continues_on_the_same_replica(run, replica):
+    async def body(client):
+        keys = {f'tests:key:{i}' for i in range(20)}
+        await replica.clients[ADDRESS].mset({key: 1 for key in keys})
+        found, cursor = [], None
+        while True:
+            response = (await client.get('/api/redis/keys', params={"match": "tests:key:*", "count": 5,
+                                                                    **({"cursor": cursor} if cursor else {})})).json()
+            found += response['keys']
+            cursor = response['cursor']
+            if cursor is None:
+                break
+            # a SCAN cursor is only valid on the server that returned it
+            assert decode_cursor(cursor)[2] == ADDRESS
+        assert set(found) == keys
+
+    run(body)
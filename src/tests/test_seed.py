@@ -0,0 +1,45 @@
+# tests/test_seed.py
+"""
+The synthetic items and users of app/seed.py.
+"""
+import asyncio
+import json
+import app.seed as seed
+import app.storage as storage
+from app.redis_db import redis
+
+def test_seed_items(encoding):
+    async def scenario(concurrency: int) -> tuple[int, list[dict]]:
+        created = await seed.seed_items(50, start=1000, chunk=7, concurrency=concurrency, seed=1)
+        items = await storage.read_items(list(range(1000, 1050)))
+        return created, items
+
+    async def run_twice():
+        # the examples of app/definitions.py and the generated items
+        created, items = await scenario(concurrency=3)
+        assert created == 54
+        assert all(items) and {item['category'] for item in items} <= set(seed.CATEGORIES)
+        assert await redis.zcard(storage.PRICE_INDEX) == 54
+        # nothing is created again, the same seed gives the same items
+        assert await scenario(concurrency=1) == (0, items)
+        await redis.flushall()
+        created, again = await scenario(concurrency=1)
+        assert created == 54
+        assert [{**item, "version": 0} for item in again] == [{**item, "version": 0} for item in items]
+        await redis.connection_pool.disconnect()
+
+    asyncio.run(run_twice())
+
+def test_seed_users(tmp_path, monkeypatch):
+    users = tmp_path / 'users.json'
+    users.write_text('[]')
+    monkeypatch.setattr(seed, 'USR_DATABASE', str(users))
+    assert seed.seed_users(3, seed=1, processes=1) == 3
+    first = json.loads(users.read_text())
+    assert [user['email'] for user in first] == [f'seed{n}@example.com' for n in range(1, 4)]
+    assert seed.pbkdf2_sha256.verify('Password2', first[1]['password'])
+    # the users already in the file are kept, the next ones are the same with the same seed
+    assert seed.seed_users(4, seed=1, processes=1) == 1
+    second = json.loads(users.read_text())
+    assert second[:3] == first
+    assert second[3]['email'] == 'seed4@example.com'
@@ -0,0 +1,95 @@
+# tests/test_sharding.py
+"""
+The items sharded on many Redis nodes by consistent hashing, see REDIS_NODES in app/definitions.py.
+"""
+import pytest
+from fastapi import HTTPException
+import app.redis_db as redis_db
+import app.storage as storage
+from app.redis_db import HashRing, shards, connect, encode_cursor, decode_cursor
+from benchmark import use_fakeredis
+from tests.conftest import make_item
+
+NODES = ['tests1:6379', 'tests2:6379', 'tests3:6379']
+# one item per bucket, on every node
+ITEM_IDS = list(range(0, 3000, 100))
+
+@pytest.fixture
+def nodes(monkeypatch):
+    """
+    Three nodes, each one with its own fakeredis server. The first one is the node of the other tests.
+    """
+    shards.extend(connect(node) for node in NODES[1:])
+    use_fakeredis()
+    ring = HashRing(NODES)
+    monkeypatch.setattr(redis_db, 'ring', ring)
+    monkeypatch.setattr(storage, 'ring', ring)
+    yield shards
+    for client in shards[1:]:
+        client.connection_pool.reset()
+    del shards[1:]
+
+def test_items_on_every_node(run, nodes, encoding):
+    async def body(client):
+        response = await client.post('/api/items/batch', json=[make_item(item_id, price=item_id / 100)
+                                                                for item_id in ITEM_IDS])
+        assert response.json()['created'] == len(ITEM_IDS)
+        # each node has its own items and their index entries
+        counts = [await node.zcard(storage.PRICE_INDEX) for node in nodes]
+        assert all(counts) and sum(counts) == len(ITEM_IDS)
+        for item_id in ITEM_IDS:
+            assert await storage.shard_of(item_id).zscore(storage.PRICE_INDEX, str(item_id)) is not None
+        assert (await client.get('/api/item/2900')).json()['Item']['id'] == 2900
+        response = (await client.request('GET', '/api/items/batch', json={"item_ids": ITEM_IDS})).json()
+        assert response['found'] == len(ITEM_IDS)
+        # the pages of every node are merged in the order of the index
+        found, cursor = [], None
+        while True:
+            page = (await client.get('/api/items', params={"count": 7, **({"cursor": cursor} if cursor else {})})).json()
+            found += [item['id'] for item in page['items']]
+            cursor = page['cursor']
+            if cursor is None:
+                break
+        assert found == ITEM_IDS
+        response = await client.request('DELETE', '/api/items/batch', json={"item_ids": ITEM_IDS})
+        assert response.json()['deleted'] == len(ITEM_IDS)
+        assert [await node.zcard(storage.PRICE_INDEX) for node in nodes] == [0, 0, 0]
+
+    run(body)
+
+def test_keys_of_every_node(run, nodes):
+    async def body(client):
+        for i, node in enumerate(nodes):
+            await node.mset({f'tests:key:{i}:{k}': k for k in range(5)})
+        found, cursor = [], None
+        while True:
+            response = (await client.get('/api/redis/keys', params={"match": "tests:key:*", "count": 3,
+                                                                    **({"cursor": cursor} if cursor else {})})).json()
+            # and the hash 'visited' of the first node
+            assert response['dbsize'] == 16
+            found += response['keys']
+            cursor = response['cursor']
+            if cursor is None:
+                break
+        assert len(set(found)) == 15
+
+    run(body)
+
+def test_scan_cursor_of_many_nodes(nodes):
+    # the end of a node starts the next one, on any replica
+    assert decode_cursor(encode_cursor(0, 0, 'replica:6380')) == (1, 0, None)
+    assert decode_cursor(encode_cursor(1, 42, 'replica:6380')) == (1, 42, 'replica:6380')
+    assert encode_cursor(2, 0) is None
+
+def test_scan_cursor_out_of_range(nodes):
+    """
+    A cursor of a node that was removed from REDIS_NODES.
+    """
+    cursor = encode_cursor(2, 42)
+    removed = shards.pop()
+    try:
+        with pytest.raises(HTTPException) as error:
+            decode_cursor(cursor)
+        assert error.value.status_code == 400
+    finally:
+        shards.append(removed)
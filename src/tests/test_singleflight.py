@@ -0,0 +1,107 @@
+# tests/test_singleflight.py
+"""
+The coalescing of the concurrent reads of the same item, see app/singleflight.py.
+"""
+import asyncio
+import pytest
+import app.singleflight as singleflight
+import app.storage as storage
+from app.singleflight import SingleFlight
+from tests.conftest import make_item
+
+# keys of the reads of the items 1 and 2, see app/get.py
+A = (1, False)
+B = (2, False)
+
+@pytest.fixture
+def flights(monkeypatch):
+    flights = SingleFlight()
+    monkeypatch.setattr(singleflight, 'flights', flights)
+    # imported by name by the routers
+    monkeypatch.setattr('app.get.flights', flights)
+    monkeypatch.setattr('app.cache.flights', flights)
+    return flights
+
+def test_concurrent_calls_share_one_call():
+    calls = []
+
+    async def call(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return value
+
+    async def scenario():
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.do(A, lambda: call(1)) for _ in range(5)],
+                                       flights.do(B, lambda: call(2)))
+        assert results == [1] * 5 + [2]
+        assert (flights.leaders, flights.followers) == (2, 4)
+        assert flights.stats()['in_flight'] == 0
+        # the next call, after the first one is done, isn't shared
+        assert await flights.do(A, lambda: call(3)) == 3
+
+    asyncio.run(scenario())
+    assert calls == [1, 2, 3]
+
+def test_error_is_raised_in_every_caller():
+    async def failing():
+        await asyncio.sleep(0.05)
+        raise ConnectionError('down')
+
+    async def scenario():
+        flights = SingleFlight()
+        results = await asyncio.gather(*[flights.do(A, failing) for _ in range(3)], return_exceptions=True)
+        assert all(isinstance(result, ConnectionError) for result in results)
+
+    asyncio.run(scenario())
+
+def test_cancelled_caller_doesnt_cancel_the_call():
+    async def scenario():
+        flights = SingleFlight()
+        first = asyncio.create_task(flights.do(A, lambda: asyncio.sleep(0.05, result=1)))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(flights.do(A, lambda: asyncio.sleep(0.05, result=2)))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == 1
+
+    asyncio.run(scenario())
+
+def test_forget():
+    async def scenario():
+        flights = SingleFlight()
+        first = asyncio.create_task(flights.do(A, lambda: asyncio.sleep(0.05, result='before')))
+        await asyncio.sleep(0)
+        # a write of the item: the next readers don't get the read started before it
+        flights.forget(A)
+        second = asyncio.create_task(flights.do(A, lambda: asyncio.sleep(0.05, result='after')))
+        assert (await first, await second) == ('before', 'after')
+
+    asyncio.run(scenario())
+
+def test_concurrent_requests_read_redis_once(run, flights, monkeypatch):
+    reads = []
+    read_item = storage.read_item
+
+    async def slow_read(item_id):
+        reads.append(item_id)
+        await asyncio.sleep(0.05)
+        return await read_item(item_id)
+
+    monkeypatch.setattr(storage, 'read_item', slow_read)
+
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        responses = await asyncio.gather(*[client.get('/api/item/5') for _ in range(10)])
+        assert [response.status_code for response in responses] == [200] * 10
+        assert reads == [5]
+        stats = (await client.get('/api/cache/stats')).json()['singleflight']
+        assert (stats['reads'], stats['coalesced']) == (1, 9)
+        assert stats['hot_items'][0]['id'] == 5
+        assert stats['hot_items'][0]['coalesced'] == 9
+        # only the totals, no series per item
+        exposition = (await client.get('/metrics')).text
+        assert 'fakeapi_singleflight_reads_total{role="follower"} 9' in exposition
+        assert 'item=' not in exposition
+
+    run(body)
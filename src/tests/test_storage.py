@@ -0,0 +1,189 @@
+# tests/test_storage.py
+"""
+The storage of the items in Redis, see app/storage.py, and the Lua scripts that write them and keep the indexes,
+in both encodings.
+"""
+import asyncio
+import app.storage as storage
+from redis.exceptions import ResponseError
+from app.redis_db import redis
+from app.scripts import CREATE_ITEM, CREATE_PACKED
+from tests.conftest import make_item
+
+async def indexed(category: str) -> list[str]:
+    return await redis.zrange('index:category:' + category, 0, -1)
+
+def test_batch_create_get_and_delete(run, encoding):
+    async def body(client):
+        items = [make_item(item_id) for item_id in range(1, 251)]
+        response = await client.post('/api/items/batch', json=items[:200])
+        assert response.status_code == 200
+        assert response.json()['created'] == 200
+        assert await redis.zcard('index:price') == 200
+        # the existing items of a batch aren't overwritten
+        response = (await client.post('/api/items/batch', json=items[150:])).json()
+        assert (response['created'], response['failed']) == (50, 50)
+        assert [item['status'] for item in response['items']] == [400] * 50 + [201] * 50
+        assert await redis.zcard('index:price') == 250
+        response = (await client.request('GET', '/api/items/batch', json={"item_ids": [1, 250, 251]})).json()
+        assert (response['found'], response['missing']) == (2, 1)
+        assert [item['status'] for item in response['items']] == [200, 200, 404]
+        assert response['items'][1]['Item']['id'] == 250
+        response = await client.request('DELETE', '/api/items/batch', json={"item_ids": list(range(1, 252))})
+        assert response.status_code == 200
+        assert (response.json()['deleted'], response.json()['missing']) == (250, 1)
+        assert await redis.zcard('index:price') == 0
+        assert await indexed('tools') == []
+
+    run(body)
+
+def test_concurrent_creates_of_the_same_id(run, encoding):
+    async def body(client):
+        responses = await asyncio.gather(*[client.post('/api/item', json=make_item(5, description=str(i)))
+                                           for i in range(10)])
+        assert sorted(response.status_code for response in responses) == [201] + [400] * 9
+        created = next(response.json() for response in responses if response.status_code == 201)
+        assert (await client.get('/api/item/5')).json()['Item']['description'] == created['description']
+
+    run(body)
+
+def test_scripts_loaded_again_after_a_flush(run, encoding):
+    async def body(client):
+        await redis.script_flush()
+        assert (await client.post('/api/item', json=make_item(5))).status_code == 201
+        await redis.script_flush()
+        assert (await client.post('/api/items/batch', json=[make_item(6), make_item(7)])).json()['created'] == 2
+        script = CREATE_PACKED if encoding == 'bucket' else CREATE_ITEM
+        assert await redis.script_exists(script.sha) == [True]
+
+    run(body)
+
+def test_update_of_a_missing_item(run, encoding):
+    async def body(client):
+        assert (await client.put('/api/item/id', json=make_item(5))).status_code == 400
+        assert await storage.update_item(5, {"price": 1}) == -1
+        assert (await client.get('/api/item/5')).status_code == 404
+
+    run(body)
+
+def test_create_is_atomic_and_indexed(run, encoding):
+    async def body(client):
+        response = await client.post('/api/item', json=make_item(5))
+        assert response.status_code == 201
+        assert response.json()['version'] > 0
+        # an ID that already exists isn't overwritten
+        assert (await client.post('/api/item', json=make_item(5, description='Saw'))).status_code == 400
+        item = (await client.get('/api/item/5')).json()['Item']
+        assert item['description'] == 'Hammer'
+        assert await redis.zscore('index:price', '5') == 9.99
+        assert await indexed('tools') == ['5']
+
+    run(body)
+
+def test_update_moves_the_index_entries(run, encoding):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        response = await client.put('/api/item/id', json=make_item(5, price=2.5, category='grocery'))
+        assert response.status_code == 200
+        assert await redis.zscore('index:price', '5') == 2.5
+        assert await indexed('tools') == []
+        assert await indexed('grocery') == ['5']
+
+    run(body)
+
+def test_delete_removes_the_index_entries(run, encoding):
+    async def body(client):
+        await client.post('/api/item', json=make_item(5))
+        assert (await client.request('DELETE', '/api/delete/id/', json={"item_id": 5})).status_code == 200
+        assert (await client.get('/api/item/5')).status_code == 404
+        assert await redis.zscore('index:price', '5') is None
+        assert await indexed('tools') == []
+
+    run(body)
+
+def test_delete_key_keeps_the_indexes(run, encoding):
+    """
+    An item deleted with DELETE /api/redis/key and created again in another category isn't found in its old one.
+    """
+    async def body(client):
+        await client.post('/api/item', json=make_item(5, category='tools'))
+        key = 'items:0' if encoding == 'bucket' else 'item:5'
+        assert (await client.delete(f'/api/redis/key/{key}')).status_code == 200
+        assert await redis.exists(key) == 0
+        await client.post('/api/item', json=make_item(5, category='grocery', description='Milk'))
+        assert (await client.get('/api/items', params={"category": "tools"})).json()['items'] == []
+        items = (await client.get('/api/items', params={"category": "grocery"})).json()['items']
+        assert [item['description'] for item in items] == ['Milk']
+
+    run(body)
+
+def test_delete_key_of_a_bucket_deletes_its_items(run, monkeypatch):
+    async def body(client):
+        for item_id in (1, 2, 3):
+            await client.post('/api/item', json=make_item(item_id))
+        assert (await client.delete('/api/redis/key/items:0')).status_code == 200
+        assert await redis.zcard('index:price') == 0
+        assert [(await client.get(f'/api/item/{item_id}')).status_code for item_id in (1, 2, 3)] == [404] * 3
+
+    monkeypatch.setattr(storage, 'BUCKETS', True)
+    run(body)
+
+def test_keys_of_the_app_are_kept(run):
+    """
+    The indexes, the idempotency responses and the visits aren't listed nor deleted by /api/redis.
+    """
+    async def body(client):
+        await client.post('/api/item', json=make_item(5), headers={"Idempotency-Key": "tests"})
+        await redis.hset('visited', 'tests', 1)
+        await redis.set('tests:key', 1)
+        assert await redis.keys('idempotency:*')
+        keys = (await client.get('/api/redis/keys', params={"count": 100})).json()['keys']
+        assert sorted(keys) == ['item:5', 'tests:key']
+        response = await client.get('/api/redis/keys', params={"stream": True})
+        assert sorted(response.text.split()) == ['"item:5"', '"tests:key"']
+        for key in ('index:price', 'index:category:tools', 'visited'):
+            response = await client.delete(f'/api/redis/key/{key}')
+            assert response.status_code == 400
+            assert await redis.exists(key) == 1
+        # not a hash
+        assert (await client.delete('/api/redis/key/tests:key')).status_code == 400
+
+    run(body)
+
+def test_packed_items_have_a_version(monkeypatch):
+    async def scenario():
+        version = await storage.create_item(make_item(5))
+        value = await redis.hget(storage.bucket_key(5), '5')
+        assert value.startswith(f'v{version}|')
+        assert storage.unpack(5, value) == {**make_item(5), "version": version}
+        assert storage.pack(storage.unpack(5, value)) == value
+        await redis.connection_pool.disconnect()
+
+    monkeypatch.setattr(storage, 'BUCKETS', True)
+    asyncio.run(scenario())
+
+def test_batch_delete_reports_the_errors(run, monkeypatch):
+    """
+    An item that Redis fails to delete doesn't fail the others.
+    """
+    run_pipeline = storage.run_pipeline
+
+    async def failing_pipeline(script, calls, client):
+        results = await run_pipeline(script, calls, client)
+        results[1] = ResponseError('failed')
+        return results
+
+    async def body(client):
+        await client.post('/api/items/batch', json=[make_item(item_id) for item_id in range(1, 6)])
+        monkeypatch.setattr(storage, 'run_pipeline', failing_pipeline)
+        response = (await client.request('DELETE', '/api/items/batch', json={"item_ids": [1, 2, 9]})).json()
+        assert (response['deleted'], response['missing'], response['failed']) == (1, 1, 1)
+        assert [item['status'] for item in response['items']] == [200, 500, 404]
+        assert response['items'][1]['detail'] == 'failed'
+        # the bucket of the items 2 to 5
+        response = await client.delete('/api/redis/key/items:0')
+        assert response.status_code == 500
+        assert 'failed' in response.headers['X-Fake-REST-API']
+
+    monkeypatch.setattr(storage, 'BUCKETS', True)
+    run(body)
@@ -0,0 +1,36 @@
+# tests/test_users.py
+"""
+The users kept in memory by jwtauth/database.py.
+"""
+import json
+import os
+from jwtauth.database import UserRepository
+from jwtauth.model import UserSchema
+
+def make_user(n: int) -> UserSchema:
+    return UserSchema(fullname=f'User{n} Name{n}', email=f'user{n}@example.com', password=f'Password{n}', role='OPS')
+
+def test_lookups(tmp_path):
+    filename = tmp_path / 'users.json'
+    filename.write_text('[]')
+    users = UserRepository(str(filename))
+    assert users.add(make_user(1))
+    assert not users.add(make_user(1))
+    user = users.by_email('user1@example.com')
+    assert users.by_id(user.id) == user
+    # changed by another worker
+    filename.write_text(json.dumps(json.loads(filename.read_text()) + [json.loads(make_user(2).json())]))
+    os.utime(filename, ns=(0, 0))
+    assert [user.email for user in users.all()] == ['user1@example.com', 'user2@example.com']
+
+def test_lookup_doesnt_wait_for_a_write(tmp_path):
+    filename = tmp_path / 'users.json'
+    filename.write_text('[]')
+    users = UserRepository(str(filename))
+    assert users.add(make_user(1))
+    filename.write_text('[]')
+    os.utime(filename, ns=(0, 0))
+    # held by add() in the threadpool
+    with users._lock:
+        assert users.by_email('user1@example.com') is not None
+    assert users.by_email('user1@example.com') is None